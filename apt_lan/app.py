@@ -1,7 +1,6 @@
 ''' Main app structure '''
 
 # Required packages:
-#   - dpkg-dev (/usr/bin/dpkg-scanpackages)
 #   - rsync (for rsyncd)
 # --------------------------------------------------
 #   - python3-pyftpdlib (used to create FTP server)
@@ -13,7 +12,9 @@ import sys
 
 from pathlib import Path
 
-from apt_lan import cmd, utils
+# Other apt_lan modules are imported by the commands that use them, so that
+#   quick runs like --version don't load the sync machinery.
+from apt_lan import utils
 
 
 class App():
@@ -24,6 +25,11 @@ class App():
         # TODO: consolidate the next two attributes into one.
         self.apt_lan_dir = Path(f'/var/cache/{self.pkg_name}')
         self.share_path = self.apt_lan_dir
+        # Persistent state (peer cache, indexes) kept outside the folder that
+        #   rsyncd shares with the LAN.
+        self.state_dir = Path(f'/var/lib/{self.pkg_name}')
+        # Content-addressed package store; archive folders hold links into it.
+        self.store_dir = self.state_dir / 'blobs'
         self.log_dir = Path(f'/var/log/{self.pkg_name}')
         self.log_path = self.log_dir / f"{self.pkg_name}.log"
 
@@ -34,6 +40,13 @@ class App():
             'lan': self.share_path / self.os_rel / self.arch_d
         }
         self.ports = [22022] # custom rsyncd
+        # In-memory state kept between syncs when running as a daemon.
+        self.peer_cache = None
+        self.beacons = None
+        # Metrics of the sync in progress, if it's being measured.
+        self.metrics = None
+        # Set from "--profile[=path]".
+        self.profile = None
 
     def run(self, cmdline):
         self.exe_path = Path(cmdline[0]).resolve()
@@ -61,6 +74,38 @@ class App():
             action='store_true',
             help="Update apt-lan archive with LAN systems' apt-lan archives."
         )
+        parser.add_argument(
+            '--beacon', '-b',
+            action='store_true',
+            help="Announce apt-lan archive to LAN systems until stopped."
+        )
+        parser.add_argument(
+            '--daemon', '-D',
+            action='store_true',
+            help="Run syncs whenever APT or LAN packages change until stopped."
+        )
+        parser.add_argument(
+            '--watch', '-w',
+            action='store_true',
+            help="Add new APT archive packages to apt-lan archive as they're downloaded until stopped."
+        )
+        parser.add_argument(
+            '--health',
+            action='store_true',
+            help="Check that rsyncd is serving the apt-lan archive; exit 1 if not."
+        )
+        parser.add_argument(
+            '--verify-index',
+            action='store_true',
+            help="Check apt-lan's cached package index against a full rescan."
+        )
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='',
+            metavar='PATH',
+            help="Profile the command, saving stats to PATH (default: a .pstats file in the log folder) and a summary to the log."
+        )
         parser.add_argument(
             '--debug', '-d',
             action='store_true',
@@ -68,7 +113,7 @@ class App():
         )
 
         self.args = parser.parse_args()
-        if not any([self.args.apply, self.args.version, self.args.server_sync, self.args.client_sync]):
+        if not any([self.args.apply, self.args.version, self.args.server_sync, self.args.client_sync, self.args.beacon, self.args.daemon, self.args.watch, self.args.health, self.args.verify_index]):
             # No command line args passed.
             parser.print_help()
             return 1
@@ -110,6 +155,13 @@ class App():
         utils.set_up_logging(self)
         logging.debug(f"runmode = {self.runmode}")
 
+        self.profile = self.args.profile
+        if self.profile is not None:
+            from apt_lan import profiling
+            return profiling.run_profiled(self, self.run_command, self.profile)
+        return self.run_command()
+
+    def run_command(self):
         # Run functions for passed option.
         if self.args.apply:
             if self.runmode == 'test':
@@ -123,16 +175,46 @@ class App():
             utils.apply_config(self)
 
             # Run sync.
+            from apt_lan import cmd, lock, metrics
             logging.info(f"Starting server packages sync from system.")
-            ret = cmd.run_server_sync(self)
+            ret = lock.run_locked(self, metrics.run_measured, 'server', cmd.run_server_sync)
 
         elif self.args.client_sync:
             # Apply current config.
             utils.apply_config(self)
 
             # Run sync.
+            from apt_lan import cmd, lock, metrics
             logging.info(f"Starting client packages sync from LAN.")
-            ret = cmd.run_client_sync(self)
+            ret = lock.run_locked(self, metrics.run_measured, 'client', cmd.run_client_sync)
+
+        elif self.args.beacon:
+            from apt_lan import cmd
+            self.config = utils.get_config(self)
+            logging.info(f"Starting apt-lan beacon.")
+            ret = cmd.run_announcer(self)
+
+        elif self.args.daemon:
+            # Apply current config.
+            utils.apply_config(self)
+
+            from apt_lan import daemon
+            logging.info(f"Starting apt-lan daemon.")
+            ret = daemon.run_daemon(self)
+
+        elif self.args.watch:
+            from apt_lan import daemon
+            self.config = utils.get_config(self)
+            logging.info(f"Watching APT archive for new packages.")
+            ret = daemon.run_daemon(self, client=False)
+
+        elif self.args.health:
+            from apt_lan import health
+            ret = health.run_health_check(self)
+
+        elif self.args.verify_index:
+            from apt_lan import cmd
+            ret = cmd.run_verify_index(self)
 
         else:
             # Unknown options are handled elsewhere.
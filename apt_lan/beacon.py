@@ -0,0 +1,155 @@
+''' Functions related to announcing apt-lan shares over UDP multicast '''
+
+import hashlib
+import json
+import logging
+import select
+import socket
+import struct
+import time
+
+from apt_lan import health
+
+
+MCAST_GROUP = '239.255.22.22'
+MCAST_PORT = 22022
+BEACON_VERSION = 1
+
+
+def get_file_digest(file):
+    """
+    Return SHA256 hex digest of file, or an empty string if it doesn't exist.
+    """
+    sha256 = hashlib.sha256()
+    try:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha256.update(chunk)
+    except FileNotFoundError:
+        return ''
+    return sha256.hexdigest()
+
+def build_beacon(app):
+    """
+    Describe this system's LAN share in a small dict.
+    """
+    dest_dir = app.deb_archives.get('lan')
+    return {
+        'v': BEACON_VERSION,
+        'host': app.hostname,
+        'release': app.os_rel,
+        'arch': app.arch_d,
+        'port': app.ports[0],
+        'count': len(list(dest_dir.glob('*.deb'))),
+        'digest': get_file_digest(dest_dir / 'Packages.gz'),
+        # Result of the last rsyncd health check; None if there wasn't one.
+        'ready': health.is_ready(app.state_dir),
+    }
+
+def encode_message(message):
+    return json.dumps(message, separators=(',', ':')).encode()
+
+def decode_message(data):
+    try:
+        message = json.loads(data.decode())
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(message, dict) or message.get('v') != BEACON_VERSION:
+        return None
+    return message
+
+def open_socket(group=MCAST_GROUP, port=MCAST_PORT):
+    """
+    Open a UDP socket that is a member of the multicast group.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    # Both announcer and listener may run on the same system.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    # Keep beacons on the LAN.
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    return sock
+
+def send_message(sock, message, group=MCAST_GROUP, port=MCAST_PORT):
+    sock.sendto(encode_message(message), (group, port))
+
+def run_announcer(app, interval=60, group=MCAST_GROUP, port=MCAST_PORT):
+    """
+    Multicast this system's beacon every "interval" seconds, and right away
+    whenever a client asks for beacons. Runs until interrupted.
+    """
+    logging.info(f"Announcing apt-lan share to {group}:{port} every {interval} s.")
+    with open_socket(group, port) as sock:
+        next_beacon = 0
+        while True:
+            now = time.time()
+            if now >= next_beacon:
+                send_message(sock, build_beacon(app), group, port)
+                next_beacon = now + interval
+            ready, _, _ = select.select([sock], [], [], next_beacon - now)
+            if not ready:
+                continue
+            data, addr = sock.recvfrom(4096)
+            message = decode_message(data)
+            if message and message.get('query'):
+                logging.debug(f"Beacon query from {addr[0]}.")
+                # Answer right away so that clients can listen only briefly.
+                next_beacon = 0
+
+def listen_for_beacons(wait, own_ip=None, group=MCAST_GROUP, port=MCAST_PORT):
+    """
+    Ask LAN shares to announce themselves and collect beacons for "wait"
+    seconds. Returns a dict of {ip: beacon}.
+    """
+    beacons = {}
+    logging.info(f"Listening for apt-lan beacons for {wait} s...")
+    try:
+        sock = open_socket(group, port)
+    except OSError as e:
+        logging.warning(f"Unable to listen for beacons: {e}")
+        return beacons
+    with sock:
+        send_message(sock, {'v': BEACON_VERSION, 'query': 1}, group, port)
+        deadline = time.time() + wait
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([sock], [], [], remaining)
+            if not ready:
+                break
+            data, addr = sock.recvfrom(4096)
+            ip = addr[0]
+            message = decode_message(data)
+            if not message or message.get('query') or ip == own_ip:
+                continue
+            logging.debug(f"Beacon from {ip}: {message}")
+            beacons[ip] = message
+    logging.info(f"{len(beacons)} apt-lan beacons received.")
+    return beacons
+
+def select_beacon_ips(beacons, release, arch, port, own_digest=''):
+    """
+    Sort IPs of beaconing shares that have packages for release and arch into
+    those worth syncing from and those whose Packages.gz matches our own.
+    """
+    new_ips = []
+    same_ips = []
+    for ip, b in beacons.items():
+        if b.get('release') != release or b.get('arch') != arch or b.get('port') != port:
+            continue
+        if not b.get('count'):
+            continue
+        if b.get('ready') is False:
+            logging.debug(f"{ip} reports that its share isn't being served.")
+            continue
+        if own_digest and b.get('digest') == own_digest:
+            logging.debug(f"{ip} has the same packages as this system.")
+            same_ips.append(ip)
+        else:
+            new_ips.append(ip)
+    new_ips.sort()
+    same_ips.sort()
+    return new_ips, same_ips
@@ -2,17 +2,25 @@ import ipaddress
 import logging
 import netifaces
 import os
+import queue
 import socket
 import subprocess
+import threading
 import time
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
 
-def lan_connect(hostname, port):
+
+def lan_connect(hostname, port, timeout=10):
+    """
+    Check if hostname accepts connections on port; timeout is in milliseconds.
+    """
     logging.debug(f"Connecting to {hostname}:{port}...")
-    timeout = 10 # milliseconds
     tos = timeout / 1000
-    socket.setdefaulttimeout(tos)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # Set timeout per socket so that concurrent probes don't share it.
+        sock.settimeout(tos)
         result = sock.connect_ex((hostname, port))
     logging.debug(f"result: {result}; {os.strerror(result)}")
     return result == 0
@@ -57,96 +65,162 @@ def get_network_info():
                 return lan_ip, netmask
     return None, None
 
-def get_share_ips(own_ip, netmask, ports):
+def probe_ip(ip, port, timeout=10):
     """
-    Search the local network for IPs with open share ports.
+    Probe a single IP for an open share port; return (ip, found, duration).
     """
-    lan_ips = []
+    t_start = time.time()
+    found = lan_connect(ip, port, timeout)
+    duration = time.time() - t_start
+    logging.debug(f"Search for {ip} lasted {duration} s.")
+    return ip, found, duration
 
-    logging.info(f"Checking LAN for IPs with open port {ports[0]}...")
+def list_subnet_ips(own_ip, netmask):
+    """
+    Yield all host IPs in the subnet except own_ip.
+    """
     netw = ipaddress.ip_network(f"{own_ip}/{netmask}", strict=False)
-    for ip in netw:
-        if str(ip) == own_ip:
+    for ip in netw.hosts():
+        ip = str(ip)
+        if ip == own_ip:
             logging.debug(f"Skipped own IP: {own_ip}.")
             continue
-        # It takes too long to scan 2 ports for every IP, so only scanning :139.
-        t_start = time.time()
-        found = lan_connect(str(ip), ports[0])
-        t_end = time.time()
-        duration = t_end - t_start
-        logging.debug(f"Search for {ip} lasted {duration} s.")
-        if found:
-            logging.debug(f"LAN share IP found: {ip}")
-            lan_ips.append(str(ip))
-    return lan_ips
+        yield ip
 
-def get_files_from_share(share_uri, port, filenames=None, dst_dir=None):
-    orig_cwd = os.getcwd()
-    logging.debug(f"share_uri: {share_uri}")
-    # if dst_dir:
-    #     os.chdir(dst_dir)
-    #     logging.debug(f"cd to {dst_dir}")
-    uri_parts = share_uri.split('/')
-    share_ip = uri_parts[2]
-    # Shared folder "local-cache" is parent. Only "focal", etc. are visible.
-    dir_path = '/'.join(uri_parts[3:])
-    logging.debug(f"Share IP: {share_ip}")
-    logging.debug(f"Share subfolder path: {dir_path}")
+def run_probes(ips, port, results, stop, workers=64, timeout=10):
+    """
+    Probe the given IPs with at most "workers" probes in flight at once.
+    Each probe result is put onto the "results" queue as soon as it's known.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for ip in ips:
+                if stop.is_set():
+                    break
+                pending.add(executor.submit(probe_ip, ip, port, timeout))
+                if len(pending) >= workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for d in done:
+                        results.put(d.result())
+            done, pending = wait(pending)
+            for d in done:
+                results.put(d.result())
+    finally:
+        # Signal the end of the probes.
+        results.put(None)
 
-    if port == 22022: # Wasta rsync
-        # TODO: Need to verify that requested release and arch folders exist.
-        #   See the verify_rsync_folder function below.
-        cmd = ['rsync', f'--port={port}', f'{share_uri}/']
-        if filenames == None:
-            # Get file list.
-            cmd.append('--list-only')
-            # r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) # python3.7
-            r = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-            )
-            logging.debug(f"cmd: {' '.join(r.args)}")
-            if r.returncode == 23:
-                logging.warning(f"Skipping missing folder at {share_uri}.")
-                return []
-            elif r.returncode != 0:
-                logging.error(f"Failed to get file list:")
-                logging.error(r.stdout)
-                return []
-            lines = r.stdout.splitlines()
-            files = [l.split()[-1] for l in lines]
-            logging.debug(f"File list:")
-            for f in files:
-                logging.debug(f"  {f}")
-            return files
-        else:
-            # Update rsync command.
-            cmd.append(str(dst_dir))
-            src_dir = cmd[2]
+def iter_probe_hits(ips, port, workers=64, timeout=10):
+    """
+    Start probing the given IPs in the background and return a generator that
+    yields (ip, duration) for each IP with an open port as soon as it's found.
+    """
+    results = queue.Queue()
+    stop = threading.Event()
+    probes = threading.Thread(
+        target=run_probes,
+        args=(ips, port, results, stop),
+        kwargs={'workers': workers, 'timeout': timeout},
+        daemon=True,
+    )
+    probes.start()
+    return drain_probe_results(results, stop)
+
+def drain_probe_results(results, stop):
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            ip, found, duration = result
+            if found:
+                logging.debug(f"LAN share IP found: {ip}")
+                yield ip, duration
+    finally:
+        # Stop probing if the caller quits early.
+        stop.set()
 
-            # Get files.
-            if len(filenames) == 1:
-                # Source is only one specific file (superseded.txt).
-                cmd[2] = src_dir + filenames[0]
-            else:
-                cmd.append('--recursive')
-            # r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) # python3.7
-            r = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-            )
-            logging.debug(f"cmd: {' '.join(r.args)}")
-            if r.returncode == 23:
-                logging.warning(f"Skipping missing folder at {share_uri}.")
-                return
-            elif r.returncode != 0:
-                logging.error(f"Failed to get file list:")
-                logging.error(r.stdout)
-                return
+def iter_share_ips(own_ip, netmask, ports, workers=64, timeout=10):
+    """
+    Search the local network for IPs with open share ports, yielding each one
+    as soon as it's found. The sweep runs in the background, so the caller can
+    work with early results while the rest of the subnet is being probed.
+    """
+    logging.info(f"Checking LAN for IPs with open port {ports[0]}...")
+    logging.debug(f"Scan concurrency: {workers}; probe timeout: {timeout} ms")
+    ips = list_subnet_ips(own_ip, netmask)
+    for ip, duration in iter_probe_hits(ips, ports[0], workers, timeout):
+        yield ip
+
+def get_share_ips(own_ip, netmask, ports, workers=64, timeout=10):
+    """
+    Search the local network for IPs with open share ports.
+    """
+    return list(iter_share_ips(own_ip, netmask, ports, workers, timeout))
+
+def fetch_share_files(share_uri, port, filenames, dst_dir, bwlimit=0, link_dest=None):
+    """
+    Get the named files from share_uri into dst_dir over a single rsync
+    session, at no more than bwlimit bytes/s if given. Files missing from
+    the share are ignored. If link_dest is given, files that are unchanged
+    there are hardlinked from it instead of transferred.
+    Returns {file name: bytes} of files transferred, or None on failure.
+    """
+    cmd = [
+        'rsync',
+        f'--port={port}',
+        '--files-from=-',
+        '--ignore-missing-args',
+        '--times',
+        '--out-format=%n %l',
+        f'{share_uri}/',
+        str(dst_dir),
+    ]
+    if bwlimit:
+        cmd.insert(1, f'--bwlimit={max(1, bwlimit // 1024)}')
+    if link_dest and Path(link_dest).is_dir():
+        cmd.insert(1, f'--link-dest={Path(link_dest).resolve()}')
+    logging.debug(f"cmd: {' '.join(cmd)}")
+    transferred = {}
+    messages = []
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    def send_filenames():
+        # Write in a thread so that a long list can't block reading output.
+        try:
+            for name in filenames:
+                proc.stdin.write(f"{name}\n")
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    writer = threading.Thread(target=send_filenames, daemon=True)
+    writer.start()
+    for line in proc.stdout:
+        line = line.rstrip('\n')
+        name, _, size = line.rpartition(' ')
+        if name.endswith('/'):
+            # Folder created for the files; not a transferred file.
+            continue
+        if name and size.isdigit():
+            transferred[name] = int(size)
+            logging.debug(f"Got {name} ({size} B) from {share_uri}; {len(transferred)} of {len(filenames)} files")
+        else:
+            messages.append(line)
+    writer.join()
+    returncode = proc.wait()
 
-    # os.chdir(orig_cwd)
-    # logging.debug(f"cd to {orig_cwd}")
+    total = sum(transferred.values())
+    logging.info(f"{len(transferred)} files, {total} B, transferred from {share_uri}.")
+    if returncode in (23, 24):
+        logging.warning(f"Partial transfer from {share_uri}:")
+        logging.warning('\n'.join(messages))
+    elif returncode != 0:
+        logging.error(f"Failed to get files from {share_uri}:")
+        logging.error('\n'.join(messages))
+        return None
+    return transferred
@@ -1,28 +1,52 @@
 ''' Main command line processing '''
 
+import json
 import logging
 import os
 import shutil
-import subprocess
-import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-from apt_lan import client, server, pkgs, utils
+from apt_lan import beacon, client, downloads, health, index, manifest, metrics, peers, placement, server, pkgs, store, superseded, throttle, utils
 
 
 def run_server_sync(app):
     # share_config = Path(f"/var/lib/samba/usershares/{app.pkg_name}")
+    sync_metrics = app.metrics or metrics.SyncMetrics('server')
+    sync_metrics.enter('setup')
+
+    # Keep the sync from slowing down the system's users.
+    policy = throttle.get_policy(app.config, 'system')
+    throttle.apply_priority(policy)
+    bucket = throttle.get_bucket(policy)
 
     # Ensure that file share is properly configured.
     app.share_path.mkdir(parents=True, exist_ok=True, mode=0o755)
-    server.ensure_rsyncd_setup(app.ports[0], app.share_path, app.loglevel)
+    rsyncd_status = server.ensure_rsyncd_setup(app)
+    use_daemon = utils.get_config_value(app.config, 'system', 'daemon', 'no') == 'yes'
+    if app.beacons is None and not use_daemon and utils.get_config_value(app.config, 'system', 'beacon_interval', 60) > 0:
+        # The daemon sends its own beacons, even when this sync wasn't run by it.
+        server.ensure_beacon_setup()
+
+    # Skip the sync if nothing it depends on has changed since the last one.
+    state = get_server_state(app)
+    state_file = app.state_dir / 'server-sync.json'
+    last_state = load_server_state(state_file) or {}
+    if state == last_state:
+        logging.info('Nothing changed since last server sync.\n')
+        return 0
 
     # Create a list of approved debs to copy from archives to local-cache:
+    sync_metrics.enter('list')
     system_debs = pkgs.list_archive_debs(app.deb_archives.get('system'))
     logging.info(f"System debs count: {len(system_debs)}")
     # logging.debug(f"System debs: {', '.join(system_debs)}")
-    good_debs = pkgs.list_good_debs(app.config.get('repositories'))
+    good_debs = pkgs.list_good_debs(
+        app.config.get('repositories'),
+        cache_file=app.state_dir / 'good-debs.cache',
+    )
     logging.debug(f"Allowed debs count: {len(good_debs)}")
     approved_debs = pkgs.list_approved_debs(system_debs, good_debs)
     logging.info(f"Approved debs count: {len(approved_debs)}")
@@ -43,27 +67,180 @@ def run_server_sync(app):
 
     # Remove debs already in destination from copy list.
     debs_to_copy = pkgs.list_debs_to_copy(approved_debs, dest_debs)
-    # Get list of debs from superseded_debs_file.
-    superseded_debs_file = dest_dir / 'superseded.txt'
-    superseded_debs = []
-    if superseded_debs_file.is_file():
-        superseded_debs = pkgs.get_superseded_debs(superseded_debs_file)
-    else:
-        # Create empty file to be populated later.
-        superseded_debs_file.touch()
-    # Remove debs in "superseded_debs" list from copy list.
-    for deb in debs_to_copy[:]:
-        if deb in superseded_debs:
-            debs_to_copy.remove(deb)
+    # Remove debs listed in the superseded log from copy list.
+    superseded_log = superseded.SupersededLog(dest_dir).load()
+    debs_to_copy = superseded_log.exclude(debs_to_copy)
 
     logging.debug(f"Packages to copy count: {len(debs_to_copy)}")
     if len(debs_to_copy) == 0:
+        if last_state.get('index_failed'):
+            # Debs are in place but the last sync couldn't index them.
+            ret = rebuild_index(app, dest_dir, cache_file=utils.get_index_cache_file(app, dest_dir))
+            if ret != 0:
+                save_server_state(app, state_file, dict(state, index_failed=True))
+                return ret
         # Already up-to-date. Nothing more to do.
+        save_server_state(app, state_file, state)
         logging.info('Server packages already synced.\n')
         return 0
 
     logging.debug(f"Packages to copy: {', '.join(debs_to_copy)}")
 
+    sync_metrics.enter('place')
+    ret = place_debs(app, debs_to_copy, dest_dir, dest_bytes_free, bucket, sync_metrics)
+    if ret != 0:
+        return ret
+
+    # Scan new debs in destination; stanzas of known debs come from the cache.
+    sync_metrics.enter('scan')
+    index_cache = utils.get_index_cache_file(app, dest_dir)
+    stanzas = index.scan_debs(dest_dir, cache_file=index_cache)
+    dest_debs = pkgs.DebSet(stanzas)
+
+    # List newest amd64 and i386 packages to keep.
+    logging.info("Listing packages to be kept...")
+    kept_debs = index.newest_debs(stanzas, ['amd64', 'i386'])
+    logging.info(f"{len(kept_debs)} amd64 and i386 packages found.")
+
+    # Remove non-kept packages.
+    sync_metrics.enter('prune')
+    logging.debug(f"All kept packages: {', '.join(kept_debs)}")
+    removed_debs = dest_debs - kept_debs
+    sync_metrics.count('debs_removed', len(removed_debs))
+    for deb in removed_debs:
+        file = dest_dir / deb
+        file.unlink()
+        logging.debug(f"{file} removed from LAN cache.")
+    superseded_log.append(removed_debs)
+    superseded_log.compact(utils.get_config_value(app.config, 'system', 'superseded_max', 50000))
+
+    # Store each distinct deb once, whatever its release or arch folder.
+    sync_metrics.enter('store')
+    store.add_files(app.store_dir, dest_dir, {d: stanzas[d] for d in kept_debs})
+    store.prune(app.store_dir, app.share_path)
+
+    logging.info(f"{len(kept_debs)} packages in apt-lan cache. {len(superseded_log)} others are listed as obsolete. {len(removed_debs)} were removed.")
+    sync_metrics.count('debs_total', len(kept_debs))
+
+    # Rebuild Packages.gz file.
+    sync_metrics.enter('index')
+    ret = rebuild_index(app, dest_dir, cache_file=index_cache)
+    if ret != 0:
+        # The saved state never matches, so that the next sync tries again.
+        save_server_state(app, state_file, dict(state, index_failed=True))
+        return ret
+    if not rsyncd_status.get('ready'):
+        # On new installs rsyncd is first checked before there's an index to serve.
+        rsyncd_status = health.check_rsyncd(app)
+        logging.info(f"rsyncd ready: {rsyncd_status.get('ready')}")
+    store.report(app.store_dir, app.share_path)
+    save_server_state(app, state_file, state)
+
+    logging.info("System packages sync complete.\n")
+    return 0
+
+def get_dir_key(dir):
+    try:
+        st = os.stat(str(dir))
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_ino]
+
+def get_server_state(app):
+    """
+    Return what a server sync's result depends on. Adding or removing debs
+    or package lists changes the mtime of their folder.
+    """
+    return {
+        'config': app.config,
+        'system': get_dir_key(app.deb_archives.get('system')),
+        'lists': get_dir_key(pkgs.LISTS_DIR),
+        'lan': get_dir_key(app.deb_archives.get('lan')),
+    }
+
+def load_server_state(state_file):
+    try:
+        return json.loads(Path(state_file).read_text())
+    except (OSError, ValueError):
+        return None
+
+def save_server_state(app, state_file, state):
+    """
+    Save the state a server sync started from, with the LAN archive as the
+    sync left it. Changes made to the other folders during the sync are
+    caught by the next one.
+    """
+    state = dict(state, lan=get_dir_key(app.deb_archives.get('lan')))
+    utils.write_file_atomic(state_file, json.dumps(state))
+
+def run_server_changes_sync(app, names):
+    """
+    Add the named debs from the system's APT archive to the LAN archive and
+    its index. Neither archive is listed in full, so the cost depends on the
+    number of changed debs rather than on the size of the archives.
+    """
+    sync_metrics = app.metrics or metrics.SyncMetrics('changes')
+    sync_metrics.enter('setup')
+    policy = throttle.get_policy(app.config, 'system')
+    throttle.apply_priority(policy)
+
+    src_dir = app.deb_archives.get('system')
+    dest_dir = app.deb_archives.get('lan')
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    # Only consider new debs that are approved and not superseded.
+    sync_metrics.enter('list')
+    new_debs = pkgs.DebSet(n for n in names if (src_dir / n).is_file() and not (dest_dir / n).exists())
+    if not new_debs:
+        logging.info('No new packages to add.')
+        return 0
+    good_debs = pkgs.list_good_debs(
+        app.config.get('repositories'),
+        cache_file=app.state_dir / 'good-debs.cache',
+    )
+    superseded_log = superseded.SupersededLog(dest_dir).load()
+    debs_to_copy = superseded_log.exclude(pkgs.list_approved_debs(new_debs, good_debs))
+    logging.info(f"{len(debs_to_copy)} of {len(new_debs)} new packages approved for {dest_dir}.")
+    if not debs_to_copy:
+        return 0
+    logging.debug(f"Packages to copy: {', '.join(debs_to_copy)}")
+    dest_bytes_free = shutil.disk_usage(str(dest_dir)).free
+    sync_metrics.enter('place')
+    ret = place_debs(app, debs_to_copy, dest_dir, dest_bytes_free, throttle.get_bucket(policy), sync_metrics)
+    if ret != 0:
+        return ret
+
+    # Index only the new debs, then keep the newest of each affected package.
+    sync_metrics.enter('scan')
+    index_cache = utils.get_index_cache_file(app, dest_dir)
+    stanzas = index.update_stanzas(dest_dir, added=debs_to_copy, cache_file=index_cache)
+    packages = set(stanzas[d].get('Package') for d in debs_to_copy if d in stanzas)
+    related = {n: f for n, f in stanzas.items() if f.get('Package') in packages}
+    removed_debs = pkgs.DebSet(related) - index.newest_debs(related, ['amd64', 'i386'])
+    sync_metrics.enter('prune')
+    sync_metrics.count('debs_removed', len(removed_debs))
+    for deb in removed_debs:
+        file = dest_dir / deb
+        file.unlink()
+        logging.debug(f"{file} removed from LAN cache.")
+    if removed_debs:
+        stanzas = index.update_stanzas(dest_dir, removed=removed_debs, cache_file=index_cache)
+        superseded_log.append(removed_debs)
+
+    # Store each distinct deb once, whatever its release or arch folder.
+    sync_metrics.enter('store')
+    added_debs = debs_to_copy - removed_debs
+    store.add_files(app.store_dir, dest_dir, {d: stanzas[d] for d in added_debs if d in stanzas})
+    logging.info(f"{len(added_debs)} packages added to apt-lan cache. {len(removed_debs)} were removed.")
+
+    # Rebuild Packages.gz file.
+    sync_metrics.enter('index')
+    return rebuild_index(app, dest_dir, stanzas=stanzas)
+
+def place_debs(app, debs_to_copy, dest_dir, dest_bytes_free, bucket=None, sync_metrics=None):
+    """
+    Place debs from the system's APT archive in dest_dir if there's room.
+    """
     copy_bytes = 0
     for deb in debs_to_copy:
         file = Path(app.deb_archives.get('system') / deb)
@@ -71,11 +248,16 @@ def run_server_sync(app):
         copy_bytes += deb_bytes
     copy_size_human = utils.convert_bytes_to_human(copy_bytes)
 
+    # Hardlink or reflink debs if possible so that only metadata is written.
+    sample = app.deb_archives.get('system') / next(iter(debs_to_copy))
+    strategy = placement.probe_strategy(sample, dest_dir)
+    bytes_needed = placement.get_bytes_needed(strategy, copy_bytes)
+
     # Ensure free space at destination.
     ch = copy_size_human
-    dh = dest_free_human
+    dh = utils.convert_bytes_to_human(dest_bytes_free)
     # Ensure at least 100 MB of space left after copy.
-    if dest_bytes_free - 100000000 < copy_bytes:
+    if dest_bytes_free - 100000000 < bytes_needed:
         logging.error(f"{ch.get('Number'):5.1f} {ch.get('Unit')} to copy, but only {dh.get('Number'):5.1f} {dh.get('Unit')} available in {dest_dir}")
         return 1
 
@@ -84,98 +266,82 @@ def run_server_sync(app):
     s = 's'
     if ct == 1:
         s = ''
-    logging.info(f"Copying {ct} package{s}, {ch.get('Number'):5.1f} {ch.get('Unit')}, to {dest_dir}")
+    logging.info(f"Placing {ct} package{s}, {ch.get('Number'):5.1f} {ch.get('Unit')}, in {dest_dir} by {strategy}")
 
-    # Copy debs.
-    debs_copied = []
+    # Place debs.
+    strategies_used = {}
     for deb in debs_to_copy:
-        if deb not in dest_debs:
-            src_file = app.deb_archives.get('system') / deb
-            copied = shutil.copy(src_file, dest_dir)
-            debs_copied.append(copied)
-    os.sync()
-
-    # Delay the script if another sync is in progress.
-    old_pkgs_gz = dest_dir / 'Packages.gz.old'
-    utils.delay_if_other_sync_in_progress(old_pkgs_gz)
-    # Rename Packages.gz file (if it exists) during file changes.
-    pkgs_gz = dest_dir / 'Packages.gz'
-    if pkgs_gz.is_file():
-        pkgs_gz.rename(old_pkgs_gz)
-
-    # Prepare to gather package lists.
-    kept_debs = []                                                  # newest
-    dest_debs = pkgs.ensure_destination(dest_dir).get('Packages')   # existing in destination
-
-    # List amd64 packages to keep.
-    logging.info("Listing amd64 packages to be kept...")
-    cmd = ['dpkg-scanpackages', '--arch', 'amd64', dest_dir]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
-    output = result.stdout.splitlines()
-    logging.info(f"{len(output)} amd64 packages found.")
-    for line in output:
-        if 'Filename: ' in line:
-            deb = line.split(':')[1].strip().split('/')[-1]
-            kept_debs.append(deb)
-            logging.debug(f"{deb} added to list of kept packages.")
-
-    # List i386 packages to keep.
-    logging.info("Listing i386 packages to be kept...")
-    cmd = ['dpkg-scanpackages', '--arch', 'i386', dest_dir]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
-    output = result.stdout.splitlines()
-    logging.info(f"{len(output)} i386 packages found.")
-    # Add scanned packages to kept_debs list.
-    for line in output:
-        if 'Filename: ' in line:
-            deb = line.split(':')[1].strip().split('/')[-1]
-            kept_debs.append(deb)
-            logging.debug(f"{deb} added to list of kept packages.")
-
-    # Remove non-kept packages.
-    removed_debs = []
-    kept_debs = list(set(kept_debs))
-    kept_debs.sort()
-    logging.debug(f"All kept packages: {', '.join(kept_debs)}")
-    for deb in dest_debs:
-        if deb not in kept_debs:
-            superseded_debs.append(deb)
-            removed_debs.append(deb)
-            file = dest_dir / deb
-            file.unlink()
-            logging.debug(f"{file} removed from LAN cache.")
-    superseded_debs.sort()
-
-    # Update superseded_debs_file.
-    with open(superseded_debs_file, 'w') as f:
-        for deb in superseded_debs:
-            f.write(f"{deb}\n")
-    logging.debug(f"Superseded packages file: {superseded_debs_file}.")
-    logging.info(f"{len(kept_debs)} packages in apt-lan cache. {len(superseded_debs)} others are listed as obsolete. {len(removed_debs)} were removed.")
-
-    # Rebuild Packages.gz file.
-    pkgs.rebuild_pkgs_gz(dest_dir, pkgs_gz, old_pkgs_gz)
-
-    logging.info("System packages sync complete.\n")
+        src_file = app.deb_archives.get('system') / deb
+        used = placement.place_file(src_file, dest_dir, strategy)
+        strategies_used[used] = strategies_used.get(used, 0) + 1
+        if used == 'copy' and bucket:
+            # Only full copies load the disk.
+            bucket.consume(src_file.stat().st_size)
+    placement.sync_dir(dest_dir)
+    if sync_metrics:
+        sync_metrics.count('debs_placed', ct)
+        sync_metrics.count('bytes_placed', copy_bytes)
+    logging.info(f"Packages placed: {', '.join(f'{v} by {k}' for k, v in sorted(strategies_used.items()))}")
     return 0
 
+def rebuild_index(app, dest_dir, stanzas=None, cache_file=None):
+    """
+    Rebuild dest_dir's Packages indexes in the configured formats.
+    """
+    formats = utils.get_config_value(app.config, 'system', 'index_formats', 'gz')
+    return index.rebuild_pkgs_gz(
+        dest_dir,
+        stanzas=stanzas,
+        cache_file=cache_file,
+        formats=[f.strip() for f in formats.split(',') if f.strip()],
+        level=utils.get_config_value(app.config, 'system', 'index_level', 6),
+    )
+
+def list_sync_targets(app):
+    """
+    List the "<release>/<arch folder>" LAN archive folders to sync, starting
+    with this system's own. Releases come from the configured repositories
+    that APT has lists for, and arch folders from dpkg's native and foreign
+    architectures.
+    """
+    targets = [f"{app.os_rel}/{app.arch_d}"]
+    arches = pkgs.get_dpkg_arches()
+    releases = pkgs.list_repo_releases(app.config.get('repositories'), arches)
+    arch_ds = [utils.get_arch_dir_name(a) for a in arches]
+    for release in [app.os_rel] + releases:
+        for arch_d in [app.arch_d] + arch_ds:
+            target = f"{release}/{arch_d}"
+            if target not in targets:
+                targets.append(target)
+    return targets
+
 def run_client_sync(app):
     # Outline:
     #   - Find LAN sources. (assumes IPv4 for now)
     #   - Sync their packages locally.
-    #       - only same release and arch
-    #   - Rebuild local Packages.gz
-
-    # Ensure that share folder exists.
-    dest_dir = app.deb_archives.get('lan')
-    dest_dir.mkdir(parents=True, exist_ok=True)
-
-    # Get current packages list.
-    local_debs = pkgs.list_archive_debs(dest_dir)
-
-    # Define Packages.gz file names.
-    pkgs_gz = dest_dir / 'Packages.gz'
-    old_pkgs_gz = dest_dir / 'Packages.gz.old'
+    #       - every configured release and dpkg arch, over one session per peer
+    #   - Rebuild local Packages.gz files
+
+    sync_metrics = app.metrics or metrics.SyncMetrics('client')
+
+    # Ensure that share folders exist and get current packages lists.
+    sync_metrics.enter('list')
+    archives = {}
+    for target in list_sync_targets(app):
+        dest_dir = app.share_path / target
+        if target == f"{app.os_rel}/{app.arch_d}":
+            # Other folders are only created once peers have debs for them.
+            dest_dir.mkdir(parents=True, exist_ok=True)
+        archives[target] = {
+            'dir': dest_dir,
+            'debs': pkgs.list_archive_debs(dest_dir),
+            'pkgs_gz': dest_dir / 'Packages.gz',
+        }
+    logging.info(f"Syncing LAN archive folders: {', '.join(archives)}")
+
+    # Keep the sync from slowing down the system's users.
+    policy = throttle.get_policy(app.config, 'network')
+    throttle.apply_priority(policy)
 
     # Get LAN IP and subnet.
     own_ip, netmask = client.get_network_info()
@@ -184,72 +350,317 @@ def run_client_sync(app):
         return 1
 
     # Loop through LAN IPs and copy debs from each one.
-    #   - List LAN IPs with correct port open.
-    share_ips = client.get_share_ips(own_ip, netmask, app.ports)
-    logging.info(f"{len(share_ips)} LAN share IPs found.")
-    logging.debug(f"LAN share IPs: {share_ips}")
-    superseded_debs_file = dest_dir / 'superseded.txt'
-    superseded_debs_file.touch(exist_ok=True)
-    superseded_debs_own = pkgs.get_superseded_debs(superseded_debs_file)
-    logging.debug(f"{len(superseded_debs_own)} superseded packages already identified.")
-    for ip in share_ips:
-        # TODO: Fix to get debs from any release listed in app.config.repositories.
-        #   Currently only gets debs matching system OS release.
-        share_uri = f"rsync://{ip}/apt-lan/{app.os_rel}/{app.arch_d}"
-        # Get file list from IP address.
-        ip_files = client.get_files_from_share(share_uri, app.ports[0])
-        logging.info(f"{len(ip_files)} files found at {ip} for {app.os_rel}/{app.arch_d}.")
-
-        # Skip this server if another sync is in progress there.
-        if 'Packages.gz.old' in ip_files:
-            logging.info(f"Another sync is in progress at {ip}. Skipping.")
-            return 1
-        # Update superseded_debs list from LAN share.
-        superseded_debs_ip = []
-        if 'superseded.txt' in ip_files[:]:
-            # Use tempdir because file will be downloaded to CWD.
-            with Path(tempfile.mkdtemp()) as tempdir:
-                client.get_files_from_share(share_uri, app.ports[0], ["superseded.txt"], tempdir)
-                new_superseded = tempdir / 'superseded.txt'
-                superseded_debs_ip = pkgs.get_superseded_debs(new_superseded)
-            ip_files.remove('superseded.txt')
-        for s in superseded_debs_ip:
-            if s not in superseded_debs_own:
-                superseded_debs_own.append(s)
-        superseded_debs_own.sort()
-
-        # Update superseded_debs_file.
-        with open(superseded_debs_file, 'w') as f:
-            for deb in superseded_debs_own:
-                f.write(f"{deb}\n")
-        logging.debug(f"Superseded packages file: {superseded_debs_file}.")
-
-        # Rename Packages.gz file (if it exists) during file changes.
-        if pkgs_gz.is_file():
-            pkgs_gz.rename(old_pkgs_gz)
-
-        # Get new packages from LAN share.
-        debs_to_get = [d for d in ip_files if d[-4:] == '.deb' and d not in local_debs and d not in superseded_debs_own]
-        logging.info(f"{len(debs_to_get)} packages to get from {ip}.")
-        if len(debs_to_get) == 0:
-            # Already up-to-date. Nothing more to do.
-            logging.info(f'LAN packages already synced from {ip}.\n')
-            return 0
-        logging.debug(f"Packages to get from {ip}: {debs_to_get}")
-        client.get_files_from_share(share_uri, app.ports[0], debs_to_get, dest_dir)
-
-        # Rebuild Packages.gz file.
-        pkgs.rebuild_pkgs_gz(dest_dir, pkgs_gz, old_pkgs_gz)
-
-    # Ensure correct Packages.gz file.
-    final_debs = pkgs.list_archive_debs(dest_dir)
-    if final_debs != local_debs or not pkgs_gz.is_file():
-        # Rebuild Packages.gz file.
-        #   TODO: This rebuilds it unnecessarily if any packages were added above.
-        #       But the point is to make sure the folder ends in an accurate
-        #       state, regardless of how successful the sync was. Ideally, I
-        #       would just confirm that Packages.gz matches the file list.
-        pkgs.rebuild_pkgs_gz(dest_dir, pkgs_gz, old_pkgs_gz)
+    #   - LAN IPs with correct port open are handled as soon as they're found.
+    #   - Peers announcing themselves with beacons are used first, then known
+    #     peers from earlier syncs. The LAN is only scanned as a fallback.
+    sync_metrics.enter('discovery')
+    beacon_ips = None
+    synced_ips = []
+    beacons = None
+    beacon_wait = utils.get_config_value(app.config, 'network', 'beacon_wait', 2.0)
+    if app.beacons is not None:
+        # The daemon has been collecting beacons all along.
+        beacon_age = 3 * utils.get_config_value(app.config, 'system', 'beacon_interval', 60)
+        beacons = {ip: b for ip, b in app.beacons.items() if time.time() - b.get('seen', 0) < beacon_age}
+    elif beacon_wait > 0:
+        beacons = beacon.listen_for_beacons(beacon_wait, own_ip)
+    in_sync = {}
+    if beacons:
+        beacon_ips = set()
+        for target, archive in archives.items():
+            release, arch_d = target.split('/')
+            own_digest = beacon.get_file_digest(archive.get('pkgs_gz'))
+            new_ips, same_ips = beacon.select_beacon_ips(
+                beacons, release, arch_d, app.ports[0], own_digest
+            )
+            beacon_ips.update(new_ips)
+            for ip in same_ips:
+                in_sync.setdefault(ip, set()).add(target)
+        # Beacons only describe a peer's own folder; it may have others, so
+        #   in-sync peers are only skipped for the folder their beacon matches.
+        synced_ips = sorted(ip for ip, targets in in_sync.items() if len(targets) == len(archives))
+        beacon_ips.update(ip for ip in in_sync if ip not in synced_ips)
+        beacon_ips = sorted(beacon_ips)
+        logging.info(f"{len(in_sync)} beaconing LAN peers already in sync for their own folder.")
+    peer_cache = app.peer_cache or peers.PeerCache(app.state_dir / 'peers.json').load()
+    max_age = utils.get_config_value(app.config, 'network', 'peer_max_age', 7)
+    peer_cache.expire(max_age * 86400)
+    for mirror_dir in (app.state_dir / 'peers').glob('*'):
+        if mirror_dir.name not in peer_cache.peers:
+            # Forget files mirrored from expired peers.
+            shutil.rmtree(str(mirror_dir))
+    sweep_interval = utils.get_config_value(app.config, 'network', 'sweep_interval', 24)
+    share_ips = peers.iter_peers(
+        peer_cache,
+        own_ip,
+        netmask,
+        app.ports,
+        workers=utils.get_config_value(app.config, 'network', 'scan_workers', 64),
+        timeout=utils.get_config_value(app.config, 'network', 'scan_timeout', 10),
+        sweep_interval=sweep_interval * 3600,
+        beacon_ips=beacon_ips,
+        synced_ips=synced_ips,
+    )
+    try:
+        ret = sync_from_peers(app, share_ips, peer_cache, archives, throttle.get_bucket(policy), sync_metrics, in_sync)
+    finally:
+        peer_cache.save()
+    if ret != 0:
+        return ret
+
+    # Ensure correct Packages.gz files.
+    sync_metrics.enter('index')
+    for target, archive in archives.items():
+        dest_dir = archive.get('dir')
+        pkgs_gz = archive.get('pkgs_gz')
+        index_cache = utils.get_index_cache_file(app, dest_dir)
+        final_debs = pkgs.list_archive_debs(dest_dir)
+        if final_debs == archive.get('debs') and pkgs_gz.is_file():
+            continue
+        if not final_debs and target != f"{app.os_rel}/{app.arch_d}":
+            # Nothing found for this other release or arch.
+            continue
+        # Rebuild Packages.gz file once, after all peers are done.
+        rebuild_index(app, dest_dir, cache_file=index_cache)
+
+        # Store each distinct deb once, whatever its release or arch folder.
+        stanzas = index.scan_debs(dest_dir, cache_file=index_cache)
+        store.add_files(app.store_dir, dest_dir, stanzas)
+    store.report(app.store_dir, app.share_path)
 
     logging.info("LAN packages sync complete.\n")
     return 0
+
+def get_peer_listing(app, ip, targets, since):
+    """
+    Get the manifest generation, package fields and new superseded entries of
+    each target folder from a LAN peer, in a single rsync session. The peer's
+    files are mirrored in the state folder so that rsync skips unchanged ones
+    and only transfers what was appended to superseded.log since the last
+    sync. Each fetch goes into a fresh folder with unchanged files linked from
+    the mirror, so files the peer no longer has are never mistaken for its
+    current ones. Packages.gz and superseded.txt are only fetched from peers
+    that don't publish manifests.
+    Files mirrored for folders that aren't fetched this time are kept.
+    Returns {target: (generation, debs, superseded entries)}, where entries
+    are (generation, deb name) newer than since[target], or None on failure.
+    """
+    share_uri = f"rsync://{ip}/apt-lan"
+    mirror_dir = app.state_dir / 'peers' / ip
+    new_dir = mirror_dir.with_name(f".{ip}.new")
+    if new_dir.exists():
+        shutil.rmtree(str(new_dir))
+    new_dir.mkdir(parents=True)
+    try:
+        listing = fetch_peer_listing(app, share_uri, targets, since, mirror_dir, new_dir)
+        if listing is None:
+            return None
+        for old in mirror_dir.glob('*/*'):
+            target = f"{old.parent.name}/{old.name}"
+            if target not in targets:
+                (new_dir / target).parent.mkdir(parents=True, exist_ok=True)
+                old.rename(new_dir / target)
+        if mirror_dir.exists():
+            shutil.rmtree(str(mirror_dir))
+        new_dir.rename(mirror_dir)
+    finally:
+        if new_dir.exists():
+            shutil.rmtree(str(new_dir))
+    return listing
+
+def fetch_peer_listing(app, share_uri, targets, since, mirror_dir, new_dir):
+    """
+    Fetch the files for get_peer_listing() into new_dir, linking those that
+    are unchanged from mirror_dir, and read them.
+    """
+    names = []
+    since = dict(since)
+    for target in targets:
+        if not (mirror_dir / target / superseded.LOG_NAME).is_file():
+            since[target] = 0
+        names.extend([f"{target}/{manifest.MANIFEST_NAME}", f"{target}/{superseded.LOG_NAME}"])
+    r = client.fetch_share_files(share_uri, app.ports[0], names, new_dir, link_dest=mirror_dir)
+    if r is None:
+        return None
+    listing = {}
+    no_manifest = []
+    for target in targets:
+        generation, debs = manifest.read_manifest(new_dir / target / manifest.MANIFEST_NAME)
+        log = new_dir / target / superseded.LOG_NAME
+        entries = list(superseded.read_entries(log, since.get(target, 0)))
+        listing[target] = (generation, debs or {}, entries)
+        if debs is None and not log.is_file():
+            no_manifest.append(target)
+
+    # Fall back to Packages.gz and superseded.txt for peers running older versions.
+    if no_manifest:
+        names = [f"{t}/{n}" for t in no_manifest for n in ['Packages.gz', superseded.LEGACY_NAME]]
+        r = client.fetch_share_files(share_uri, app.ports[0], names, new_dir, link_dest=mirror_dir)
+        if r is None:
+            return None
+        for target in no_manifest:
+            pkgs_gz = new_dir / target / 'Packages.gz'
+            if not pkgs_gz.is_file():
+                continue
+            superseded_debs_ip = pkgs.get_superseded_debs(new_dir / target / superseded.LEGACY_NAME)
+            entries = [(0, d) for d in superseded_debs_ip]
+            listing[target] = (0, index.read_packages_gz(pkgs_gz), entries)
+    return listing
+
+def sync_from_peers(app, share_ips, peer_cache, archives, bucket=None, sync_metrics=None, in_sync=None):
+    """
+    Get new debs for the archive folders from peers. in_sync is {ip: targets}
+    of folders that peers' beacons show are already the same as ours.
+    """
+    sync_metrics = sync_metrics or metrics.SyncMetrics('client')
+    in_sync = in_sync or {}
+    for archive in archives.values():
+        archive['superseded'] = superseded.SupersededLog(archive.get('dir')).load()
+        archive['linked'] = pkgs.DebSet()
+        logging.debug(f"{len(archive.get('superseded'))} superseded packages already identified in {archive.get('dir')}.")
+    parallel = utils.get_config_value(app.config, 'network', 'parallel_peers', 4)
+
+    # Get file listings for all folders from peers as they are found. Peers are
+    #   found while their listings are fetched, so both are timed as "peers".
+    sync_metrics.enter('peers')
+    listings = {}
+    generations = {}
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = {}
+        for ip in share_ips:
+            logging.info(f"LAN share IP found: {ip}")
+            targets = [t for t in archives if t not in in_sync.get(ip, ())]
+            if not targets:
+                continue
+            since = {t: peer_cache.get_generation(ip, f"{t}/{superseded.LOG_NAME}") for t in targets}
+            futures[executor.submit(get_peer_listing, app, ip, targets, since)] = ip
+        for future in as_completed(futures):
+            ip = futures[future]
+            listing = future.result()
+            if listing is None:
+                peer_cache.record_failure(ip)
+                continue
+            sync_metrics.count('peers_found')
+            pkg_count = 0
+            for target, (generation, ip_stanzas, entries) in listing.items():
+                if entries:
+                    # Merge only superseded entries not seen before from this peer.
+                    archives[target]['superseded'].append(d for g, d in entries)
+                    last_generation = max(g for g, d in entries)
+                    if last_generation:
+                        peer_cache.record_generation(ip, f"{target}/{superseded.LOG_NAME}", last_generation)
+                if not ip_stanzas:
+                    continue
+                pkg_count += len(ip_stanzas)
+                if generation and generation == peer_cache.get_generation(ip, f"{target}/{manifest.MANIFEST_NAME}"):
+                    logging.info(f"{ip} unchanged for {target} since last sync; generation {generation}.")
+                    continue
+                logging.info(f"{len(ip_stanzas)} packages found at {ip} for {target}.")
+                listings.setdefault(ip, {})[target] = ip_stanzas
+                generations[(ip, f"{target}/{manifest.MANIFEST_NAME}")] = generation
+            peer_cache.record_seen(ip, pkg_count=pkg_count)
+            if not pkg_count:
+                logging.info(f"No package index at {ip}. Skipping.")
+
+    # Link wanted debs that are already stored locally under another path.
+    sync_metrics.enter('link')
+    def list_wanted(target, ip_stanzas):
+        archive = archives[target]
+        return archive.get('superseded').exclude(pkgs.DebSet(ip_stanzas) - archive.get('debs') - archive.get('linked'))
+    linked_bytes = 0
+    linked_count = 0
+    for ip_listing in listings.values():
+        for target, ip_stanzas in ip_listing.items():
+            for deb in list_wanted(target, ip_stanzas):
+                fields = ip_stanzas[deb]
+                if store.link_from_store(app.store_dir, fields.get('SHA256'), archives[target]['dir'] / deb):
+                    archives[target]['linked'].add(deb)
+                    linked_bytes += int(fields.get('Size', 0))
+                    linked_count += 1
+    sync_metrics.count('debs_linked', linked_count)
+    sync_metrics.count('bytes_linked', linked_bytes)
+    if linked_count:
+        logging.info(f"{linked_count} packages, {linked_bytes} B, linked from package store instead of downloaded.")
+        store.record_bandwidth_saved(app.store_dir, linked_bytes)
+
+    # Get new packages from all LAN shares, spreading them across peers.
+    sync_metrics.enter('download')
+    #   Debs are named by their path in the share so that each peer's debs
+    #   for every folder come over a single session.
+    wanted = {}
+    for ip, ip_listing in listings.items():
+        wanted[ip] = {}
+        for target, ip_stanzas in ip_listing.items():
+            for deb in list_wanted(target, ip_stanzas):
+                wanted[ip][f"{target}/{deb}"] = int(ip_stanzas[deb].get('Size', 0))
+    latencies = {ip: peer_cache.peers.get(ip, {}).get('latency') for ip in wanted}
+    plan = downloads.plan_downloads(wanted, latencies)
+    debs_to_get = sum(len(debs) for debs in plan.values())
+    logging.info(f"{debs_to_get} packages to get from {len(plan)} LAN peers.")
+    if debs_to_get == 0:
+        # Already up-to-date. Nothing more to do.
+        record_generations(peer_cache, generations)
+        logging.info('LAN packages already synced.')
+        return 0
+
+    def count_fetched(ip, transferred):
+        if transferred is not None:
+            sync_metrics.count('debs_downloaded', len(transferred), peer=ip)
+            sync_metrics.count('bytes_downloaded', sum(transferred.values()), peer=ip)
+        return transferred
+    def fetch(ip, debs):
+        logging.info(f"{len(debs)} packages to get from {ip}.")
+        logging.debug(f"Packages to get from {ip}: {', '.join(debs)}")
+        share_uri = f"rsync://{ip}/apt-lan"
+        def fetch_chunk(chunk, bwlimit=0):
+            return count_fetched(ip, client.fetch_share_files(share_uri, app.ports[0], chunk, app.share_path, bwlimit))
+        if not bucket:
+            return fetch_chunk(list(debs))
+        # rsync's --bwlimit does the limiting; concurrent peers split the rate.
+        return throttle.fetch_limited(fetch_chunk, debs, wanted[ip], bucket)
+    if bucket:
+        bucket.plan_transfers(len(plan), parallel)
+    results = downloads.run_downloads(plan, fetch, parallel)
+
+    # Remember peer generations only if all planned debs were received, since
+    #   debs planned from one peer may also be offered by others.
+    failed = [ip for ip, debs in plan.items() if results.get(ip) is None or len(results.get(ip)) < len(debs)]
+    if failed:
+        logging.warning(f"Not all packages were received from: {', '.join(failed)}")
+    else:
+        record_generations(peer_cache, generations)
+    return 0
+
+def record_generations(peer_cache, generations):
+    for (ip, name), generation in generations.items():
+        if generation:
+            peer_cache.record_generation(ip, name, generation)
+
+def run_announcer(app):
+    interval = utils.get_config_value(app.config, 'system', 'beacon_interval', 60)
+    if interval <= 0:
+        logging.info("Beacons are disabled in config.")
+        return 0
+    try:
+        beacon.run_announcer(app, interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def run_verify_index(app):
+    """
+    Check that the cached package stanzas and Packages.gz match a full rescan.
+    """
+    dest_dir = app.deb_archives.get('lan')
+    index_cache = utils.get_index_cache_file(app, dest_dir)
+    logging.info(f"Verifying {index_cache} against a full rescan of {dest_dir}...")
+    problems = index.verify_stanza_cache(dest_dir, index_cache)
+    for problem in problems:
+        logging.error(problem)
+        print(problem)
+    if problems:
+        print(f"{len(problems)} problems found in package index of {dest_dir}.")
+        return 1
+    logging.info("Package index verified.")
+    print(f"Package index of {dest_dir} verified.")
+    return 0
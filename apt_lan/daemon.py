@@ -0,0 +1,197 @@
+''' Functions related to running apt-lan as a long-running service '''
+
+import logging
+import select
+import signal
+import time
+
+from apt_lan import beacon, cmd, lock, metrics, peers, utils, watch
+
+
+FREQUENCIES = {
+    'hourly': 3600,
+    'daily': 86400,
+    'weekly': 604800,
+    'monthly': 2592000,
+    'never': 0,
+}
+# Debs removed from the APT archive are kept in the LAN archive.
+ARCHIVE_EVENTS = watch.IN_CLOSE_WRITE | watch.IN_MOVED_TO
+LISTS_EVENTS = watch.IN_CLOSE_WRITE | watch.IN_MOVED_TO
+LISTS_DIR = '/var/lib/apt/lists'
+
+
+def get_interval(config, section, default):
+    """
+    Get seconds between periodic syncs from a section's frequency.
+    """
+    freq = utils.get_config_value(config, section, 'frequency', default)
+    if freq not in FREQUENCIES:
+        freq = default
+    return FREQUENCIES.get(freq)
+
+def stop(signum, frame):
+    raise SystemExit(0)
+
+
+class Daemon():
+    """
+    Run syncs when something changes instead of on a fixed schedule:
+        - server sync of just the new debs when they're added to the APT
+          archive ("changes")
+        - full server sync when "apt update" replaces package lists
+        - client sync when a peer's beacon shows that its packages changed
+    Changes are allowed to settle before syncing so that a burst of them
+    leads to a single sync. Full syncs also still run at their configured
+    frequency in case an event was missed. Config, peer state and beacons
+    are kept in memory between syncs. With client=False only the server
+    side is kept up to date.
+    """
+    def __init__(self, app, client=True):
+        self.app = app
+        self.client = client
+        self.due = {}
+        self.changed = set()
+        self.digests = {}
+        self.next_beacon = 0
+        self.reload = False
+
+    def load_config(self):
+        self.app.config = utils.get_config(self.app)
+        config = self.app.config
+        self.settle = utils.get_config_value(config, 'system', 'settle_time', 60)
+        self.beacon_interval = utils.get_config_value(config, 'system', 'beacon_interval', 60)
+        self.intervals = {
+            'server': get_interval(config, 'system', 'daily'),
+            'client': get_interval(config, 'network', 'hourly') if self.client else 0,
+        }
+        logging.debug(f"Daemon settle time: {self.settle} s; sync intervals: {self.intervals}")
+
+    def request_reload(self, signum, frame):
+        self.reload = True
+
+    def schedule(self, name, delay):
+        """
+        Make sync "name" due in "delay" seconds unless it's due sooner.
+        """
+        due = time.time() + delay
+        if due < self.due.get(name, due + 1):
+            self.due[name] = due
+            logging.debug(f"{name} sync due in {delay} s.")
+
+    def run_due(self):
+        for name in ['server', 'changes', 'client']:
+            if self.due.get(name, time.time() + 1) > time.time():
+                continue
+            del self.due[name]
+            try:
+                if name == 'server':
+                    logging.info(f"Starting server packages sync from system.")
+                    # A full sync covers any changed debs too.
+                    self.changed.clear()
+                    self.due.pop('changes', None)
+                    lock.run_locked(self.app, metrics.run_measured, 'server', cmd.run_server_sync)
+                elif name == 'changes':
+                    names = sorted(self.changed)
+                    self.changed.clear()
+                    logging.info(f"Starting server packages sync of {len(names)} changed packages.")
+                    lock.run_locked(self.app, metrics.run_measured, 'changes', cmd.run_server_changes_sync, names)
+                else:
+                    logging.info(f"Starting client packages sync from LAN.")
+                    lock.run_locked(self.app, metrics.run_measured, 'client', cmd.run_client_sync)
+            except Exception:
+                logging.exception(f"{name} sync failed.")
+            if self.intervals.get(name):
+                self.schedule(name, self.intervals.get(name))
+            # Tell peers about any changes right away.
+            self.next_beacon = 0
+
+    def handle_watch_events(self, watcher):
+        archives_dir = self.app.deb_archives.get('system')
+        for folder, name, mask in watcher.read_events():
+            if mask & watch.IN_Q_OVERFLOW:
+                # Changed debs may have been missed; a full sync finds them.
+                logging.warning("inotify queue overflowed; scheduling a full server sync.")
+                self.schedule('server', self.settle)
+            elif folder == archives_dir and name.endswith('.deb'):
+                logging.debug(f"APT archive changed: {name}")
+                self.changed.add(name)
+                self.schedule('changes', self.settle)
+            elif str(folder) == LISTS_DIR and '_Packages' in name:
+                logging.debug(f"APT package list updated: {name}")
+                self.schedule('server', self.settle)
+
+    def handle_message(self, sock):
+        data, addr = sock.recvfrom(4096)
+        message = beacon.decode_message(data)
+        if not message:
+            return
+        if message.get('query'):
+            self.next_beacon = 0
+            return
+        ip = addr[0]
+        if message.get('host') == self.app.hostname:
+            return
+        message['seen'] = time.time()
+        self.app.beacons[ip] = message
+        if self.digests.get(ip) != message.get('digest'):
+            logging.info(f"Packages changed at {ip}.")
+            self.digests[ip] = message.get('digest')
+            if message.get('count') and self.client:
+                self.schedule('client', self.settle)
+
+    def open_watcher(self):
+        try:
+            watcher = watch.Watcher()
+            watcher.add(self.app.deb_archives.get('system'), ARCHIVE_EVENTS)
+            watcher.add(LISTS_DIR, LISTS_EVENTS)
+        except OSError as e:
+            logging.warning(f"Unable to watch APT folders; only syncing periodically: {e}")
+            return None
+        return watcher
+
+    def run(self):
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.load_config()
+        self.app.peer_cache = peers.PeerCache(self.app.state_dir / 'peers.json').load()
+        self.app.beacons = {}
+        watcher = self.open_watcher()
+        sock = beacon.open_socket()
+        sources = [sock] + ([watcher] if watcher else [])
+        # Catch up on anything that changed while the daemon wasn't running.
+        self.schedule('server', self.settle)
+        if self.client:
+            self.schedule('client', self.settle)
+        try:
+            while True:
+                if self.reload:
+                    logging.info("Reloading config.")
+                    self.reload = False
+                    self.load_config()
+                now = time.time()
+                if self.beacon_interval > 0 and now >= self.next_beacon:
+                    beacon.send_message(sock, beacon.build_beacon(self.app))
+                    self.next_beacon = now + self.beacon_interval
+                waits = [due - now for due in self.due.values()]
+                if self.beacon_interval > 0:
+                    waits.append(self.next_beacon - now)
+                timeout = max(0, min(waits)) if waits else 60
+                ready, _, _ = select.select(sources, [], [], timeout)
+                if sock in ready:
+                    self.handle_message(sock)
+                if watcher and watcher in ready:
+                    self.handle_watch_events(watcher)
+                self.run_due()
+        except (KeyboardInterrupt, SystemExit):
+            logging.info("Stopping apt-lan daemon.")
+        finally:
+            sock.close()
+            if watcher:
+                watcher.close()
+            self.app.peer_cache.save()
+        return 0
+
+
+def run_daemon(app, client=True):
+    return Daemon(app, client).run()
@@ -0,0 +1,65 @@
+''' Functions related to scheduling package downloads from LAN peers '''
+
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from apt_lan import pkgs
+
+
+# Assumed cost of each file transfer, regardless of size.
+FILE_OVERHEAD_BYTES = 65536
+
+
+def plan_downloads(listings, latencies=None):
+    """
+    Assign each wanted deb to one of the peers that has it.
+
+    listings:   {ip: {deb name: size}} of debs wanted from each peer
+    latencies:  {ip: seconds} of peers' last probe durations
+    Returns {ip: DebSet} with each deb listed under a single peer.
+
+    Debs are assigned largest first to the peer that would then have the least
+    data to send, weighted so that a peer with 10 ms latency counts its load
+    double, which keeps any single peer from becoming the bottleneck.
+    """
+    latencies = latencies or {}
+    sizes = {}
+    for ip, files in listings.items():
+        for deb, size in files.items():
+            sizes[deb] = max(size, sizes.get(deb, 0))
+
+    load = {ip: 0 for ip in listings}
+    plan = {ip: pkgs.DebSet() for ip in listings}
+    def cost(ip, size):
+        weight = 1 + (latencies.get(ip) or 0) * 100
+        return ((load[ip] + size + FILE_OVERHEAD_BYTES) * weight, ip)
+
+    for deb in sorted(sizes, key=lambda d: (-sizes[d], d)):
+        size = sizes[deb]
+        holders = [ip for ip, files in listings.items() if deb in files]
+        ip = min(holders, key=lambda i: cost(i, size))
+        plan[ip].add(deb)
+        load[ip] += size + FILE_OVERHEAD_BYTES
+    for ip in listings:
+        logging.debug(f"Planned {len(plan[ip])} packages, {load[ip]} bytes, from {ip}.")
+    return {ip: debs for ip, debs in plan.items() if debs}
+
+def run_downloads(plan, fetch, parallel=4):
+    """
+    Call fetch(ip, debs) for each peer in plan, with at most "parallel" peers
+    being fetched from at once. Returns {ip: fetch result}.
+    """
+    results = {}
+    if not plan:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = {executor.submit(fetch, ip, debs): ip for ip, debs in plan.items()}
+        for future in as_completed(futures):
+            ip = futures[future]
+            try:
+                results[ip] = future.result()
+            except Exception as e:
+                logging.error(f"Failed to get packages from {ip}: {e}")
+                results[ip] = None
+    return results
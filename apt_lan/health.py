@@ -0,0 +1,148 @@
+''' Functions related to checking that the LAN share is being served '''
+
+import json
+import logging
+import socket
+import subprocess
+import time
+
+from pathlib import Path
+
+from apt_lan import utils
+
+
+HEALTH_NAME = 'health.json'
+MODULE_NAME = 'apt-lan'
+# Protocol version sent to rsyncd; any daemon since rsync 3.0 accepts it.
+CLIENT_GREETING = b'@RSYNCD: 30.0\n'
+
+
+def probe_rsyncd(host, port, timeout=1.0):
+    """
+    Greet rsyncd and ask for its module list, without starting a transfer.
+    Returns {'listening': bool, 'version': str, 'modules': [names]}.
+    """
+    status = {'listening': False, 'version': '', 'modules': []}
+    try:
+        with socket.create_connection((host, port), timeout) as sock:
+            f = sock.makefile('rwb')
+            greeting = f.readline().decode(errors='replace').strip()
+            if not greeting.startswith('@RSYNCD: '):
+                status['error'] = f"unexpected greeting: {greeting[:40]}"
+                return status
+            status['listening'] = True
+            status['version'] = greeting.split()[1]
+            f.write(CLIENT_GREETING + b'#list\n')
+            f.flush()
+            for line in f:
+                line = line.decode(errors='replace').rstrip('\n')
+                if line.startswith('@RSYNCD: EXIT'):
+                    break
+                if line.startswith('@ERROR'):
+                    status['error'] = line
+                    break
+                # Modules are listed as "<name>\t<comment>"; other lines are
+                #   the daemon's motd.
+                if '\t' in line:
+                    status['modules'].append(line.split('\t')[0].strip())
+    except OSError as e:
+        status['error'] = str(e)
+    return status
+
+def check_tree(host, port, target):
+    """
+    Check that the apt-lan module serves target's Packages.gz.
+    """
+    cmd = [
+        'rsync',
+        f'--port={port}',
+        '--list-only',
+        f'rsync://{host}/{MODULE_NAME}/{target}/Packages.gz',
+    ]
+    try:
+        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning(f"Unable to list {target} from rsyncd: {e}")
+        return False
+    return r.returncode == 0
+
+def load_status(state_dir):
+    try:
+        return json.loads((Path(state_dir) / HEALTH_NAME).read_text())
+    except (OSError, ValueError):
+        return {}
+
+def save_status(state_dir, status):
+    utils.write_file_atomic(Path(state_dir) / HEALTH_NAME, json.dumps(status, indent=2) + '\n')
+
+def check_rsyncd(app, host='localhost'):
+    """
+    Check that rsyncd is listening, lists the apt-lan module and serves this
+    system's <release>/<arch> folder. The socket probe is cheap and runs every
+    time; the served folder is checked with rsync only when the last check
+    failed or is more than [system] health_interval seconds old.
+    The status is saved to the state folder for beacons and metrics.
+    """
+    port = app.ports[0]
+    target = f"{app.os_rel}/{app.arch_d}"
+    interval = utils.get_config_value(app.config, 'system', 'health_interval', 600)
+    cached = load_status(app.state_dir)
+    status = probe_rsyncd(host, port)
+    status.update({'checked': time.time(), 'port': port, 'target': target})
+    status['module'] = MODULE_NAME in status.get('modules')
+    if not status.get('module'):
+        status['serving'] = False
+    elif cached.get('serving') and cached.get('port') == port and cached.get('target') == target and time.time() - cached.get('tree_checked', 0) < interval:
+        status['serving'] = True
+        status['tree_checked'] = cached.get('tree_checked')
+    else:
+        status['serving'] = check_tree(host, port, target)
+        status['tree_checked'] = status.get('checked')
+    status['ready'] = status.get('serving')
+    save_status(app.state_dir, status)
+    write_textfile(app, status)
+    return status
+
+def format_prometheus(status):
+    lines = []
+    for name, help_text, value in [
+        ('up', "Whether apt-lan's rsyncd answers on its port.", status.get('listening')),
+        ('ready', "Whether apt-lan's rsyncd serves this system's package folder.", status.get('ready')),
+        ('last_check_timestamp_seconds', "Time of the last rsyncd health check.", round(status.get('checked', 0), 3)),
+    ]:
+        lines.append(f"# HELP apt_lan_rsyncd_{name} {help_text}")
+        lines.append(f"# TYPE apt_lan_rsyncd_{name} gauge")
+        lines.append(f'apt_lan_rsyncd_{name}{{port="{status.get("port")}"}} {int(value) if isinstance(value, bool) else value}')
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(app, status):
+    textfile_dir = utils.get_config_value(app.config, 'system', 'metrics_textfile_dir', '/var/lib/prometheus/node-exporter')
+    if not Path(textfile_dir).is_dir():
+        return
+    prom = Path(textfile_dir) / 'apt-lan-health.prom'
+    try:
+        utils.write_file_atomic(prom, format_prometheus(status))
+    except OSError as e:
+        logging.warning(f"Unable to write {prom}: {e}")
+
+def is_ready(state_dir):
+    """
+    Return the readiness of the last health check, or None if there wasn't
+    one.
+    """
+    return load_status(state_dir).get('ready')
+
+def run_health_check(app):
+    """
+    Print the rsyncd health status; return 0 if the share is ready.
+    """
+    app.config = utils.get_config(app)
+    status = check_rsyncd(app)
+    state = 'ready' if status.get('ready') else 'not ready'
+    print(f"rsyncd on port {status.get('port')}: {state}")
+    print(f"  listening: {status.get('listening')} (protocol {status.get('version') or '-'})")
+    print(f"  {MODULE_NAME} module: {status.get('module')}")
+    print(f"  serving {status.get('target')}: {status.get('serving')}")
+    if status.get('error'):
+        print(f"  error: {status.get('error')}")
+    return 0 if status.get('ready') else 1
@@ -0,0 +1,572 @@
+''' Functions related to building APT Packages indexes '''
+
+import gzip
+import hashlib
+import io
+import logging
+import lzma
+import os
+import subprocess
+import tarfile
+
+from collections import OrderedDict
+from contextlib import ExitStack
+from email.utils import formatdate
+from functools import cmp_to_key
+from pathlib import Path
+
+from apt_lan import manifest, pkgs, utils
+
+try:
+    import zstandard
+except ImportError:
+    # python3-zstandard is optional; dpkg-deb is used for zstd debs without it.
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    # python3-lz4 is optional; Packages.lz4 isn't written without it.
+    lz4 = None
+
+
+CHUNK_SIZE = 1048576
+# Bump when the format of the stanza cache changes.
+STANZA_CACHE_VERSION = 1
+# Compressed index formats in the order they're offered to APT. Packages.gz
+#   is always written because peers read it.
+INDEX_FORMATS = ['gz', 'xz', 'lz4']
+RELEASE_NAME = 'Release'
+# Indexes are also published under their hashes, so that APT never sees a
+#   Release file whose hashes don't match the indexes it fetches.
+BY_HASH_DIR = 'by-hash/SHA256'
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+# Field order used by dpkg-scanpackages; other fields follow in control order.
+FIELD_ORDER = [
+    'Package', 'Package-Type', 'Source', 'Version', 'Kernel-Version',
+    'Built-Using', 'Built-For-Profiles', 'Auto-Built-Package', 'Architecture',
+    'Subarchitecture', 'Installer-Menu-Item', 'Essential', 'Origin', 'Bugs',
+    'Maintainer', 'Installed-Size', 'Provides', 'Pre-Depends', 'Depends',
+    'Recommends', 'Suggests', 'Conflicts', 'Enhances', 'Breaks', 'Replaces',
+    'Filename', 'Size', 'MD5sum', 'SHA1', 'SHA256', 'Section', 'Priority',
+    'Multi-Arch', 'Homepage', 'Description', 'Tag', 'Task',
+]
+
+
+def find_control_member(head):
+    """
+    Find the control.tar.* member in the start of a deb's ar archive.
+    Returns (name, data), or None if more of the file is needed.
+    """
+    if len(head) < len(AR_MAGIC):
+        return None
+    if head[:len(AR_MAGIC)] != AR_MAGIC:
+        raise ValueError("not an ar archive")
+    pos = len(AR_MAGIC)
+    while len(head) >= pos + AR_HEADER_SIZE:
+        header = bytes(head[pos:pos + AR_HEADER_SIZE])
+        if header[58:60] != b'`\n':
+            raise ValueError("bad ar member header")
+        name = header[:16].decode().strip().rstrip('/')
+        size = int(header[48:58].decode().strip())
+        start = pos + AR_HEADER_SIZE
+        if name.startswith('control.tar'):
+            if len(head) < start + size:
+                return None
+            return name, bytes(head[start:start + size])
+        if name.startswith('data.tar'):
+            break
+        # Members are padded to even offsets.
+        pos = start + size + size % 2
+    else:
+        return None
+    raise ValueError("no control member")
+
+def extract_control_text(deb, name, data):
+    """
+    Get the text of the control file from a control.tar.* member.
+    """
+    if name.endswith('.zst'):
+        if not zstandard:
+            # Let dpkg-deb handle it.
+            r = subprocess.run(
+                ['dpkg-deb', '--info', str(deb), 'control'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+            return r.stdout.decode()
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        mode = 'r:'
+    elif name.endswith('.gz'):
+        mode = 'r:gz'
+    elif name.endswith('.xz'):
+        mode = 'r:xz'
+    else:
+        mode = 'r:'
+    with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+        for member in tar:
+            if member.name in ('./control', 'control'):
+                return tar.extractfile(member).read().decode()
+    raise ValueError("no control file")
+
+def parse_control(text):
+    """
+    Parse deb822 control text into an ordered dict of fields.
+    """
+    fields = OrderedDict()
+    key = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in ' \t' and key:
+            fields[key] += f"\n{line}"
+        else:
+            key, value = line.split(':', 1)
+            fields[key] = value.strip()
+    return fields
+
+def scan_deb(file, prefix=None):
+    """
+    Read a deb once, hashing it and extracting its control fields on the way.
+    Returns the deb's Packages stanza as an ordered dict.
+    """
+    file = Path(file)
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    size = 0
+    head = bytearray()
+    member = None
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            sha1.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+            if member is None:
+                head += chunk
+                member = find_control_member(head)
+                if member:
+                    head = None
+    if member is None:
+        raise ValueError("no control member")
+    control = parse_control(extract_control_text(file, *member))
+    if prefix is None:
+        prefix = file.parent
+    control['Filename'] = str(Path(prefix) / file.name)
+    control['Size'] = str(size)
+    control['MD5sum'] = md5.hexdigest()
+    control['SHA1'] = sha1.hexdigest()
+    control['SHA256'] = sha256.hexdigest()
+    return order_fields(control)
+
+def order_fields(fields):
+    known = [k for k in FIELD_ORDER if k in fields]
+    others = [k for k in fields if k not in FIELD_ORDER]
+    return OrderedDict((k, fields[k]) for k in known + others)
+
+def load_stanza_cache(cache_file):
+    return utils.load_cache(cache_file, {'version': STANZA_CACHE_VERSION, 'debs': {}})
+
+def list_deb_keys(dest_dir):
+    """
+    Return a dict of {deb name: (size, mtime)} for debs in dest_dir.
+    """
+    keys = {}
+    with os.scandir(str(dest_dir)) as entries:
+        for e in entries:
+            if e.name.endswith('.deb') and e.is_file():
+                st = e.stat()
+                keys[e.name] = (st.st_size, st.st_mtime_ns)
+    return keys
+
+def scan_debs(dest_dir, names=None, cache_file=None):
+    """
+    Scan debs in dest_dir and return a dict of {deb name: stanza}.
+
+    If cache_file is given, stanzas are saved there, and only debs whose name,
+    size or mtime aren't in the cache are read again.
+    """
+    dest_dir = Path(dest_dir)
+    all_keys = list_deb_keys(dest_dir)
+    keys = all_keys
+    if names is not None:
+        keys = {n: k for n, k in all_keys.items() if n in names}
+    cache = load_stanza_cache(cache_file)
+    cached = cache.get('debs')
+    stanzas = {}
+    entries = {}
+    scanned = 0
+    for name in sorted(keys):
+        key = keys.get(name)
+        entry = cached.get(name)
+        if entry and entry.get('key') == key:
+            stanza = entry.get('stanza')
+        else:
+            try:
+                stanza = scan_deb(dest_dir / name)
+            except (OSError, ValueError, tarfile.TarError, subprocess.CalledProcessError) as e:
+                logging.warning(f"Skipping unreadable package {name}: {e}")
+                continue
+            scanned += 1
+        stanzas[name] = stanza
+        entries[name] = {'key': key, 'stanza': stanza}
+    logging.info(f"{len(stanzas)} packages indexed in {dest_dir}; {scanned} needed scanning.")
+
+    if cache_file and (scanned or len(entries) != len(cached)):
+        if names is not None:
+            # Keep cached entries for debs that weren't asked for.
+            for name, entry in cached.items():
+                if name not in names and name in all_keys:
+                    entries[name] = entry
+        cache['debs'] = entries
+        utils.save_cache(cache_file, cache)
+    return stanzas
+
+def update_stanzas(dest_dir, added=(), removed=(), cache_file=None):
+    """
+    Apply added and removed debs to dest_dir's stanza cache and return a dict
+    of {deb name: stanza} for all of its debs. Only added debs are read, and
+    the folder isn't listed, unless there's no cache to start from.
+    """
+    dest_dir = Path(dest_dir)
+    cache = load_stanza_cache(cache_file)
+    entries = cache.get('debs')
+    if not entries:
+        return scan_debs(dest_dir, cache_file=cache_file)
+    for name in removed:
+        entries.pop(name, None)
+    for name in added:
+        file = dest_dir / name
+        try:
+            st = file.stat()
+            stanza = scan_deb(file)
+        except (OSError, ValueError, tarfile.TarError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Skipping unreadable package {name}: {e}")
+            entries.pop(name, None)
+            continue
+        entries[name] = {'key': (st.st_size, st.st_mtime_ns), 'stanza': stanza}
+    logging.info(f"{len(entries)} packages indexed in {dest_dir}; {len(added)} added, {len(removed)} removed.")
+    if cache_file:
+        utils.save_cache(cache_file, cache)
+    return {name: entry.get('stanza') for name, entry in entries.items()}
+
+def read_packages_gz(pkgs_gz):
+    """
+    Read a Packages.gz file into a dict of {deb name: stanza}.
+    """
+    stanzas = {}
+    with gzip.open(pkgs_gz, 'rt') as f:
+        text = f.read()
+    for block in text.split('\n\n'):
+        if not block.strip():
+            continue
+        fields = parse_control(block)
+        filename = fields.get('Filename')
+        if filename:
+            stanzas[Path(filename).name] = fields
+    return stanzas
+
+def verify_stanza_cache(dest_dir, cache_file):
+    """
+    Compare cached stanzas and Packages.gz with a full rescan of dest_dir.
+    Returns a list of problems found.
+    """
+    problems = []
+    dest_dir = Path(dest_dir)
+    cached = load_stanza_cache(cache_file).get('debs')
+    keys = list_deb_keys(dest_dir)
+    full = scan_debs(dest_dir)
+    for name in sorted(set(cached) | set(full)):
+        if name not in keys:
+            problems.append(f"{name}: cached but not in {dest_dir}")
+        elif name not in cached:
+            problems.append(f"{name}: not cached")
+        elif name not in full:
+            problems.append(f"{name}: cached but unreadable")
+        elif cached[name].get('key') != keys[name]:
+            problems.append(f"{name}: cached size or mtime is stale")
+        elif cached[name].get('stanza') != full[name]:
+            problems.append(f"{name}: cached stanza differs from rescan")
+
+    pkgs_gz = dest_dir / 'Packages.gz'
+    if not pkgs_gz.is_file():
+        problems.append(f"{pkgs_gz}: missing")
+    elif gzip.decompress(pkgs_gz.read_bytes()).decode() != format_packages(full):
+        problems.append(f"{pkgs_gz}: differs from rescan")
+    return problems
+
+def format_stanza(fields):
+    return ''.join(f"{k}: {v}\n" for k, v in fields.items())
+
+def format_packages(stanzas):
+    """
+    Return Packages file text for a dict of {deb name: stanza}.
+    """
+    return ''.join(f"{format_stanza(stanzas[name])}\n" for name in sort_stanza_names(stanzas))
+
+def sort_stanza_names(stanzas):
+    """
+    Sort deb names by package name, as dpkg-scanpackages does, then by
+    version and arch so that the order doesn't depend on the file system.
+    """
+    version_key = cmp_to_key(compare_versions)
+    def key(name):
+        fields = stanzas[name]
+        return (fields.get('Package', ''), version_key(fields.get('Version', '')), fields.get('Architecture', ''), name)
+    return sorted(stanzas, key=key)
+
+def open_compressed(fmt, f, level):
+    """
+    Return a file object that compresses what's written to it into f.
+    """
+    if fmt == 'gz':
+        # No name or timestamp, so that unchanged indexes keep their hashes.
+        return gzip.GzipFile(filename='', mode='wb', fileobj=f, compresslevel=min(max(level, 1), 9), mtime=0)
+    if fmt == 'xz':
+        return lzma.LZMAFile(f, 'wb', preset=min(max(level, 0), 9))
+    if fmt == 'lz4':
+        return lz4.frame.LZ4FrameFile(f, 'wb', compression_level=level)
+    raise ValueError(f"Unknown index format: {fmt}")
+
+def get_file_hash(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def read_release_hashes(release):
+    """
+    Return the SHA256 hashes listed in a Release file.
+    """
+    hashes = set()
+    try:
+        lines = Path(release).read_text().splitlines()
+    except (OSError, ValueError):
+        return hashes
+    in_sha256 = False
+    for line in lines:
+        if not line.startswith(' '):
+            in_sha256 = line.startswith('SHA256:')
+        elif in_sha256 and line.split():
+            hashes.add(line.split()[0])
+    return hashes
+
+def link_by_hash(dest_dir, file, sha256):
+    """
+    Hardlink file to by-hash/SHA256/<sha256> unless it's already there.
+    """
+    by_hash = Path(dest_dir) / BY_HASH_DIR
+    by_hash.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(str(file), str(by_hash / sha256))
+    except FileExistsError:
+        pass
+
+def prune_by_hash(dest_dir, keep):
+    """
+    Remove by-hash files whose hashes aren't in keep.
+    """
+    for file in (Path(dest_dir) / BY_HASH_DIR).glob('*'):
+        if file.name not in keep:
+            file.unlink()
+            logging.debug(f"{file} removed.")
+
+def write_indexes(dest_dir, stanzas, formats=('gz',), level=6):
+    """
+    Write Packages.<fmt> for a dict of {deb name: stanza} in each of the
+    given compression formats, streaming stanzas through all of them at
+    once, and the Release file listing them. Files of formats that aren't
+    wanted any more are removed.
+    All indexes are staged and linked into by-hash/ before the new Release
+    is published, and the previous generation is kept there, so that APT
+    reading by hash always finds the indexes that its Release lists. Plain
+    Packages.<fmt> names are replaced last.
+    Returns {file name: (sha256, size)}, including the uncompressed index.
+    """
+    dest_dir = Path(dest_dir)
+    wanted = ['gz']
+    for fmt in formats:
+        if fmt not in INDEX_FORMATS:
+            logging.warning(f"Ignoring unknown index format: {fmt}")
+        elif fmt == 'lz4' and lz4 is None:
+            logging.warning(f"python3-lz4 is not installed; Packages.lz4 not written.")
+        elif fmt not in wanted:
+            wanted.append(fmt)
+
+    tmps = {fmt: dest_dir / f".Packages.{fmt}.tmp" for fmt in wanted}
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with ExitStack() as stack:
+            outs = []
+            for fmt in wanted:
+                raw = stack.enter_context(open(tmps.get(fmt), 'wb'))
+                outs.append(stack.enter_context(open_compressed(fmt, raw, level)))
+            for name in sort_stanza_names(stanzas):
+                data = f"{format_stanza(stanzas[name])}\n".encode()
+                sha256.update(data)
+                size += len(data)
+                for out in outs:
+                    out.write(data)
+        hashes = {'Packages': (sha256.hexdigest(), size)}
+        for fmt in wanted:
+            tmp = tmps.get(fmt)
+            with open(tmp, 'rb+') as f:
+                os.fsync(f.fileno())
+            hashes[f"Packages.{fmt}"] = (get_file_hash(tmp), tmp.stat().st_size)
+            link_by_hash(dest_dir, tmp, hashes[f"Packages.{fmt}"][0])
+        previous = read_release_hashes(dest_dir / RELEASE_NAME)
+        write_release(dest_dir, hashes)
+        for fmt in wanted:
+            os.replace(str(tmps.get(fmt)), str(dest_dir / f"Packages.{fmt}"))
+    finally:
+        for tmp in tmps.values():
+            if tmp.exists():
+                tmp.unlink()
+    for fmt in INDEX_FORMATS:
+        stale = dest_dir / f"Packages.{fmt}"
+        if fmt not in wanted and stale.exists():
+            stale.unlink()
+            logging.debug(f"{stale} removed.")
+    # Keep the previous generation for APT runs that read the old Release.
+    prune_by_hash(dest_dir, previous | {h for h, s in hashes.values()})
+    logging.debug(f"Package indexes ({', '.join(wanted)}) written to {dest_dir} with {len(stanzas)} packages.")
+    return hashes
+
+def write_release(dest_dir, hashes):
+    """
+    Write an unsigned Release file listing the hashes of the indexes, so
+    that APT can pick the cheapest format and skip unchanged ones.
+    """
+    dest_dir = Path(dest_dir)
+    lines = [
+        f"Origin: apt-lan",
+        f"Label: apt-lan",
+        f"Date: {formatdate(usegmt=True)}",
+        f"Acquire-By-Hash: yes",
+        f"SHA256:",
+    ]
+    lines.extend(f" {sha256} {size:>16} {name}" for name, (sha256, size) in sorted(hashes.items()))
+    release = dest_dir / RELEASE_NAME
+    utils.write_file_atomic(release, '\n'.join(lines) + '\n', sync=True)
+    logging.debug(f"{release} written.")
+
+def order_char(c):
+    if c.isdigit():
+        return 0
+    elif c.isalpha():
+        return ord(c)
+    elif c == '~':
+        return -1
+    elif c:
+        return ord(c) + 256
+    return 0
+
+def compare_fragments(a, b):
+    """
+    Compare upstream versions or revisions as dpkg does.
+    """
+    i = 0
+    j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = order_char(a[i]) if i < len(a) else 0
+            bc = order_char(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+def split_version(version):
+    epoch = 0
+    if ':' in version:
+        e, version = version.split(':', 1)
+        epoch = int(e)
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+def compare_versions(a, b):
+    """
+    Compare two Debian version strings; the result is <0, 0 or >0.
+    """
+    ea, ua, ra = split_version(a)
+    eb, ub, rb = split_version(b)
+    if ea != eb:
+        return ea - eb
+    return compare_fragments(ua, ub) or compare_fragments(ra, rb)
+
+def newest_debs(stanzas, arches):
+    """
+    List the newest deb of each package for each arch, as dpkg-scanpackages
+    would keep without --multiversion. Arch "all" debs count for every arch.
+    """
+    version_key = cmp_to_key(compare_versions)
+    kept = pkgs.DebSet()
+    for arch in arches:
+        newest = {}
+        for name, fields in stanzas.items():
+            if fields.get('Architecture') not in (arch, 'all'):
+                continue
+            package = fields.get('Package')
+            current = newest.get(package)
+            if current is None or version_key(fields.get('Version')) > version_key(stanzas[current].get('Version')):
+                newest[package] = name
+        kept.update(newest.values())
+    return kept
+
+def create_packages_gz(dest_dir, stanzas=None, cache_file=None, formats=('gz',), level=6):
+    """
+    Write dest_dir's Packages indexes, Release file and manifest, scanning
+    its debs unless stanzas are given.
+    """
+    dest_dir = Path(dest_dir)
+    if stanzas is None:
+        stanzas = scan_debs(dest_dir, cache_file=cache_file)
+    try:
+        write_indexes(dest_dir, stanzas, formats, level)
+        manifest.write_manifest(dest_dir, stanzas)
+    except OSError as e:
+        logging.error(f"Failed to write package index in {dest_dir}: {e}")
+        return 1
+    return 0
+
+def rebuild_pkgs_gz(dest_dir, stanzas=None, cache_file=None, formats=('gz',), level=6):
+    # Rebuild Packages.gz file.
+    logging.info(f"Creating Packages.gz file...")
+    r = create_packages_gz(dest_dir, stanzas, cache_file, formats, level)
+    if r == 0:
+        logging.info(f"Packages.gz file created.")
+        # Remove index left behind by versions that renamed it during syncs.
+        old_pkgs_gz = Path(dest_dir) / 'Packages.gz.old'
+        # old_pkgs_gz.unlink(missing_ok=True) # >= python3.8
+        if old_pkgs_gz.exists():
+            old_pkgs_gz.unlink()
+            logging.debug(f"Packages.gz.old removed.")
+        ret = 0
+    else:
+        # The previous Packages.gz, if any, is still in place.
+        logging.error(f"Packages.gz file creation failed. Previous version kept, if it exists.")
+        ret = 1
+    return ret
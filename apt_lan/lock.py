@@ -0,0 +1,88 @@
+''' Functions related to keeping syncs from running at the same time '''
+
+import fcntl
+import logging
+import os
+import time
+
+from pathlib import Path
+
+from apt_lan import utils
+
+
+class SyncLock():
+    """
+    Exclusive flock on a file that holds the owner's PID and start time.
+    The kernel releases the lock if its owner dies, so a crashed sync never
+    blocks later ones. Readers of the LAN archive don't take the lock.
+
+    A sync waits at most "timeout" seconds for the lock; after that the
+    owner is reported as stuck and the lock isn't acquired.
+    """
+    def __init__(self, file, timeout=3600):
+        self.file = Path(file)
+        self.timeout = timeout
+        self.fd = None
+
+    def read_owner(self):
+        try:
+            pid, since = self.file.read_text().split()[:2]
+            return int(pid), float(since)
+        except (OSError, ValueError):
+            return None, None
+
+    def acquire(self):
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(str(self.file), os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        step = 0.01
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                pass
+            pid, since = self.read_owner()
+            if not waiting:
+                logging.info(f"Waiting for sync by PID {pid} to finish.")
+                waiting = True
+            if time.monotonic() >= deadline:
+                age = int(time.time() - since) if since else '?'
+                logging.error(f"Sync by PID {pid} has held {self.file} for {age} s; giving up.")
+                os.close(self.fd)
+                self.fd = None
+                return False
+            time.sleep(step)
+            # Check often at first so that short syncs are followed closely.
+            step = min(step * 2, 0.5)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, f"{os.getpid()} {time.time()}\n".encode())
+        logging.debug(f"{self.file} acquired.")
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        logging.debug(f"{self.file} released.")
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def run_locked(app, func, *args):
+    """
+    Run a sync function while holding the app's sync lock.
+    """
+    timeout = utils.get_config_value(app.config, 'system', 'lock_timeout', 3600)
+    with SyncLock(app.state_dir / 'sync.lock', timeout) as acquired:
+        if not acquired:
+            return 1
+        return func(app, *args)
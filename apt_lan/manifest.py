@@ -0,0 +1,76 @@
+''' Functions related to the manifest of debs published by LAN shares '''
+
+import gzip
+import json
+import logging
+import time
+
+from pathlib import Path
+
+from apt_lan import utils
+
+
+MANIFEST_NAME = 'manifest.json.gz'
+MANIFEST_VERSION = 1
+MANIFEST_FIELDS = ['Size', 'SHA256', 'Package', 'Version', 'Architecture']
+
+
+def build_entries(stanzas):
+    """
+    Reduce each deb's stanza to a compact list of MANIFEST_FIELDS.
+    """
+    entries = {}
+    for name, fields in stanzas.items():
+        entry = [fields.get(f, '') for f in MANIFEST_FIELDS]
+        entry[0] = int(entry[0] or 0)
+        entries[name] = entry
+    return entries
+
+def read_manifest(file):
+    """
+    Return (generation, {deb name: fields}) from a manifest file, or
+    (0, None) if it's missing or invalid.
+    """
+    try:
+        with gzip.open(str(file), 'rt') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return 0, None
+    except (OSError, EOFError, ValueError) as e:
+        logging.warning(f"Ignoring invalid manifest {file}: {e}")
+        return 0, None
+    if not isinstance(data, dict) or data.get('v') != MANIFEST_VERSION:
+        logging.warning(f"Ignoring manifest {file} of unknown version.")
+        return 0, None
+    debs = {}
+    for name, entry in data.get('debs', {}).items():
+        debs[name] = dict(zip(MANIFEST_FIELDS, entry))
+    return data.get('generation', 0), debs
+
+def write_manifest(dest_dir, stanzas):
+    """
+    Publish the manifest of debs in dest_dir. The generation only changes
+    when the debs do, so that clients can tell when there's nothing new.
+    Returns the manifest's generation.
+    """
+    file = Path(dest_dir) / MANIFEST_NAME
+    entries = build_entries(stanzas)
+    try:
+        with gzip.open(str(file), 'rt') as f:
+            old = json.load(f)
+    except (OSError, EOFError, ValueError):
+        old = {}
+    if not isinstance(old, dict):
+        old = {}
+    old_generation = old.get('generation', 0)
+    if old.get('v') == MANIFEST_VERSION and old.get('debs') == entries:
+        logging.debug(f"{file} unchanged at generation {old_generation}.")
+        return old_generation
+
+    # Generations keep increasing even if the manifest is deleted.
+    generation = max(old_generation + 1, int(time.time()))
+    data = {'v': MANIFEST_VERSION, 'generation': generation, 'debs': entries}
+    text = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    utils.write_file_atomic(file, gzip.compress(text.encode(), compresslevel=9))
+    logging.debug(f"{file} written with {len(entries)} packages at generation {generation}.")
+    return generation
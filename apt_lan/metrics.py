@@ -0,0 +1,177 @@
+''' Functions related to timing syncs and exporting their metrics '''
+
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+from collections import OrderedDict
+from pathlib import Path
+
+from apt_lan import utils
+
+
+RUNS_NAME = 'runs.jsonl'
+# Older run records are dropped once the history grows past this.
+MAX_RUNS = 1000
+PROM_PREFIX = 'apt_lan_sync'
+# Phases whose peak memory use is traced when profiling: list parsing and
+#   index building.
+TRACED_PHASES = ['list', 'scan', 'index']
+
+
+class SyncMetrics():
+    """
+    Phase timings and counters of one sync run. Each phase lasts from its
+    enter() until the next one or finish(), and a phase entered more than
+    once adds up. Counters are totals for the run, optionally also per peer;
+    counting is thread-safe. The peak memory allocated by Python during each
+    of the traced_phases is measured with tracemalloc.
+    """
+    def __init__(self, kind, traced_phases=()):
+        self.kind = kind
+        self.traced_phases = traced_phases
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.duration = None
+        self.result = None
+        self.phase = None
+        self.phase_start = None
+        self.phases = OrderedDict()
+        self.memory_peaks = OrderedDict()
+        self.counters = OrderedDict()
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def enter(self, name):
+        """
+        End the current phase, if any, and start timing phase "name".
+        """
+        self.end_phase()
+        self.phase = name
+        if name in self.traced_phases and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.phase_start = time.monotonic()
+
+    def end_phase(self):
+        if self.phase is None:
+            return
+        elapsed = time.monotonic() - self.phase_start
+        self.phases[self.phase] = self.phases.get(self.phase, 0) + elapsed
+        logging.debug(f"{self.kind} sync phase {self.phase} took {elapsed:.3f} s.")
+        if self.phase in self.traced_phases and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.memory_peaks[self.phase] = max(peak, self.memory_peaks.get(self.phase, 0))
+            logging.info(f"{self.kind} sync phase {self.phase} peak memory: {peak / 1048576:.1f} MiB")
+        self.phase = None
+
+    def count(self, name, amount=1, peer=None):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            if peer:
+                counters = self.peers.setdefault(peer, {})
+                counters[name] = counters.get(name, 0) + amount
+
+    def finish(self, result):
+        self.end_phase()
+        self.result = result
+        self.duration = time.monotonic() - self.start
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'started': round(self.started, 3),
+            'duration': round(self.duration or 0, 3),
+            'result': self.result,
+            'phases': {k: round(v, 3) for k, v in self.phases.items()},
+            'counters': dict(self.counters),
+            'peers': self.peers,
+            'memory_peaks': dict(self.memory_peaks),
+        }
+
+
+def format_labels(labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels.items())
+
+def format_prometheus(metrics):
+    """
+    Return the run's metrics in the Prometheus text exposition format.
+    """
+    record = metrics.to_dict()
+    kind = {'kind': metrics.kind}
+    families = [
+        ('last_run_timestamp_seconds', "Start time of the last sync.", [(kind, record.get('started'))]),
+        ('duration_seconds', "Duration of the last sync.", [(kind, record.get('duration'))]),
+        ('success', "Whether the last sync succeeded.", [(kind, int(record.get('result') == 0))]),
+        ('phase_seconds', "Time spent in each phase of the last sync.", [
+            (dict(kind, phase=p), v) for p, v in record.get('phases').items()
+        ]),
+        ('count', "Files and bytes handled by the last sync.", [
+            (dict(kind, counter=c), v) for c, v in record.get('counters').items()
+        ]),
+        ('phase_memory_peak_bytes', "Peak Python memory use of traced phases of the last sync.", [
+            (dict(kind, phase=p), v) for p, v in record.get('memory_peaks').items()
+        ]),
+        ('peer_count', "Files and bytes handled per peer by the last sync.", [
+            (dict(kind, peer=ip, counter=c), v) for ip, counters in sorted(record.get('peers').items()) for c, v in counters.items()
+        ]),
+    ]
+    lines = []
+    for name, help_text, samples in families:
+        if not samples:
+            continue
+        lines.append(f"# HELP {PROM_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PROM_PREFIX}_{name} gauge")
+        lines.extend(f"{PROM_PREFIX}_{name}{{{format_labels(l)}}} {v}" for l, v in samples)
+    return '\n'.join(lines) + '\n'
+
+def append_run_record(file, record, max_runs=MAX_RUNS):
+    """
+    Add a run record to a file of one JSON record per line, dropping the
+    oldest records if there are more than max_runs.
+    """
+    with open(file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    with open(file) as f:
+        lines = f.readlines()
+    if len(lines) > max_runs:
+        utils.write_file_atomic(file, ''.join(lines[-max_runs:]))
+
+def save(metrics, metrics_dir, textfile_dir=None):
+    """
+    Save the run record of a finished sync to metrics_dir as <kind>.json,
+    add it to the run history, and write a Prometheus textfile-collector
+    file to textfile_dir if it exists.
+    """
+    metrics_dir = Path(metrics_dir)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    record = metrics.to_dict()
+    utils.write_file_atomic(metrics_dir / f"{metrics.kind}.json", json.dumps(record, indent=2) + '\n')
+    append_run_record(metrics_dir / RUNS_NAME, record)
+    if textfile_dir and Path(textfile_dir).is_dir():
+        prom = Path(textfile_dir) / f"apt-lan-{metrics.kind}.prom"
+        utils.write_file_atomic(prom, format_prometheus(metrics))
+        logging.debug(f"{prom} written.")
+    phases = ', '.join(f"{k} {v:.1f} s" for k, v in metrics.phases.items())
+    logging.info(f"{metrics.kind} sync took {metrics.duration:.1f} s: {phases}")
+
+def run_measured(app, kind, func, *args):
+    """
+    Run a sync function with app.metrics collecting its metrics, then save
+    them, whether or not it succeeded.
+    """
+    app.metrics = SyncMetrics(kind, TRACED_PHASES if app.profile is not None else ())
+    ret = 1
+    try:
+        ret = func(app, *args)
+        return ret
+    finally:
+        app.metrics.finish(ret)
+        textfile_dir = utils.get_config_value(app.config, 'system', 'metrics_textfile_dir', '/var/lib/prometheus/node-exporter')
+        try:
+            save(app.metrics, app.state_dir / 'metrics', textfile_dir)
+        except OSError as e:
+            logging.warning(f"Unable to save sync metrics: {e}")
+        app.metrics = None
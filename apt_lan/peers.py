@@ -0,0 +1,141 @@
+''' Functions related to tracking LAN peers between syncs '''
+
+import json
+import logging
+import time
+
+from pathlib import Path
+
+from apt_lan import client, utils
+
+
+class PeerCache():
+    """
+    On-disk record of LAN peers seen in earlier syncs.
+
+    Each peer entry holds:
+        last_seen:  time of last successful probe (epoch seconds)
+        latency:    duration of last successful probe (seconds)
+        failures:   consecutive failed probes
+        pkg_count:  number of packages the peer last offered
+        generations: manifest generation of each folder when last synced
+    """
+    def __init__(self, file):
+        self.file = Path(file)
+        self.last_sweep = 0
+        self.peers = {}
+
+    def load(self):
+        try:
+            data = json.loads(self.file.read_text())
+            self.last_sweep = data.get('last_sweep', 0)
+            self.peers = data.get('peers', {})
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError):
+            logging.warning(f"Ignoring invalid peer cache: {self.file}")
+        logging.debug(f"{len(self.peers)} peers loaded from {self.file}")
+        return self
+
+    def save(self):
+        data = {'last_sweep': self.last_sweep, 'peers': self.peers}
+        utils.write_file_atomic(self.file, json.dumps(data, indent=2, sort_keys=True))
+        logging.debug(f"{len(self.peers)} peers saved to {self.file}")
+
+    def record_seen(self, ip, latency=None, pkg_count=None):
+        peer = self.peers.setdefault(ip, {})
+        peer['last_seen'] = time.time()
+        peer['failures'] = 0
+        if latency is not None:
+            peer['latency'] = latency
+        if pkg_count is not None:
+            peer['pkg_count'] = pkg_count
+
+    def record_failure(self, ip):
+        peer = self.peers.setdefault(ip, {'last_seen': 0})
+        peer['failures'] = peer.get('failures', 0) + 1
+
+    def get_generation(self, ip, target):
+        return self.peers.get(ip, {}).get('generations', {}).get(target, 0)
+
+    def record_generation(self, ip, target, generation):
+        """
+        Remember the manifest generation of a peer's folder once it's synced.
+        """
+        peer = self.peers.setdefault(ip, {'last_seen': 0})
+        peer.setdefault('generations', {})[target] = generation
+
+    def expire(self, max_age, max_failures=5):
+        """
+        Drop peers not seen within max_age seconds or failing too often.
+        """
+        now = time.time()
+        for ip, peer in list(self.peers.items()):
+            if now - peer.get('last_seen', 0) > max_age or peer.get('failures', 0) >= max_failures:
+                logging.debug(f"Expiring cached peer {ip}.")
+                del self.peers[ip]
+
+    def ranked(self):
+        """
+        List cached peer IPs, most reliable and fastest first.
+        """
+        def score(ip):
+            peer = self.peers[ip]
+            return (peer.get('failures', 0), peer.get('latency', 1), ip)
+        return sorted(self.peers, key=score)
+
+    def sweep_is_due(self, interval):
+        return time.time() - self.last_sweep > interval
+
+
+def iter_peers(cache, own_ip, netmask, ports, workers=64, timeout=10, sweep_interval=86400, beacon_ips=None, synced_ips=()):
+    """
+    Yield LAN share IPs, starting with those that sent beacons and then cached
+    peers. Beaconing peers that are already in sync are counted as seen but not
+    yielded.
+
+    The full subnet sweep runs in the background while the known peers are
+    being used, but only if none of them answer or, when no beacons were heard
+    at all, if the periodic sweep is due.
+    """
+    seen = set()
+    for ip in synced_ips:
+        cache.record_seen(ip)
+        seen.add(ip)
+    for ip in beacon_ips or []:
+        cache.record_seen(ip)
+        seen.add(ip)
+        yield ip
+
+    known = [ip for ip in cache.ranked() if ip not in seen]
+    logging.info(f"Checking {len(known)} cached LAN peers on port {ports[0]}...")
+    known_hits = client.iter_probe_hits(known, ports[0], workers, timeout)
+
+    sweep_hits = None
+    if beacon_ips is None and (not known or cache.sweep_is_due(sweep_interval)):
+        logging.info(f"Checking LAN for IPs with open port {ports[0]}...")
+        ips = client.list_subnet_ips(own_ip, netmask)
+        sweep_hits = client.iter_probe_hits(ips, ports[0], workers, timeout)
+
+    for ip, latency in known_hits:
+        cache.record_seen(ip, latency)
+        seen.add(ip)
+        yield ip
+    for ip in known:
+        if ip not in seen:
+            logging.debug(f"Cached LAN peer not found: {ip}")
+            cache.record_failure(ip)
+
+    if not sweep_hits and not seen:
+        # Fall back to a full sweep if no known peers answered.
+        logging.info(f"Checking LAN for IPs with open port {ports[0]}...")
+        ips = client.list_subnet_ips(own_ip, netmask)
+        sweep_hits = client.iter_probe_hits(ips, ports[0], workers, timeout)
+    if sweep_hits:
+        for ip, latency in sweep_hits:
+            cache.record_seen(ip, latency)
+            if ip in seen:
+                continue
+            seen.add(ip)
+            yield ip
+        cache.last_sweep = time.time()
@@ -2,12 +2,91 @@
 
 import gzip
 import logging
+import lzma
+import mmap
 import re
 import shutil
 import subprocess
 
 from pathlib import Path
 
+try:
+    import lz4.frame
+except ImportError:
+    # python3-lz4 is optional; lz4-compressed lists are skipped without it.
+    lz4 = None
+
+from apt_lan import utils
+
+
+# Packages list fields needed to identify debs. Stanza fields after the first
+#   one always follow a newline, which lets the regex engine skip ahead quickly.
+PKG_FIELDS = rb'(Package|Version|Architecture|Filename):[ \t]*(\S+)'
+PKG_FIELD_FIRST_RE = re.compile(PKG_FIELDS)
+PKG_FIELD_NEXT_RE = re.compile(rb'\n' + PKG_FIELDS)
+# Compressed list suffixes in order of preference.
+LIST_SUFFIXES = ['', '.lz4', '.gz', '.xz']
+LISTS_DIR = '/var/lib/apt/lists'
+# Suites that name a repo's channel rather than a release codename.
+SUITE_CLASSES = ['stable', 'testing', 'unstable', 'oldstable', 'oldoldstable', 'experimental']
+# Bump when the format of the good debs cache changes.
+GOOD_DEBS_CACHE_VERSION = 1
+
+
+class DebSet(set):
+    """
+    Set of deb file names. Membership checks are hashed, iteration is sorted,
+    and set operations return a DebSet.
+    """
+    def __iter__(self):
+        return iter(sorted(set.__iter__(self)))
+
+    def __repr__(self):
+        return f"DebSet({list(self)})"
+
+    def __or__(self, other):
+        return DebSet(set.__or__(self, other))
+
+    def __and__(self, other):
+        return DebSet(set.__and__(self, other))
+
+    def __sub__(self, other):
+        return DebSet(set.__sub__(self, other))
+
+    def __xor__(self, other):
+        return DebSet(set.__xor__(self, other))
+
+    def union(self, *others):
+        return DebSet(set.union(self, *others))
+
+    def intersection(self, *others):
+        return DebSet(set.intersection(self, *others))
+
+    def difference(self, *others):
+        return DebSet(set.difference(self, *others))
+
+    def symmetric_difference(self, other):
+        return DebSet(set.symmetric_difference(self, other))
+
+    def copy(self):
+        return DebSet(self)
+
+    def write(self, file):
+        """
+        Write deb names to file, one per line, in sorted order.
+        """
+        with open(file, 'w') as f:
+            for deb in self:
+                f.write(f"{deb}\n")
+
+    @classmethod
+    def read(cls, file):
+        """
+        Read deb names from file, one per line.
+        """
+        with open(file) as f:
+            return cls(line.strip() for line in f if line.strip())
+
 
 def get_dpkg_arches():
     arches = []
@@ -26,10 +105,7 @@ def list_archive_debs(dir):
     List APT archive files.
     """
     archive = Path(dir)
-    files = list(archive.glob('*.deb'))
-    debs = [d.name for d in files]
-    debs.sort()
-    return debs
+    return DebSet(d.name for d in archive.glob('*.deb'))
 
 def convert_repo_to_package_files(repo, dpkg_arches):
     """
@@ -58,69 +134,223 @@ def convert_repo_to_package_files(repo, dpkg_arches):
         pkg_files.append('_'.join(file_parts))
     return pkg_files
 
-def list_good_debs(repos):
+def get_list_codename(list_file):
+    """
+    Get the Codename field of the Release file that a Packages list came
+    from, or '' if there isn't one.
+    """
+    list_file = Path(list_file)
+    base = list_file.name.split('_dists_')[0]
+    suite = split_list_suffix(list_file.name)[0][len(base) + len('_dists_'):].split('_')[0]
+    for name in ['InRelease', 'Release']:
+        release = list_file.with_name(f"{base}_dists_{suite}_{name}")
+        try:
+            with release.open(errors='replace') as f:
+                for line in f:
+                    if line.startswith('Codename:'):
+                        return line.split(':', 1)[1].strip()
+                    if line.startswith(' '):
+                        # Hash lists follow the fields.
+                        break
+        except OSError:
+            continue
+    return ''
+
+def list_repo_releases(repos, arches, lists_dir=LISTS_DIR):
+    """
+    List release codenames of the given repositories that have Packages lists
+    for one of the given dpkg arches. The codename comes from the list's
+    Release file, falling back to the suite name without its pocket.
+    Example:
+    IN:  ['http://archive.ubuntu.com/ubuntu focal-updates main']
+    OUT: ['focal']
+    """
+    try:
+        list_names = [f.name for f in Path(lists_dir).iterdir()]
+    except OSError:
+        return []
+    releases = set()
+    for repo in repos or []:
+        parts = repo.split()
+        if len(parts) < 3:
+            continue
+        for approved in convert_repo_to_package_files(repo, arches):
+            matched = match_filename(approved, list_names)
+            if matched:
+                codename = get_list_codename(Path(lists_dir) / matched) or parts[1].split('-')[0]
+                if codename not in SUITE_CLASSES:
+                    releases.add(codename)
+                break
+    return sorted(releases)
+
+def get_deb_name(package, version, arch):
+    """
+    Return the file name APT gives to a downloaded deb.
+    """
+    version = version.replace(':', '%3a') # convert colons
+    return f"{package}_{version}_{arch}.deb"
+
+def split_list_suffix(name):
+    """
+    Split a Packages list file name into its base name and compression suffix.
+    """
+    for suffix in LIST_SUFFIXES[1:]:
+        if name.endswith(suffix):
+            return name[:-len(suffix)], suffix
+    return name, ''
+
+def iter_list_buffers(file, chunk_size=1048576):
+    """
+    Yield buffers from a Packages list that each hold only whole stanzas.
+    Uncompressed lists are mmap'd; compressed ones are streamed in chunks.
+    """
+    suffix = split_list_suffix(Path(file).name)[1]
+    if not suffix:
+        with open(file, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file.
+                return
+            with mm:
+                yield mm
+        return
+
+    if suffix == '.gz':
+        opener = gzip.open
+    elif suffix == '.xz':
+        opener = lzma.open
+    elif lz4:
+        opener = lz4.frame.open
+    else:
+        logging.warning(f"Skipping {file}: python3-lz4 is not installed.")
+        return
+    with opener(file, 'rb') as f:
+        tail = b''
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            buf = tail + chunk
+            end = buf.rfind(b'\n\n')
+            if end < 0:
+                tail = buf
+                continue
+            yield buf[:end + 1]
+            tail = buf[end + 1:]
+        if tail.strip():
+            yield tail
+
+def iter_packages_list(file):
+    """
+    Yield (package, version, arch, filename) for each stanza in a Packages list.
+    """
+    for buf in iter_list_buffers(file):
+        matches = PKG_FIELD_NEXT_RE.finditer(buf)
+        first = PKG_FIELD_FIRST_RE.match(buf)
+        fields = {}
+        if first:
+            fields[first.group(1)] = first.group(2)
+        for m in matches:
+            key = m.group(1)
+            if key == b'Package' and fields:
+                yield stanza_fields_to_tuple(fields)
+                fields = {}
+            fields[key] = m.group(2)
+        if fields:
+            yield stanza_fields_to_tuple(fields)
+
+def stanza_fields_to_tuple(fields):
+    return tuple(
+        fields.get(k, b'').decode()
+        for k in (b'Package', b'Version', b'Architecture', b'Filename')
+    )
+
+def get_file_key(file):
+    """
+    Return a key that changes whenever file is replaced or modified.
+    """
+    st = Path(file).stat()
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def list_good_debs(repos, cache_file=None, lists_dir=LISTS_DIR):
     """
     List packages provided by given repositories.
+
+    If cache_file is given, parsed lists are saved there and only lists whose
+    path, size, mtime or inode have changed are parsed again.
     """
     logging.debug(f"Approved repos:")
     logging.debug(repos)
     arches = get_dpkg_arches()
-    approved_pkgs_list = []
     approved_lists = []
-    parent_dir = Path('/var/lib/apt/lists')
+    parent_dir = Path(lists_dir)
     for repo in repos:
         approved_lists.extend(convert_repo_to_package_files(repo, arches))
 
+    # Account for lists possibly having country-code server prefix.
+    apt_list_names = [f.name for f in parent_dir.iterdir()]
+    list_keys = {}
     for l in approved_lists:
-        # Account for l possibly having country-code server prefix.
-        apt_list_names = [f.name for f in parent_dir.iterdir()]
         matched_list = match_filename(l, apt_list_names)
         logging.debug(f"Approved list: {l}")
         logging.debug(f"Matched list: {matched_list}")
         if not matched_list:
             continue
-
         file = parent_dir / matched_list
         try:
-            with open(file, 'r') as f:
-                kwds = ['Package: ', 'Architecture: ', 'Version: ']
-                package = ''
-                version = ''
-                arch = ''
-                for line in f:
-                    if package and version and arch:
-                        version = version.replace(':', '%3a') # convert colons
-                        debparts = [package, version, arch]
-                        debfile = '_'.join(debparts) + '.deb'
-                        approved_pkgs_list.append(debfile)
-                        package = ''
-                        version = ''
-                        arch = ''
-
-                    elif any(kwd in line for kwd in kwds):
-                        lparts = re.split(':\s', line)
-                        package = (lparts[1].strip() if lparts[0] == 'Package' else package)
-                        arch = (lparts[1].strip() if lparts[0] == 'Architecture' else arch)
-                        version = (lparts[1].strip() if lparts[0] == 'Version' else version)
-
+            list_keys[str(file)] = get_file_key(file)
         except FileNotFoundError:
             pass
 
-    return approved_pkgs_list
+    empty = {'version': GOOD_DEBS_CACHE_VERSION, 'config': None, 'lists': {}, 'good_debs': None}
+    cache = utils.load_cache(cache_file, empty)
+    config = (sorted(repos), arches)
+    cached_lists = cache.get('lists')
+    if cache.get('config') == config and cache.get('good_debs') is not None:
+        if {f: e.get('key') for f, e in cached_lists.items()} == list_keys:
+            logging.debug(f"Approved lists unchanged; using {cache_file}")
+            return cache.get('good_debs')
+
+    good_debs = DebSet()
+    lists = {}
+    for file, key in list_keys.items():
+        entry = cached_lists.get(file)
+        if entry and entry.get('key') == key:
+            debs = entry.get('debs')
+        else:
+            logging.debug(f"Parsing {file}")
+            debs = set()
+            try:
+                for package, version, arch, filename in iter_packages_list(file):
+                    if package and version and arch:
+                        debs.add(get_deb_name(package, version, arch))
+            except FileNotFoundError:
+                continue
+            debs = frozenset(debs)
+        lists[file] = {'key': key, 'debs': debs}
+        good_debs.update(debs)
+
+    if cache_file:
+        cache.update({'config': config, 'lists': lists, 'good_debs': good_debs})
+        utils.save_cache(cache_file, cache)
+    return good_debs
 
 def match_filename(approved_name, files):
-    matched_name = None
+    """
+    Find the file matching approved_name, allowing for a country-code server
+    prefix and compression suffix. Uncompressed files are preferred.
+    """
+    matches = {}
     for file in files:
-        full_name = file
-        short_name = '.'.join(file.split('.')[1:])
+        full_name, suffix = split_list_suffix(file)
+        short_name = '.'.join(full_name.split('.')[1:])
         if approved_name == full_name or approved_name == short_name:
-            matched_name = full_name
-            break
-    return matched_name
+            matches.setdefault(suffix, file)
+    for suffix in LIST_SUFFIXES:
+        if suffix in matches:
+            return matches[suffix]
+    return None
 
 def list_approved_debs(archive_debs, good_debs):
-    approved_debs = [deb for deb in archive_debs if deb in good_debs]
-    return approved_debs
+    return DebSet(archive_debs) & good_debs
 
 def ensure_destination(dest):
     dest = Path(dest)
@@ -130,70 +360,11 @@ def ensure_destination(dest):
     return {'Packages': dest_debs, 'Free Space': dest_bytes_free}
 
 def list_debs_to_copy(approved_debs, dest_debs):
-    debs_to_copy = [d for d in approved_debs if d not in dest_debs]
-    return debs_to_copy
-
-def create_packages_gz(dest_dir):
-    # Rebuild Packages.gz file.
-    cmd = ['dpkg-scanpackages', '--multiversion', dest_dir]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
-    output = result.stdout
-
-    # Remove empty line and summary line from end of output.
-    output_lines = output.splitlines()
-    output = '\n'.join(output_lines[:-2])
-
-    pkg_file0 = dest_dir / 'Packages.0'
-    pkg_file0.write_text(output)
-
-    if pkg_file0.stat().st_size:
-        # Packages.0 file is good.
-        oldies = [dest_dir / 'Packages', dest_dir / 'Packages.gz']
-        for oldie in oldies:
-            # oldie.unlink(missing_ok=True) # >= python3.8
-            if oldie.exists():
-                oldie.unlink()
-        pkg_file = dest_dir / 'Packages'
-        pkg_file0.rename(pkg_file)
-        pkg_gz = dest_dir / 'Packages.gz'
-        pkg_gz.write_bytes(gzip.compress(pkg_file.read_bytes(), compresslevel=9))
-        logging.debug(f"{pkg_gz} done.")
-        ret = 0
-    else:
-        # Packages.0 file is zero size.
-        logging.error(f"{pkg_file0} not populated. Check dpkg-scanpackages log output.")
-        ret = 1
-    # pkg_file0.unlink(missing_ok=True) # >= python3.8
-    if pkg_file0.exists():
-        pkg_file0.unlink()
-    # pkg_file.unlink(missing_ok=True) # >= python3.8
-    if pkg_file.exists():
-        pkg_file.unlink()
-    return ret
+    return DebSet(approved_debs) - dest_debs
 
 def get_superseded_debs(file):
-    superseded_debs = []
+    superseded_debs = DebSet()
     if file.is_file():
         # Get list from file.
-        with open(file) as f:
-            superseded_debs = f.readlines()
+        superseded_debs = DebSet.read(file)
     return superseded_debs
-
-def rebuild_pkgs_gz(dest_dir, pkgs_gz, old_pkgs_gz):
-    # Rebuild Packages.gz file.
-    logging.info(f"Creating Packages.gz file...")
-    r = create_packages_gz(dest_dir)
-    if r == 0:
-        logging.info(f"Packages.gz file created.")
-        # old_pkgs_gz.unlink(missing_ok=True) # >= python3.8
-        if old_pkgs_gz.exists():
-            old_pkgs_gz.unlink()
-        logging.debug(f"Packages.gz.old removed.")
-        ret = 0
-    else:
-        # Fall back if pkgs.create_packages_gz failed.
-        logging.error(f"Packages.gz file creation failed. Falling back to previous version, if it exists.")
-        if old_pkgs_gz.is_file():
-            old_pkgs_gz.rename(pkgs_gz)
-        ret = 1
-    return ret
@@ -0,0 +1,123 @@
+''' Functions related to placing package files into the LAN archive '''
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+from pathlib import Path
+
+
+# ioctl request number to clone a file's extents (linux/fs.h).
+FICLONE = 0x40049409
+# Strategies in order of preference.
+STRATEGIES = ['hardlink', 'reflink', 'copy']
+
+
+def reflink(src, dst):
+    """
+    Make dst share src's data blocks (btrfs, xfs). Raises OSError if the
+    filesystem can't do it.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(str(dst))
+            raise
+
+def copy_file(src, dst):
+    """
+    Copy src to dst in the kernel, with copy_file_range or sendfile.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        try:
+            while remaining > 0:
+                if hasattr(os, 'copy_file_range'): # >= python3.8
+                    sent = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                else:
+                    sent = os.sendfile(d.fileno(), s.fileno(), None, remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            # Fall back to copying in userspace.
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+            shutil.copyfileobj(s, d, 1048576)
+        d.flush()
+        os.fsync(d.fileno())
+    shutil.copymode(str(src), str(dst))
+
+def place_file(src, dst_dir, strategy='hardlink'):
+    """
+    Put src into dst_dir using the given strategy, falling back to the next
+    one if it fails. Returns the strategy that was used.
+    """
+    src = Path(src)
+    dst = Path(dst_dir) / src.name
+    # Work on a temp name so that dst_dir never has a partial file.
+    tmp = Path(dst_dir) / f".{src.name}.tmp"
+    if tmp.exists():
+        tmp.unlink()
+    for s in STRATEGIES[STRATEGIES.index(strategy):]:
+        try:
+            if s == 'hardlink':
+                os.link(str(src), str(tmp))
+            elif s == 'reflink':
+                reflink(src, tmp)
+            else:
+                copy_file(src, tmp)
+            break
+        except OSError as e:
+            if s == STRATEGIES[-1]:
+                raise
+            logging.debug(f"{s} of {src} failed: {e}")
+    os.replace(str(tmp), str(dst))
+    return s
+
+def probe_strategy(sample, dst_dir):
+    """
+    Find the cheapest strategy that works for putting sample into dst_dir.
+    """
+    sample = Path(sample)
+    probe = Path(dst_dir) / '.apt-lan-probe'
+    if probe.exists():
+        probe.unlink()
+    strategy = 'copy'
+    try:
+        os.link(str(sample), str(probe))
+        strategy = 'hardlink'
+    except OSError:
+        try:
+            reflink(sample, probe)
+            strategy = 'reflink'
+        except OSError:
+            pass
+    if probe.exists():
+        probe.unlink()
+    logging.debug(f"Placement strategy from {sample.parent} to {dst_dir}: {strategy}")
+    return strategy
+
+def get_bytes_needed(strategy, copy_bytes):
+    """
+    Return the free space needed to place copy_bytes of files with strategy.
+    Hardlinks and reflinks only use metadata.
+    """
+    return copy_bytes if strategy == 'copy' else 0
+
+def sync_dir(dir):
+    """
+    Flush a directory's entries to disk.
+    """
+    fd = os.open(str(dir), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
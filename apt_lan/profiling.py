@@ -0,0 +1,51 @@
+''' Functions related to profiling apt-lan commands '''
+
+import cProfile
+import io
+import logging
+import pstats
+import time
+
+from pathlib import Path
+
+
+# Number of functions listed in the log summary.
+TOP_COUNT = 30
+
+
+def get_stats_file(app, path):
+    """
+    Return the .pstats file for "--profile[=path]"; by default it goes in the
+    log folder, named by the time the run started.
+    """
+    if path:
+        return Path(path)
+    return app.log_dir / f"{app.pkg_name}-{time.strftime('%Y%m%d-%H%M%S')}.pstats"
+
+def format_top(profile, sort, count=TOP_COUNT):
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats(sort).print_stats(count)
+    return out.getvalue()
+
+def run_profiled(app, func, path=None):
+    """
+    Run func under cProfile, then save its stats to a .pstats file and log
+    the functions with the most cumulative and internal time.
+    """
+    stats_file = get_stats_file(app, path)
+    profile = cProfile.Profile()
+    logging.info(f"Profiling this run; stats will be saved to {stats_file}")
+    profile.enable()
+    try:
+        return func()
+    finally:
+        profile.disable()
+        try:
+            stats_file.parent.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(str(stats_file))
+            logging.info(f"Profile stats saved to {stats_file}")
+        except OSError as e:
+            logging.error(f"Unable to save profile stats: {e}")
+        logging.info(f"Top {TOP_COUNT} functions by cumulative time:\n{format_top(profile, 'cumulative')}")
+        logging.info(f"Top {TOP_COUNT} functions by internal time:\n{format_top(profile, 'tottime')}")
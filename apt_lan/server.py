@@ -2,11 +2,13 @@
 
 import logging
 import os
-import psutil
 import subprocess
+import time
 
 from pathlib import Path
 
+from apt_lan import health
+
 
 def get_userid():
     return os.getuid()
@@ -38,26 +40,76 @@ def ensure_smb_setup(file, share_path):
     file.write_text(contents)
     logging.debug(f"smb config written to {str(file)}")
 
-def ensure_rsyncd_setup(port, share_path, loglevel):
+def ensure_rsyncd_setup(app):
     """
     Ensure proper setup of rsyncd server and share.
     """
     # Ensure rsyncd is running.
-    connections = psutil.net_connections()
-    rsyncd = False
-    for c in connections:
-        if c.laddr.port == port:
-            logging.debug(f"rsyncd: {c}")
-            logging.info(f"rsyncd already running on port {c.laddr.port} with PID {c.pid}")
-            rsyncd = True
+    status = health.check_rsyncd(app)
+    if status.get('listening'):
+        logging.info(f"rsyncd already running on port {status.get('port')}")
+        if not status.get('ready'):
+            logging.error(f"rsyncd is not serving {status.get('target')} from its {health.MODULE_NAME} module.")
+        return status
+    cmd = ['pkexec', 'systemctl', 'enable', '--now', 'apt-lan-rsyncd.service']
+    r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode != 0:
+        logging.error(f"Failed to start apt-lan-rsyncd.service.")
+        return status
+    logging.info(f"Started apt-lan-rsyncd.service.")
+    # Give rsyncd a moment to start listening.
+    for i in range(20):
+        status = health.check_rsyncd(app)
+        if status.get('listening'):
             break
-    if not rsyncd:
-        cmd = ['pkexec', 'systemctl', 'enable', '--now', 'apt-lan-rsyncd.service']
-        if loglevel == logging.DEBUG:
-            # cmd.append('debug')
-            pass
-        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        if r.returncode == 0:
-            logging.info(f"Started rsyncd with PID {r.pid}")
-        else:
-            logging.error(f"Failed to start apt-lan-rsyncd.service.")
+        time.sleep(0.1)
+    return status
+
+def ensure_beacon_setup():
+    """
+    Ensure that apt-lan beacons are being sent.
+    """
+    cmd = ['systemctl', 'is-active', '--quiet', 'apt-lan-beacon.service']
+    r = subprocess.run(cmd)
+    if r.returncode == 0:
+        logging.info("apt-lan-beacon.service already running.")
+        return
+    cmd = ['pkexec', 'systemctl', 'enable', '--now', 'apt-lan-beacon.service']
+    r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode == 0:
+        logging.info("Started apt-lan-beacon.service.")
+    else:
+        logging.error("Failed to start apt-lan-beacon.service.")
+
+def ensure_beacon_stopped():
+    """
+    Ensure that apt-lan-beacon.service isn't sending beacons.
+    """
+    cmd = ['systemctl', 'is-enabled', '--quiet', 'apt-lan-beacon.service']
+    enabled = subprocess.run(cmd).returncode == 0
+    cmd = ['systemctl', 'is-active', '--quiet', 'apt-lan-beacon.service']
+    active = subprocess.run(cmd).returncode == 0
+    if not enabled and not active:
+        return
+    cmd = ['pkexec', 'systemctl', 'disable', '--now', 'apt-lan-beacon.service']
+    r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode == 0:
+        logging.info("Stopped apt-lan-beacon.service.")
+    else:
+        logging.error("Failed to stop apt-lan-beacon.service.")
+
+def ensure_daemon_setup():
+    """
+    Ensure that the apt-lan daemon is running syncs.
+    """
+    cmd = ['systemctl', 'is-active', '--quiet', 'apt-lan-daemon.service']
+    r = subprocess.run(cmd)
+    if r.returncode == 0:
+        logging.info("apt-lan-daemon.service already running.")
+        return
+    cmd = ['pkexec', 'systemctl', 'enable', '--now', 'apt-lan-daemon.service']
+    r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode == 0:
+        logging.info("Started apt-lan-daemon.service.")
+    else:
+        logging.error("Failed to start apt-lan-daemon.service.")
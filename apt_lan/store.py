@@ -0,0 +1,154 @@
+''' Functions related to the content-addressed package store '''
+
+import errno
+import json
+import logging
+import os
+
+from pathlib import Path
+
+from apt_lan import utils
+
+
+def get_blob_path(store_dir, sha256):
+    return Path(store_dir) / sha256[:2] / sha256
+
+def have_blob(store_dir, sha256):
+    return bool(sha256) and get_blob_path(store_dir, sha256).is_file()
+
+def link_file(src, dst):
+    """
+    Hardlink src to dst, replacing dst if it exists.
+    """
+    dst = Path(dst)
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    if tmp.exists():
+        tmp.unlink()
+    os.link(str(src), str(tmp))
+    os.replace(str(tmp), str(dst))
+
+def add_file(store_dir, file, sha256):
+    """
+    Add file to the store. If an identical blob is already stored, file is
+    replaced by a link to it. Returns the number of bytes freed.
+    """
+    blob = get_blob_path(store_dir, sha256)
+    if not blob.is_file():
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.link(str(file), str(blob))
+        return 0
+    if os.path.samefile(str(blob), str(file)):
+        return 0
+    st = Path(file).stat()
+    link_file(blob, file)
+    # Only count space as freed if nothing else links to the old file.
+    return st.st_size if st.st_nlink == 1 else 0
+
+def add_files(store_dir, dest_dir, stanzas):
+    """
+    Add debs in dest_dir to the store, using SHA256 values from their stanzas.
+    Returns the number of bytes freed by deduplication.
+    """
+    freed = 0
+    for name, fields in stanzas.items():
+        sha256 = fields.get('SHA256')
+        if not sha256:
+            continue
+        try:
+            freed += add_file(store_dir, Path(dest_dir) / name, sha256)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # Blobs can only be linked within a filesystem.
+                logging.warning(f"Package store {store_dir} isn't on the same filesystem as {dest_dir}; not deduplicating.")
+                break
+            logging.warning(f"Unable to add {name} to package store: {e}")
+    if freed:
+        logging.info(f"Deduplicated packages in {dest_dir}; {freed} B freed.")
+    return freed
+
+def link_from_store(store_dir, sha256, dst):
+    """
+    Link the stored blob with the given hash to dst. Returns True on success.
+    """
+    if not have_blob(store_dir, sha256):
+        return False
+    try:
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        link_file(get_blob_path(store_dir, sha256), dst)
+    except OSError as e:
+        logging.warning(f"Unable to link {dst} from package store: {e}")
+        return False
+    return True
+
+def count_share_links(share_dir):
+    """
+    Count the links to each file from the share's <release>/<arch> folders.
+    Debs may also be linked from elsewhere, e.g. APT's own archive, so blob
+    link counts alone don't tell how many archive folders use them.
+    Returns {(device, inode): links}.
+    """
+    links = {}
+    for file in Path(share_dir).glob('*/*/*.deb'):
+        try:
+            st = file.stat()
+        except FileNotFoundError:
+            continue
+        key = (st.st_dev, st.st_ino)
+        links[key] = links.get(key, 0) + 1
+    return links
+
+def prune(store_dir, share_dir):
+    """
+    Remove blobs that are no longer linked from any archive folder.
+    Returns the number of blobs removed.
+    """
+    links = count_share_links(share_dir)
+    removed = 0
+    for blob in Path(store_dir).glob('??/*'):
+        try:
+            st = blob.stat()
+            if st.st_nlink == 1 or (st.st_dev, st.st_ino) not in links:
+                blob.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    logging.debug(f"{removed} unused blobs removed from {store_dir}.")
+    return removed
+
+def get_space_saved(store_dir, share_dir):
+    """
+    Return bytes saved by storing each blob once instead of once per
+    archive folder that links to it.
+    """
+    links = count_share_links(share_dir)
+    saved = 0
+    for blob in Path(store_dir).glob('??/*'):
+        st = blob.stat()
+        count = links.get((st.st_dev, st.st_ino), 0)
+        if count > 1:
+            saved += st.st_size * (count - 1)
+    return saved
+
+def load_stats(store_dir):
+    try:
+        return json.loads((Path(store_dir) / 'stats.json').read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def record_bandwidth_saved(store_dir, saved):
+    """
+    Add to the running total of bytes not downloaded thanks to the store.
+    """
+    stats = load_stats(store_dir)
+    stats['bandwidth_saved'] = stats.get('bandwidth_saved', 0) + saved
+    stats_file = Path(store_dir) / 'stats.json'
+    stats_file.parent.mkdir(parents=True, exist_ok=True)
+    stats_file.write_text(json.dumps(stats))
+
+def report(store_dir, share_dir):
+    """
+    Log disk space and download bandwidth saved by the store.
+    """
+    space = utils.convert_bytes_to_human(get_space_saved(store_dir, share_dir))
+    bandwidth = utils.convert_bytes_to_human(load_stats(store_dir).get('bandwidth_saved', 0))
+    logging.info(f"Package store has saved {space.get('Number')} {space.get('Unit')} of disk space and {bandwidth.get('Number')} {bandwidth.get('Unit')} of downloads.")
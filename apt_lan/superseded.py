@@ -0,0 +1,169 @@
+''' Functions related to the log of superseded packages '''
+
+import bisect
+import hashlib
+import logging
+import os
+import time
+
+from pathlib import Path
+
+from apt_lan import pkgs, utils
+
+
+LOG_NAME = 'superseded.log'
+LEGACY_NAME = 'superseded.txt'
+
+
+class BloomFilter():
+    """
+    Fixed-size Bloom filter of strings; membership tests may give false
+    positives but never false negatives.
+    """
+    def __init__(self, capacity, bits_per_entry=10, hashes=7):
+        self.size = max(64, capacity * bits_per_entry)
+        self.hashes = hashes
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def get_indexes(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for i in self.get_indexes(item):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self.get_indexes(item))
+
+
+def parse_line(line):
+    """
+    Return (generation, deb name) from a log line, or None if it's invalid.
+    """
+    generation, _, deb = line.strip().partition(' ')
+    if not deb or not generation.isdigit():
+        return None
+    return int(generation), deb
+
+def read_entries(file, since=0):
+    """
+    Yield (generation, deb name) for entries in file newer than "since".
+    """
+    try:
+        with open(file) as f:
+            for line in f:
+                entry = parse_line(line)
+                if entry and entry[0] > since:
+                    yield entry
+    except FileNotFoundError:
+        return
+
+
+class SupersededLog():
+    """
+    Append-only log of debs superseded in an archive folder, kept as
+    "<generation> <deb name>" lines. Every batch of new entries gets a new
+    generation so that peers can merge only what they haven't seen yet.
+    Lookups use a Bloom filter in front of a sorted list of names.
+    """
+    def __init__(self, dest_dir):
+        self.dest_dir = Path(dest_dir)
+        self.file = self.dest_dir / LOG_NAME
+        self.generation = 0
+        self.entries = 0
+        self.debs = []
+        self.bloom = BloomFilter(0)
+
+    def load(self):
+        names = set()
+        self.entries = 0
+        for generation, deb in read_entries(self.file):
+            self.generation = max(self.generation, generation)
+            names.add(deb)
+            self.entries += 1
+        self.index(names)
+        legacy = self.dest_dir / LEGACY_NAME
+        if legacy.is_file():
+            # Move entries from the old flat list into the log.
+            self.append(pkgs.get_superseded_debs(legacy))
+            legacy.unlink()
+            logging.info(f"{legacy} migrated to {self.file}.")
+        logging.debug(f"{len(self)} superseded packages loaded from {self.file}.")
+        return self
+
+    def index(self, names):
+        self.debs = sorted(names)
+        # Leave room for entries appended later.
+        self.bloom = BloomFilter(len(self.debs) * 2 + 1024)
+        for deb in self.debs:
+            self.bloom.add(deb)
+
+    def __contains__(self, deb):
+        if deb not in self.bloom:
+            return False
+        i = bisect.bisect_left(self.debs, deb)
+        return i < len(self.debs) and self.debs[i] == deb
+
+    def __len__(self):
+        return len(self.debs)
+
+    def exclude(self, debs):
+        """
+        Return a DebSet of the given debs that are not superseded.
+        """
+        return pkgs.DebSet(d for d in debs if d not in self)
+
+    def next_generation(self):
+        # Generations keep increasing even if the log is deleted.
+        return max(self.generation + 1, int(time.time()))
+
+    def append(self, debs):
+        """
+        Add debs that aren't already listed as one new generation.
+        Returns the number of debs added.
+        """
+        new = sorted(set(d for d in debs if d not in self))
+        if not new:
+            return 0
+        generation = self.next_generation()
+        self.dest_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.file, 'a') as f:
+            f.writelines(f"{generation} {deb}\n" for deb in new)
+            f.flush()
+            os.fsync(f.fileno())
+        self.generation = generation
+        self.entries += len(new)
+        if len(self.debs) + len(new) > self.bloom.size // 10:
+            self.index(self.debs + new)
+        else:
+            for deb in new:
+                bisect.insort(self.debs, deb)
+                self.bloom.add(deb)
+        logging.debug(f"{len(new)} superseded packages added to {self.file} at generation {generation}.")
+        return len(new)
+
+    def compact(self, max_entries=0):
+        """
+        Rewrite the log without duplicate entries, keeping only the newest
+        "max_entries" if given. Generations are kept, so peers' positions in
+        the log stay valid.
+        """
+        if self.entries <= len(self.debs) and not (max_entries and self.entries > max_entries):
+            return 0
+        latest = {}
+        for generation, deb in read_entries(self.file):
+            latest[deb] = generation
+        entries = sorted((g, d) for d, g in latest.items())
+        if max_entries and len(entries) > max_entries:
+            entries = entries[-max_entries:]
+        if len(entries) == self.entries:
+            return 0
+        removed = self.entries - len(entries)
+        utils.write_file_atomic(self.file, ''.join(f"{g} {d}\n" for g, d in entries), sync=True)
+        self.entries = len(entries)
+        self.index(d for g, d in entries)
+        logging.info(f"{removed} entries compacted out of {self.file}.")
+        return removed
@@ -0,0 +1,196 @@
+''' Functions related to limiting the load that syncs put on the system '''
+
+import logging
+import os
+import psutil
+import threading
+import time
+
+from apt_lan import utils
+
+
+IONICE_CLASSES = {
+    'idle': (psutil.IOPRIO_CLASS_IDLE, None),
+    # Lowest best-effort priority; unlike "idle" it can't be starved.
+    'best-effort': (psutil.IOPRIO_CLASS_BE, 7),
+}
+# Seconds of transfer per rsync session when transfers share a rate limit.
+CHUNK_SECONDS = 30
+
+
+class TokenBucket():
+    """
+    Token bucket rate limiter that can be shared between threads.
+    Tokens are bytes; "rate" is in bytes per second and "burst" is the most
+    that can be used at once after the bucket has been idle.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Transfers that will share the rate, and how many run at once.
+        self.transfers = 1
+        self.parallel = 1
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take "amount" tokens and return the seconds to wait before using them.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative so that large requests aren't starved.
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait > 0:
+            logging.debug(f"Rate limit reached; waiting {wait:.1f} s.")
+            time.sleep(wait)
+        return wait
+
+    def plan_transfers(self, count, parallel):
+        """
+        Set up sharing the rate between "count" transfers that limit
+        themselves, like rsync with --bwlimit, "parallel" at a time.
+        """
+        with self.lock:
+            self.transfers = max(1, count)
+            self.parallel = max(1, parallel)
+
+    def get_share(self):
+        """
+        Return the rate for the next chunk of a planned transfer. Each running
+        transfer started with at most this share, so the total stays within
+        the rate; the share only grows once transfers end.
+        """
+        with self.lock:
+            return max(1, self.rate // min(self.parallel, self.transfers))
+
+    def end_transfer(self):
+        with self.lock:
+            self.transfers = max(1, self.transfers - 1)
+
+
+def parse_hours(spec):
+    """
+    Parse hour ranges like "8-12,13-17" into a list of (start, end) hours.
+    Ranges may wrap past midnight, e.g. "22-6".
+    """
+    ranges = []
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        try:
+            ranges.append((int(start), int(end or start) % 24))
+        except ValueError:
+            logging.warning(f"Ignoring invalid hour range: {part}")
+    return ranges
+
+def is_busy(spec, now=None):
+    """
+    Tell whether "now" (a struct_time) falls within the given hour ranges.
+    """
+    now = now or time.localtime()
+    for start, end in parse_hours(spec):
+        if start < end and start <= now.tm_hour < end:
+            return True
+        if start > end and (now.tm_hour >= start or now.tm_hour < end):
+            return True
+        if start == end and now.tm_hour == start:
+            return True
+    return False
+
+def get_policy(config, section, now=None):
+    """
+    Get the throttling policy for a sync from its config section:
+        bwlimit:    bytes per second of package transfers (0 = unlimited)
+        nice:       CPU niceness of the process
+        ionice:     I/O scheduling class, "idle", "best-effort" or "none"
+    During the section's busy_hours, busy_bwlimit replaces bwlimit.
+    """
+    busy = is_busy(utils.get_config_value(config, section, 'busy_hours', ''), now)
+    bwlimit = utils.get_config_value(config, section, 'bwlimit', 0)
+    if busy:
+        bwlimit = utils.get_config_value(config, section, 'busy_bwlimit', bwlimit)
+    policy = {
+        'busy': busy,
+        'bwlimit': max(0, bwlimit) * 1024,
+        'nice': utils.get_config_value(config, section, 'nice', 10),
+        'ionice': utils.get_config_value(config, section, 'ionice', 'best-effort'),
+    }
+    logging.debug(f"Throttling policy for [{section}]: {policy}")
+    return policy
+
+def apply_priority(policy):
+    """
+    Lower CPU and I/O priority of this process and the rsync processes it
+    starts.
+    """
+    try:
+        # Set, rather than add to, niceness so that repeated syncs in the
+        #   same process don't keep lowering it.
+        psutil.Process().nice(policy.get('nice'))
+    except (OSError, psutil.Error) as e:
+        logging.warning(f"Unable to set CPU priority: {e}")
+    ionice = IONICE_CLASSES.get(policy.get('ionice'))
+    if ionice:
+        try:
+            psutil.Process().ionice(*ionice)
+        except (OSError, psutil.Error) as e:
+            logging.warning(f"Unable to set I/O priority: {e}")
+    logging.info(f"Running with nice {os.nice(0)} and {policy.get('ionice')} I/O priority.")
+
+def get_bucket(policy):
+    """
+    Return a TokenBucket for the policy's bwlimit, or None if unlimited.
+    """
+    rate = policy.get('bwlimit')
+    if not rate:
+        return None
+    logging.info(f"Package transfers limited to {rate // 1024} KiB/s.")
+    return TokenBucket(rate)
+
+def iter_chunks(names, sizes, chunk_bytes):
+    """
+    Split names into lists whose total size is about chunk_bytes.
+    """
+    chunk = []
+    total = 0
+    for name in names:
+        chunk.append(name)
+        total += sizes.get(name, 0)
+        if total >= chunk_bytes:
+            yield chunk, total
+            chunk = []
+            total = 0
+    if chunk:
+        yield chunk, total
+
+def fetch_limited(fetch_chunk, names, sizes, bucket):
+    """
+    Fetch names in chunks of about CHUNK_SECONDS of transfer, each limited to
+    its share of the bucket's rate by fetch_chunk(chunk, bwlimit) itself.
+    The share is worked out again for each chunk so that it grows as other
+    planned transfers finish.
+    Returns {name: bytes} of files transferred, or None on failure.
+    """
+    transferred = {}
+    remaining = list(names)
+    try:
+        while remaining:
+            rate = bucket.get_share()
+            chunk, chunk_bytes = next(iter_chunks(remaining, sizes, rate * CHUNK_SECONDS))
+            r = fetch_chunk(chunk, rate)
+            if r is None:
+                return None
+            transferred.update(r)
+            remaining = remaining[len(chunk):]
+    finally:
+        bucket.end_transfer()
+    return transferred
@@ -4,11 +4,28 @@ import logging
 import os
 import platform
 import shutil
-import time
 
 from pathlib import Path
 
 
+# Cron folders that apt-lan's sync scripts may be linked into.
+CRON_DIRS = ['cron.hourly', 'cron.daily', 'cron.weekly', 'cron.monthly']
+# dpkg architectures of machine types, so that archive folders get the same
+#   names whether they come from the running kernel or from dpkg.
+DPKG_ARCHES = {
+    'x86_64': 'amd64',
+    'i386': 'i386',
+    'i486': 'i386',
+    'i586': 'i386',
+    'i686': 'i386',
+    'aarch64': 'arm64',
+    'armv7l': 'armhf',
+    'ppc64le': 'ppc64el',
+    's390x': 's390x',
+    'riscv64': 'riscv64',
+}
+
+
 def apply_config(app):
     # Get current config.
     app.config = get_config(app)
@@ -19,12 +36,17 @@ def apply_config(app):
         'system': 'apt-lan-server',
     }
 
+    # Syncs are run by apt-lan-daemon.service instead of cron if configured.
+    use_daemon = get_config_value(app.config, 'system', 'daemon', 'no') == 'yes'
+
     # Ensure proper location of scripts according to config.
     for k, v in scripts.items():
         # Define desired cron directory for the given script.
         freq = app.config.get(k, {}).get('frequency', 'none')
         freq = freq.lower()
-        if freq == 'none':
+        if use_daemon:
+            dest_dir = None
+        elif freq == 'none':
             if k == 'network':
                 dest_dir = Path('/etc/cron.hourly') # "hourly" by default
             elif k == 'system':
@@ -47,16 +69,25 @@ def apply_config(app):
                 script_path_set = True
 
         # Add link to script in dest_dir.
-        if not script_path_set:
+        if not script_path_set and dest_dir:
             logging.info(f"Symlinking /usr/lib/{app.pkg_name}/{v} into {dest_dir}.")
             dest_path = dest_dir / v
             dest_path.symlink_to(f"/usr/lib/{app.pkg_name}/{v}")
+    if use_daemon:
+        # Imported here so that commands that don't need it start faster.
+        from apt_lan import server
+        # The daemon sends beacons itself; don't send them twice.
+        server.ensure_beacon_stopped()
+        server.ensure_daemon_setup()
     logging.info("Config applied.")
 
-def find_script(script_name):
-    etc_dir = Path('/etc')
-    paths = list(etc_dir.rglob(f"cron.*/{script_name}"))
-    return paths
+def find_script(script_name, etc_dir='/etc'):
+    """
+    List links to script_name in the cron folders apt-lan uses.
+    """
+    paths = [Path(etc_dir) / d / script_name for d in CRON_DIRS]
+    # Include broken links so that they can be replaced.
+    return [p for p in paths if p.is_symlink() or p.exists()]
 
 def check_if_root():
     return True if os.geteuid() == 0 else False
@@ -85,8 +116,7 @@ def get_pkg_root(app):
     pkg_root = None
     dir = app.exe_path
     while str(dir.parent) != app.exe_path.root:
-        git = dir.glob('.git')
-        for g in git:
+        if (dir / '.git').exists():
             # git repo found.
             pkg_root = dir
             break
@@ -151,6 +181,19 @@ def get_config(app):
     logging.debug(config)
     return config
 
+def get_config_value(config, section, key, default):
+    """
+    Get a config value converted to the type of the given default.
+    """
+    value = config.get(section, {}).get(key)
+    if value is None:
+        return default
+    try:
+        return type(default)(value)
+    except ValueError:
+        logging.warning(f"Invalid value for [{section}] {key}: {value}; using {default}")
+        return default
+
 def set_up_logging(app):
     # Ensure log dir.
     log_dir = Path(app.log_dir)
@@ -180,13 +223,15 @@ def convert_bytes_to_human(bytes):
             break
     return {'Number': human, 'Unit': unit}
 
-def get_arch_dir_name():
-    os_proc = platform.machine()
-    if os_proc == 'x86_64':
-        arch_dir_name = 'binary-amd64'
-    else:
-        arch_dir_name = '-'.join(['binary', os_proc])
-    return arch_dir_name
+def get_arch_dir_name(arch=None):
+    """
+    Get archive folder name for the given dpkg arch, or for this machine.
+    Servers and clients both name folders by dpkg arch.
+    """
+    if not arch:
+        os_proc = platform.machine()
+        arch = DPKG_ARCHES.get(os_proc, os_proc)
+    return f"binary-{arch}"
 
 def get_config_root(app):
     # Get config root directory.
@@ -200,11 +245,52 @@ def get_config_root(app):
     logging.debug(f"Config root: {config_root}")
     return config_root
 
-def delay_if_other_sync_in_progress(old_pkgs_gz):
-    while old_pkgs_gz.is_file():
-        # Another sync is in progress.
-        logging.info(f"Another sync is in progress. Delaying for 30 s.")
-        time.sleep(30)
+def get_index_cache_file(app, dest_dir):
+    """
+    Return the stanza cache file for a LAN archive's <release>/<arch> folder.
+    """
+    dest_dir = Path(dest_dir)
+    return app.state_dir / 'index' / f"{dest_dir.parent.name}_{dest_dir.name}.cache"
+
+def write_file_atomic(file, data, sync=False):
+    """
+    Write text or bytes to file through a temp file in the same folder, so
+    that readers see either the old or the new version, never a partial one.
+    If sync is True, data is on disk before file is replaced.
+    """
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_name(f".{file.name}.tmp")
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(str(tmp), str(file))
+
+def load_cache(cache_file, empty):
+    """
+    Load a pickled cache dict, or return "empty" if cache_file isn't given,
+    is missing or unreadable, or has a different "version" than empty.
+    """
+    if not cache_file:
+        return empty
+    # Imported here so that commands that don't need it start faster.
+    import pickle
+    try:
+        with open(cache_file, 'rb') as f:
+            data = pickle.load(f)
+        if isinstance(data, dict) and data.get('version') == empty.get('version'):
+            return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable cache {cache_file}: {e}")
+    return empty
+
+def save_cache(cache_file, cache):
+    import pickle
+    write_file_atomic(cache_file, pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL))
 
 def test_exit(ret=9):
     print("(Early exit for testing.)")
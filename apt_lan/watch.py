@@ -0,0 +1,86 @@
+''' Functions related to watching folders for changes with inotify '''
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+from pathlib import Path
+
+
+# Event masks from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def get_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class Watcher():
+    """
+    Minimal inotify wrapper. Its fileno() can be passed to select() and then
+    read_events() yields (folder, file name, mask) for each event.
+    """
+    def __init__(self):
+        self.libc = get_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_init1: {os.strerror(e)}")
+        self.watches = {}
+
+    def add(self, folder, mask):
+        folder = Path(folder)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(folder)), mask | IN_ONLYDIR)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_add_watch {folder}: {os.strerror(e)}")
+        self.watches[wd] = folder
+        logging.debug(f"Watching {folder} for changes.")
+        return wd
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            # IN_Q_OVERFLOW comes with no folder; callers decide how to catch up.
+            folder = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            yield folder, name, mask
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
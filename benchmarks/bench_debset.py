@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Time the server sync package-set steps for growing numbers of packages.
+
+The time per package should stay about the same as the count grows.
+Usage: python3 benchmarks/bench_debset.py
+"""
+
+import sys
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from apt_lan import pkgs
+
+
+def make_debs(start, count):
+    return [f"pkg{i}_1.{i}-1_amd64.deb" for i in range(start, start + count)]
+
+def run_steps(n):
+    # Mimic a server sync: the archive overlaps half of the good debs; the LAN
+    #   cache and superseded list each hold a quarter of the archive.
+    good_debs = pkgs.DebSet(make_debs(0, n))
+    system_debs = make_debs(n // 2, n)
+    dest_debs = pkgs.DebSet(make_debs(n // 2, n // 4))
+    superseded_debs = pkgs.DebSet(make_debs(3 * n // 4, n // 4))
+    kept_debs = pkgs.DebSet(make_debs(n // 2, n // 8))
+
+    t_start = time.perf_counter()
+    approved_debs = pkgs.list_approved_debs(system_debs, good_debs)
+    debs_to_copy = pkgs.list_debs_to_copy(approved_debs, dest_debs)
+    debs_to_copy -= superseded_debs
+    removed_debs = dest_debs - kept_debs
+    superseded_debs |= removed_debs
+    list(superseded_debs)
+    return time.perf_counter() - t_start
+
+def main():
+    print(f"{'packages':>10} {'seconds':>10} {'us/package':>12}")
+    for n in [1000, 10000, 50000, 100000]:
+        duration = min(run_steps(n) for i in range(3))
+        print(f"{n:>10} {duration:>10.4f} {duration / n * 1e6:>12.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Time how long the apt-lan command takes to start.
+
+Runs "apt-lan --version" and a bare import of apt_lan.app in fresh
+interpreters, and lists the slow-to-import modules that a quick command
+loads. Cron-triggered runs should only pay for what they use.
+Usage: python3 benchmarks/bench_startup.py [--runs N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+# Modules that only syncs need.
+HEAVY_MODULES = [
+    'apt_lan.client', 'apt_lan.cmd', 'apt_lan.index', 'apt_lan.server',
+    'concurrent.futures', 'netifaces', 'psutil', 'subprocess', 'tempfile',
+]
+
+
+def time_runs(cmd, runs):
+    durations = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=str(REPO_DIR))
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def list_loaded(code):
+    r = subprocess.run(
+        [sys.executable, '-c', f"{code}\nimport sys\nprint(' '.join(sys.modules))"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+        cwd=str(REPO_DIR),
+    )
+    lines = r.stdout.splitlines()
+    loaded = lines[-1].split() if lines else []
+    return [m for m in HEAVY_MODULES if m in loaded]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark apt-lan startup time.")
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    benches = {
+        'python': [sys.executable, '-c', 'pass'],
+        'import apt_lan.app': [sys.executable, '-c', 'from apt_lan import app'],
+        'apt-lan --version': [sys.executable, str(REPO_DIR / 'bin' / 'apt-lan'), '--version'],
+    }
+    print(f"{'command':<20} {'min ms':>8} {'median ms':>10}")
+    for name, cmd in benches.items():
+        durations = time_runs(cmd, args.runs)
+        print(f"{name:<20} {min(durations) * 1000:>8.1f} {statistics.median(durations) * 1000:>10.1f}")
+
+    loaded = list_loaded("import sys\nsys.argv = ['apt-lan', '--version']\nfrom apt_lan import app\napp.App().run(sys.argv)")
+    print(f"Sync-only modules loaded by --version: {', '.join(loaded) or 'none'}")
+
+if __name__ == '__main__':
+    main()
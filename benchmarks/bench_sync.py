@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Time apt-lan's sync pipeline against synthetic APT caches and fake peers.
+
+Synthetic APT package lists and a system archive of small debs are generated
+in a temp folder for each package count. Then these are timed:
+    - parsing the package lists, with and without the list cache
+    - building Packages.gz, with and without the stanza cache
+    - full, incremental, changes-only and no-op server syncs
+    - peer discovery and full and incremental client syncs, against rsync
+      daemons on loopback addresses standing in for LAN peers (skipped if
+      rsync isn't installed)
+Results are saved as JSON. Given an earlier results file with --baseline,
+benchmarks that got slower by more than --threshold are reported and the
+exit status is 1.
+
+Usage: python3 benchmarks/bench_sync.py [--packages 1000 ...] [--peers 1 ...]
+"""
+
+import argparse
+import functools
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from apt_lan import client, cmd, index, metrics, peers, pkgs, server, utils
+
+
+REPO = 'http://archive.example.com/ubuntu focal main'
+RELEASE = 'focal'
+ARCH = 'amd64'
+TARGET = f"{RELEASE}/binary-{ARCH}"
+# Loopback addresses of fake peers; all of 127.0.0.0/8 reaches "lo".
+PEER_NET = '127.0.1'
+# Share of the archive that changes between full and incremental syncs.
+CHANGE_RATIO = 0.01
+# Seconds by which a benchmark must slow down to count as a regression.
+MIN_DIFFERENCE = 0.05
+
+
+class BenchApp():
+    """
+    Stand-in for apt_lan.app.App with all of its folders under root.
+    """
+    def __init__(self, root, port):
+        root = Path(root)
+        self.hostname = 'bench'
+        self.share_path = root / 'apt-lan'
+        self.state_dir = root / 'state'
+        self.store_dir = self.state_dir / 'blobs'
+        self.os_rel = RELEASE
+        self.arch_d = f"binary-{ARCH}"
+        self.deb_archives = {
+            'system': root / 'archives',
+            'lan': self.share_path / TARGET,
+        }
+        self.ports = [port]
+        self.loglevel = logging.WARNING
+        self.config = {
+            'repositories': [REPO],
+            'system': {'beacon_interval': '0', 'nice': '0', 'ionice': 'none'},
+            'network': {'beacon_wait': '0', 'nice': '0', 'ionice': 'none'},
+        }
+        self.peer_cache = None
+        self.beacons = None
+        self.metrics = None
+
+
+def make_tar(files, mode='w'):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def make_ar(members):
+    data = bytearray(b'!<arch>\n')
+    for name, content in members:
+        data += f"{name:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(content):<10}`\n".encode()
+        data += content
+        if len(content) % 2:
+            data += b'\n'
+    return bytes(data)
+
+def make_deb(dir, package, version, data_tar):
+    """
+    Write a minimal deb and return its name.
+    """
+    control = (
+        f"Package: {package}\nVersion: {version}\nArchitecture: {ARCH}\n"
+        f"Maintainer: Bench <bench@example.com>\nDescription: synthetic package\n"
+    ).encode()
+    name = pkgs.get_deb_name(package, version, ARCH)
+    (Path(dir) / name).write_bytes(make_ar([
+        ('debian-binary', b'2.0\n'),
+        ('control.tar.gz', make_tar({'./control': control}, 'w:gz')),
+        ('data.tar', data_tar),
+    ]))
+    return name
+
+def make_debs(dir, start, count, deb_size):
+    data_tar = make_tar({'./usr/share/bench/data': os.urandom(deb_size)})
+    return [make_deb(dir, f"pkg{i}", '1.0-1', data_tar) for i in range(start, start + count)]
+
+def write_packages_list(lists_dir, count):
+    """
+    Write an APT package list for REPO with twice as many packages as the
+    system archive holds, half of which are never downloaded.
+    """
+    name = pkgs.convert_repo_to_package_files(REPO, [ARCH])[0]
+    with open(Path(lists_dir) / name, 'w') as f:
+        for i in range(2 * count):
+            f.write(
+                f"Package: pkg{i}\nArchitecture: {ARCH}\nVersion: 1.0-1\n"
+                f"Priority: optional\nSection: misc\nMaintainer: Bench <bench@example.com>\n"
+                f"Filename: pool/main/p/pkg{i}/pkg{i}_1.0-1_{ARCH}.deb\n"
+                f"Size: 1000\nDescription: synthetic package\n\n"
+            )
+
+def link_tree(src, dst):
+    """
+    Mirror src into dst with hardlinks, so that many peers cost little space.
+    """
+    if dst.exists():
+        shutil.rmtree(str(dst))
+    shutil.copytree(str(src), str(dst), copy_function=os.link)
+
+
+class Results():
+    def __init__(self):
+        self.records = []
+
+    def add(self, bench, packages, seconds, peers=0, phases=None):
+        record = {'bench': bench, 'packages': packages, 'peers': peers, 'seconds': round(seconds, 4)}
+        if phases:
+            record['phases'] = phases
+        self.records.append(record)
+        print(f"{bench:<22} {packages:>8} {peers:>6} {seconds:>10.3f}", flush=True)
+
+    def time(self, bench, packages, func, *args, peers=0):
+        start = time.perf_counter()
+        ret = func(*args)
+        self.add(bench, packages, time.perf_counter() - start, peers)
+        return ret
+
+    def time_sync(self, bench, packages, app, func, *args, peers=0):
+        app.metrics = metrics.SyncMetrics(bench)
+        start = time.perf_counter()
+        ret = func(app, *args)
+        duration = time.perf_counter() - start
+        app.metrics.finish(ret)
+        self.add(bench, packages, duration, peers, app.metrics.to_dict().get('phases'))
+        app.metrics = None
+        if ret != 0:
+            logging.error(f"{bench} returned {ret}")
+        return ret
+
+
+def run_client(app, ips):
+    """
+    The part of cmd.run_client_sync that follows peer discovery.
+    """
+    dest_dir = app.share_path / TARGET
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    archives = {TARGET: {
+        'dir': dest_dir,
+        'debs': pkgs.list_archive_debs(dest_dir),
+        'pkgs_gz': dest_dir / 'Packages.gz',
+    }}
+    peer_cache = peers.PeerCache(app.state_dir / 'peers.json').load()
+    ret = cmd.sync_from_peers(app, iter(ips), peer_cache, archives, None, app.metrics)
+    peer_cache.save()
+    app.metrics.enter('index')
+    cmd.rebuild_index(app, dest_dir, cache_file=utils.get_index_cache_file(app, dest_dir))
+    return ret
+
+def start_peers(root, count, port, target_dir):
+    """
+    Start an rsync daemon for each fake peer, sharing a hardlinked copy of
+    target_dir as its TARGET folder. Returns {ip: process}.
+    """
+    procs = {}
+    for i in range(1, count + 1):
+        ip = f"{PEER_NET}.{i}"
+        peer_dir = Path(root) / 'peers' / ip
+        link_tree(target_dir, peer_dir / 'share' / TARGET)
+        conf = peer_dir / 'rsyncd.conf'
+        conf.write_text(
+            f"use chroot = no\npid file = {peer_dir / 'rsyncd.pid'}\n"
+            f"[apt-lan]\npath = {peer_dir / 'share'}\nread only = yes\n"
+        )
+        procs[ip] = subprocess.Popen(
+            ['rsync', '--daemon', '--no-detach', f'--config={conf}', f'--address={ip}', f'--port={port}'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    deadline = time.monotonic() + 10
+    for ip in procs:
+        while not client.lan_connect(ip, port, 100):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"rsync daemon at {ip}:{port} didn't start")
+            time.sleep(0.05)
+    return procs
+
+def stop_peers(procs):
+    for proc in procs.values():
+        proc.send_signal(signal.SIGTERM)
+    for proc in procs.values():
+        proc.wait()
+
+def bench_packages(results, n, peer_counts, deb_size, port):
+    root = Path(tempfile.mkdtemp(prefix='apt-lan-bench-'))
+    try:
+        app = BenchApp(root / 'server', port)
+        system_dir = app.deb_archives.get('system')
+        system_dir.mkdir(parents=True)
+        lists_dir = root / 'lists'
+        lists_dir.mkdir()
+        write_packages_list(lists_dir, n + int(n * CHANGE_RATIO) * 2)
+        make_debs(system_dir, 0, n, deb_size)
+
+        # Package lists.
+        good_debs_cache = root / 'good-debs.cache'
+        list_good_debs = functools.partial(pkgs.list_good_debs, [REPO], lists_dir=lists_dir)
+        results.time('list_good_debs_cold', n, list_good_debs, good_debs_cache)
+        results.time('list_good_debs_cached', n, list_good_debs, good_debs_cache)
+
+        # Package index.
+        index_dir = root / 'index'
+        link_tree(system_dir, index_dir)
+        index_cache = root / 'index.cache'
+        results.time('create_packages_gz_cold', n, index.create_packages_gz, index_dir, None, index_cache)
+        results.time('create_packages_gz_cached', n, index.create_packages_gz, index_dir, None, index_cache)
+
+        # Server syncs read the synthetic lists and don't touch rsyncd config.
+        orig_list_good_debs = pkgs.list_good_debs
+        orig_ensure_rsyncd_setup = server.ensure_rsyncd_setup
+        pkgs.list_good_debs = functools.partial(orig_list_good_debs, lists_dir=lists_dir)
+        server.ensure_rsyncd_setup = lambda *args: {'ready': True}
+        try:
+            results.time_sync('server_full', n, app, cmd.run_server_sync)
+            step = max(1, int(n * CHANGE_RATIO))
+            make_debs(system_dir, n, step, deb_size)
+            results.time_sync('server_incremental', n, app, cmd.run_server_sync)
+            names = make_debs(system_dir, n + step, step, deb_size)
+            results.time_sync('server_changes', n, app, cmd.run_server_changes_sync, names)
+            # Once synced, a run with nothing new should stop early.
+            cmd.run_server_sync(app)
+            results.time_sync('server_noop', n, app, cmd.run_server_sync)
+        finally:
+            pkgs.list_good_debs = orig_list_good_debs
+            server.ensure_rsyncd_setup = orig_ensure_rsyncd_setup
+
+        if not peer_counts:
+            return
+        if not shutil.which('rsync'):
+            logging.warning("rsync not found; skipping peer benchmarks.")
+            return
+        # The server's LAN archive is what every fake peer shares.
+        target_dir = app.deb_archives.get('lan')
+        for count in peer_counts:
+            procs = start_peers(root, count, port, target_dir)
+            try:
+                ips = list(procs)
+                subnet = [f"{PEER_NET}.{i}" for i in range(1, 255)]
+                results.time(
+                    'discovery', n,
+                    lambda: [ip for ip, d in client.iter_probe_hits(subnet, port, timeout=100)],
+                    peers=count,
+                )
+                client_app = BenchApp(root / f"client-{count}", port)
+                results.time_sync('client_full', n, client_app, run_client, ips, peers=count)
+
+                # Each peer gains the same new debs.
+                extra_dir = root / 'extra'
+                link_tree(target_dir, extra_dir)
+                make_debs(extra_dir, 2 * n, max(1, int(n * CHANGE_RATIO)), deb_size)
+                index.create_packages_gz(extra_dir)
+                for ip in ips:
+                    link_tree(extra_dir, root / 'peers' / ip / 'share' / TARGET)
+                shutil.rmtree(str(extra_dir))
+                results.time_sync('client_incremental', n, client_app, run_client, ips, peers=count)
+            finally:
+                stop_peers(procs)
+                shutil.rmtree(str(root / 'peers'), ignore_errors=True)
+    finally:
+        shutil.rmtree(str(root), ignore_errors=True)
+
+def compare(records, baseline_file, threshold):
+    """
+    Report benchmarks that took more than threshold times their baseline.
+    """
+    baseline = json.loads(Path(baseline_file).read_text())
+    def key(r):
+        return (r.get('bench'), r.get('packages'), r.get('peers'))
+    before = {key(r): r.get('seconds') for r in baseline.get('results', [])}
+    regressions = []
+    for record in records:
+        old = before.get(key(record))
+        # Ignore differences too small to measure reliably.
+        if old and record.get('seconds') > old * threshold and record.get('seconds') - old > MIN_DIFFERENCE:
+            regressions.append(record)
+            print(f"Regression: {record.get('bench')} at {record.get('packages')} packages, {record.get('peers')} peers: {old:.3f} s -> {record.get('seconds'):.3f} s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark apt-lan syncs with synthetic data.")
+    parser.add_argument('--packages', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--peers', type=int, nargs='*', default=[1, 10, 50])
+    parser.add_argument('--deb-size', type=int, default=4096, help="bytes of data in each deb")
+    parser.add_argument('--port', type=int, default=22022)
+    parser.add_argument('--output', default=f"bench-sync-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument('--baseline', help="earlier results file to compare with")
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    if any(p > 254 for p in args.peers):
+        parser.error("at most 254 peers")
+
+    results = Results()
+    print(f"{'benchmark':<22} {'packages':>8} {'peers':>6} {'seconds':>10}")
+    for n in args.packages:
+        bench_packages(results, n, args.peers, args.deb_size, args.port)
+    Path(args.output).write_text(json.dumps({
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'deb_size': args.deb_size,
+        'results': results.records,
+    }, indent=2) + '\n')
+    print(f"Results saved to {args.output}")
+    if args.baseline and compare(results.records, args.baseline, args.threshold):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
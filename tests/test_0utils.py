@@ -44,6 +44,53 @@ class Basic(unittest.TestCase):
             result = utils.convert_bytes_to_human(bytes[i])
             self.assertEqual(human[i], result)
 
+    def test_get_arch_dir_name(self):
+        self.assertEqual(utils.get_arch_dir_name('i386'), 'binary-i386')
+        self.assertTrue(utils.get_arch_dir_name().startswith('binary-'))
+        self.assertEqual(utils.get_arch_dir_name(utils.DPKG_ARCHES.get('aarch64')), 'binary-arm64')
+
+    def test_get_config_value(self):
+        config = {'network': {'scan_workers': '16', 'scan_timeout': 'x'}}
+        self.assertEqual(utils.get_config_value(config, 'network', 'scan_workers', 64), 16)
+        self.assertEqual(utils.get_config_value(config, 'network', 'scan_timeout', 10), 10)
+        self.assertEqual(utils.get_config_value(config, 'system', 'frequency', 'daily'), 'daily')
+
+    def test_find_script(self):
+        with tempfile.TemporaryDirectory() as etc_dir:
+            etc_dir = Path(etc_dir)
+            for name in ['cron.daily', 'cron.weekly', 'cron.d']:
+                (etc_dir / name).mkdir()
+            (etc_dir / 'cron.d' / 'apt-lan-server').touch()
+            self.assertEqual(utils.find_script('apt-lan-server', etc_dir), [])
+            # Broken links are found too.
+            (etc_dir / 'cron.weekly' / 'apt-lan-server').symlink_to(etc_dir / 'missing')
+            self.assertEqual(
+                utils.find_script('apt-lan-server', etc_dir),
+                [etc_dir / 'cron.weekly' / 'apt-lan-server'],
+            )
+
+    def test_write_file_atomic(self):
+        with tempfile.TemporaryDirectory() as d:
+            file = Path(d) / 'sub' / 'file.txt'
+            utils.write_file_atomic(file, 'text\n')
+            self.assertEqual(file.read_text(), 'text\n')
+            utils.write_file_atomic(file, b'bytes', sync=True)
+            self.assertEqual(file.read_bytes(), b'bytes')
+            self.assertEqual([f.name for f in file.parent.iterdir()], ['file.txt'])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d) / 'cache.pickle'
+            empty = {'version': 2, 'items': {}}
+            self.assertIs(utils.load_cache(None, empty), empty)
+            self.assertIs(utils.load_cache(cache_file, empty), empty)
+            utils.save_cache(cache_file, {'version': 2, 'items': {'a': 1}})
+            self.assertEqual(utils.load_cache(cache_file, empty), {'version': 2, 'items': {'a': 1}})
+            # Caches of other versions or unreadable ones are ignored.
+            self.assertIs(utils.load_cache(cache_file, {'version': 3}).get('items'), None)
+            cache_file.write_bytes(b'garbage')
+            self.assertIs(utils.load_cache(cache_file, empty), empty)
+
 class AppObj(unittest.TestCase):
     def setUp(self):
         import logging
@@ -1,6 +1,7 @@
+import subprocess
 import sys
 import unittest
-#from pathlib import Path
+from pathlib import Path
 
 from apt_lan import app
 
@@ -18,5 +19,18 @@ class AppObj(unittest.TestCase):
         self.obj.run(sys.argv)
         self.assertTrue(self.obj.args.apply)
 
+    def test_lazy_imports(self):
+        # Quick commands like --version shouldn't load the sync machinery.
+        r = subprocess.run(
+            [sys.executable, '-c', "import sys; from apt_lan import app; print(' '.join(sys.modules))"],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            cwd=str(Path(__file__).resolve().parents[1]),
+        )
+        loaded = r.stdout.split()
+        self.assertIn('apt_lan.utils', loaded)
+        for module in ['apt_lan.cmd', 'apt_lan.server', 'netifaces', 'psutil']:
+            self.assertNotIn(module, loaded)
+
     def tearDown(self):
         sys.argv = self.orig_args
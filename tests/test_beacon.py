@@ -0,0 +1,33 @@
+import unittest
+
+from apt_lan import beacon
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_decode_message(self):
+        message = {'v': beacon.BEACON_VERSION, 'host': 'lab-01', 'count': 3}
+        self.assertEqual(beacon.decode_message(beacon.encode_message(message)), message)
+        self.assertIsNone(beacon.decode_message(b'\xff'))
+        self.assertIsNone(beacon.decode_message(b'{"v": 0}'))
+
+    def test_select_beacon_ips(self):
+        b = {'release': 'focal', 'arch': 'binary-amd64', 'port': 22022, 'count': 5, 'digest': 'aa'}
+        beacons = {
+            '10.0.0.4': dict(b),
+            '10.0.0.3': dict(b, digest='bb'),
+            '10.0.0.2': dict(b, release='bionic'),
+            '10.0.0.1': dict(b, count=0),
+            '10.0.0.5': dict(b, digest='cc', ready=False),
+            '10.0.0.6': dict(b, digest='dd', ready=None),
+        }
+        new_ips, same_ips = beacon.select_beacon_ips(beacons, 'focal', 'binary-amd64', 22022, 'aa')
+        self.assertEqual(new_ips, ['10.0.0.3', '10.0.0.6'])
+        self.assertEqual(same_ips, ['10.0.0.4'])
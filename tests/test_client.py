@@ -1,4 +1,5 @@
 import psutil
+import socket
 import subprocess
 import tempfile
 import unittest
@@ -16,3 +17,12 @@ class Basic(unittest.TestCase):
 
     def tearDown(self):
         pass
+
+    def test_iter_share_ips(self):
+        # Listen on a loopback address in a small subnet.
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.3', 0))
+            sock.listen()
+            port = sock.getsockname()[1]
+            found = list(client.iter_share_ips('127.0.0.1', 29, [port], workers=2))
+        self.assertEqual(found, ['127.0.0.3'])
@@ -0,0 +1,82 @@
+import time
+import unittest
+
+from pathlib import Path
+
+from apt_lan import beacon, daemon, watch
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class FakeApp():
+    hostname = 'me'
+    deb_archives = {'system': Path('/var/cache/apt/archives')}
+    beacons = {}
+
+
+class FakeWatcher():
+    def __init__(self, events):
+        self.events = events
+
+    def read_events(self):
+        return iter(self.events)
+
+
+class FakeSocket():
+    def __init__(self, message, ip):
+        self.data = beacon.encode_message(message)
+        self.ip = ip
+
+    def recvfrom(self, size):
+        return self.data, (self.ip, beacon.MCAST_PORT)
+
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.daemon = daemon.Daemon(FakeApp())
+        self.daemon.settle = 60
+
+    def tearDown(self):
+        pass
+
+    def test_get_interval(self):
+        config = {'network': {'frequency': 'daily'}, 'system': {'frequency': 'sometimes'}}
+        self.assertEqual(daemon.get_interval(config, 'network', 'hourly'), 86400)
+        self.assertEqual(daemon.get_interval(config, 'system', 'daily'), 86400)
+        self.assertEqual(daemon.get_interval({}, 'network', 'hourly'), 3600)
+
+    def test_schedule(self):
+        self.daemon.schedule('server', 3600)
+        due = self.daemon.due['server']
+        self.daemon.schedule('server', 7200)
+        self.assertEqual(self.daemon.due['server'], due)
+        self.daemon.schedule('server', 60)
+        self.assertLess(self.daemon.due['server'], due)
+
+    def test_handle_watch_events(self):
+        archives = FakeApp.deb_archives['system']
+        self.daemon.handle_watch_events(FakeWatcher([(archives, 'lock', watch.IN_CLOSE_WRITE)]))
+        self.assertNotIn('server', self.daemon.due)
+        self.daemon.handle_watch_events(FakeWatcher([(archives, 'foo_1.0_all.deb', watch.IN_MOVED_TO)]))
+        self.assertIn('changes', self.daemon.due)
+        self.assertEqual(self.daemon.changed, {'foo_1.0_all.deb'})
+        self.daemon.handle_watch_events(FakeWatcher([(Path(daemon.LISTS_DIR), 'x_focal_main_binary-amd64_Packages', watch.IN_MOVED_TO)]))
+        self.assertIn('server', self.daemon.due)
+
+    def test_handle_watch_overflow(self):
+        self.daemon.handle_watch_events(FakeWatcher([(None, '', watch.IN_Q_OVERFLOW)]))
+        self.assertIn('server', self.daemon.due)
+        self.assertLessEqual(self.daemon.due.get('server'), time.time() + self.daemon.settle)
+
+    def test_handle_message(self):
+        message = {'v': beacon.BEACON_VERSION, 'host': 'peer', 'count': 3, 'digest': 'abc'}
+        self.daemon.handle_message(FakeSocket(message, '10.0.0.2'))
+        self.assertIn('10.0.0.2', self.daemon.app.beacons)
+        self.assertIn('client', self.daemon.due)
+        # An unchanged beacon doesn't bring the sync forward.
+        self.daemon.due['client'] = time.time() + 3600
+        self.daemon.handle_message(FakeSocket(message, '10.0.0.2'))
+        self.assertGreater(self.daemon.due['client'], time.time() + 600)
+        # Own beacons are ignored.
+        self.daemon.handle_message(FakeSocket(dict(message, host='me'), '10.0.0.3'))
+        self.assertNotIn('10.0.0.3', self.daemon.app.beacons)
@@ -0,0 +1,54 @@
+import threading
+import unittest
+
+from apt_lan import downloads
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_plan_downloads(self):
+        mb = 1048576
+        listings = {
+            '10.0.0.1': {'a.deb': 40 * mb, 'b.deb': 30 * mb, 'c.deb': 20 * mb, 'd.deb': 10 * mb},
+            '10.0.0.2': {'a.deb': 40 * mb, 'b.deb': 30 * mb, 'c.deb': 20 * mb},
+            '10.0.0.3': {'d.deb': 10 * mb, 'e.deb': 1 * mb},
+        }
+        plan = downloads.plan_downloads(listings)
+        # Each deb is planned exactly once.
+        planned = [d for debs in plan.values() for d in debs]
+        self.assertEqual(sorted(planned), ['a.deb', 'b.deb', 'c.deb', 'd.deb', 'e.deb'])
+        # Load is spread across peers.
+        self.assertEqual(list(plan['10.0.0.1']), ['a.deb'])
+        self.assertEqual(list(plan['10.0.0.2']), ['b.deb', 'c.deb'])
+        self.assertEqual(list(plan['10.0.0.3']), ['d.deb', 'e.deb'])
+
+    def test_plan_downloads_latency(self):
+        listings = {
+            '10.0.0.1': {'a.deb': 100, 'b.deb': 100},
+            '10.0.0.2': {'a.deb': 100, 'b.deb': 100},
+        }
+        plan = downloads.plan_downloads(listings, {'10.0.0.1': 0.001, '10.0.0.2': 0.5})
+        self.assertEqual(list(plan), ['10.0.0.1'])
+
+    def test_run_downloads(self):
+        lock = threading.Lock()
+        active = []
+        peak = []
+        def fetch(ip, debs):
+            with lock:
+                active.append(ip)
+                peak.append(len(active))
+            with lock:
+                active.remove(ip)
+            return len(debs)
+        plan = {f"10.0.0.{i}": ['a.deb'] * i for i in range(1, 6)}
+        results = downloads.run_downloads(plan, fetch, parallel=2)
+        self.assertEqual(results, {ip: len(debs) for ip, debs in plan.items()})
+        self.assertLessEqual(max(peak), 2)
@@ -0,0 +1,61 @@
+import socket
+import tempfile
+import threading
+import unittest
+
+from pathlib import Path
+
+from apt_lan import health
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+def serve_module_list(server):
+    conn, addr = server.accept()
+    with conn:
+        f = conn.makefile('rwb')
+        f.write(b'@RSYNCD: 31.0\n')
+        f.flush()
+        f.readline() # client greeting
+        f.readline() # "#list"
+        f.write(b'Welcome to apt-lan\napt-lan        \tSoftware updates\n@RSYNCD: EXIT\n')
+        f.flush()
+
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tempdir.name)
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.tempdir.cleanup()
+
+    def test_probe_rsyncd(self):
+        t = threading.Thread(target=serve_module_list, args=(self.server,))
+        t.start()
+        status = health.probe_rsyncd('127.0.0.1', self.port)
+        t.join()
+        self.assertTrue(status.get('listening'))
+        self.assertEqual(status.get('version'), '31.0')
+        self.assertEqual(status.get('modules'), ['apt-lan'])
+
+    def test_probe_closed_port(self):
+        self.server.close()
+        status = health.probe_rsyncd('127.0.0.1', self.port)
+        self.assertFalse(status.get('listening'))
+        self.assertIn('error', status)
+
+    def test_status_and_prometheus(self):
+        self.assertIsNone(health.is_ready(self.dir))
+        status = {'listening': True, 'ready': False, 'checked': 1.5, 'port': 22000}
+        health.save_status(self.dir, status)
+        self.assertIs(health.is_ready(self.dir), False)
+        prom = health.format_prometheus(status)
+        self.assertIn('apt_lan_rsyncd_up{port="22000"} 1\n', prom)
+        self.assertIn('apt_lan_rsyncd_ready{port="22000"} 0\n', prom)
+        self.assertIn('apt_lan_rsyncd_last_check_timestamp_seconds{port="22000"} 1.5\n', prom)
@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import io
+import lzma
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import index
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+def make_tar(files, mode='w:gz'):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def make_deb(dir, package, version, arch, control_mode='w:xz'):
+    """
+    Write a minimal deb to dir and return its path.
+    """
+    control = (
+        f"Package: {package}\nVersion: {version}\nArchitecture: {arch}\n"
+        f"Maintainer: Test <test@example.com>\nDescription: test package\n more text\n"
+    ).encode()
+    members = [
+        ('debian-binary', b'2.0\n'),
+        (f"control.tar.{control_mode[-2:]}", make_tar({'./control': control}, control_mode)),
+        ('data.tar.gz', make_tar({'./usr/share/doc/x': package.encode()})),
+    ]
+    name = f"{package}_{version.replace(':', '%3a')}_{arch}.deb"
+    path = Path(dir) / name
+    with open(path, 'wb') as f:
+        f.write(b'!<arch>\n')
+        for member, data in members:
+            f.write(f"{member:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n".encode())
+            f.write(data)
+            if len(data) % 2:
+                f.write(b'\n')
+    return path
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_compare_versions(self):
+        ordered = ['1.0~rc1', '1.0', '1.0-1', '1.0-1ubuntu1', '1.0.1', '1.10', '1:0.9']
+        for a, b in zip(ordered, ordered[1:]):
+            self.assertLess(index.compare_versions(a, b), 0, f"{a} < {b}")
+            self.assertGreater(index.compare_versions(b, a), 0, f"{b} > {a}")
+        self.assertEqual(index.compare_versions('1.01', '1.1'), 0)
+
+    def test_scan_deb(self):
+        deb = make_deb(self.dir, 'foo', '1:1.0-1', 'all')
+        stanza = index.scan_deb(deb)
+        self.assertEqual(list(stanza)[:4], ['Package', 'Version', 'Architecture', 'Maintainer'])
+        self.assertEqual(stanza['Filename'], str(deb))
+        self.assertEqual(stanza['Size'], str(deb.stat().st_size))
+        self.assertEqual(stanza['Description'], 'test package\n more text')
+
+    def test_scan_deb_matches_dpkg_scanpackages(self):
+        if not shutil.which('dpkg-scanpackages'):
+            self.skipTest("dpkg-scanpackages not installed")
+        make_deb(self.dir, 'foo', '1:1.0-1', 'all', 'w:gz')
+        make_deb(self.dir, 'bar', '2.0', 'amd64')
+        r = subprocess.run(
+            ['dpkg-scanpackages', '--multiversion', str(self.dir)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+        stanzas = index.scan_debs(self.dir)
+        self.assertEqual(index.format_packages(stanzas), r.stdout)
+
+    def test_newest_debs(self):
+        for version in ['1.0', '1.2', '1.10']:
+            make_deb(self.dir, 'foo', version, 'amd64')
+        make_deb(self.dir, 'foo', '1.1', 'i386')
+        make_deb(self.dir, 'bar', '1.0', 'all')
+        make_deb(self.dir, 'bar', '0.9', 'all')
+        stanzas = index.scan_debs(self.dir)
+        kept = index.newest_debs(stanzas, ['amd64', 'i386'])
+        self.assertEqual(list(kept), ['bar_1.0_all.deb', 'foo_1.10_amd64.deb', 'foo_1.1_i386.deb'])
+
+    def test_scan_debs_cache(self):
+        debs_dir = self.dir / 'debs'
+        debs_dir.mkdir()
+        cache_file = self.dir / 'index.cache'
+        make_deb(debs_dir, 'foo', '1.0', 'amd64')
+        make_deb(debs_dir, 'bar', '1.0', 'all')
+        full = index.scan_debs(debs_dir, cache_file=cache_file)
+        self.assertEqual(index.create_packages_gz(debs_dir, cache_file=cache_file), 0)
+        self.assertEqual(index.verify_stanza_cache(debs_dir, cache_file), [])
+
+        # Cached stanzas are used for unchanged debs.
+        orig_scan_deb = index.scan_deb
+        scanned = []
+        def scan_deb(file, prefix=None):
+            scanned.append(Path(file).name)
+            return orig_scan_deb(file, prefix)
+        index.scan_deb = scan_deb
+        try:
+            make_deb(debs_dir, 'baz', '1.0', 'all')
+            (debs_dir / 'bar_1.0_all.deb').unlink()
+            stanzas = index.scan_debs(debs_dir, cache_file=cache_file)
+        finally:
+            index.scan_deb = orig_scan_deb
+        self.assertEqual(scanned, ['baz_1.0_all.deb'])
+        self.assertEqual(stanzas['foo_1.0_amd64.deb'], full['foo_1.0_amd64.deb'])
+        self.assertEqual(sorted(stanzas), ['baz_1.0_all.deb', 'foo_1.0_amd64.deb'])
+
+        # Packages.gz is now out of date.
+        problems = index.verify_stanza_cache(debs_dir, cache_file)
+        self.assertEqual(problems, [f"{debs_dir / 'Packages.gz'}: differs from rescan"])
+
+    def test_update_stanzas(self):
+        debs_dir = self.dir / 'debs'
+        debs_dir.mkdir()
+        cache_file = self.dir / 'index.cache'
+        make_deb(debs_dir, 'foo', '1.0', 'amd64')
+        make_deb(debs_dir, 'bar', '1.0', 'all')
+        # Without a cache the whole folder is scanned.
+        stanzas = index.update_stanzas(debs_dir, added=['bar_1.0_all.deb'], cache_file=cache_file)
+        self.assertEqual(sorted(stanzas), ['bar_1.0_all.deb', 'foo_1.0_amd64.deb'])
+
+        make_deb(debs_dir, 'baz', '1.0', 'all')
+        (debs_dir / 'bar_1.0_all.deb').unlink()
+        stanzas = index.update_stanzas(
+            debs_dir,
+            added=['baz_1.0_all.deb'],
+            removed=['bar_1.0_all.deb'],
+            cache_file=cache_file,
+        )
+        self.assertEqual(sorted(stanzas), ['baz_1.0_all.deb', 'foo_1.0_amd64.deb'])
+        self.assertEqual(stanzas, index.scan_debs(debs_dir))
+        self.assertEqual(index.create_packages_gz(debs_dir, stanzas), 0)
+        self.assertEqual(index.verify_stanza_cache(debs_dir, cache_file), [])
+
+    def test_sort_stanza_names(self):
+        stanzas = {
+            'foo_1.10_amd64.deb': {'Package': 'foo', 'Version': '1.10', 'Architecture': 'amd64'},
+            'foo-bar_1.0_amd64.deb': {'Package': 'foo-bar', 'Version': '1.0', 'Architecture': 'amd64'},
+            'foo_1.9_amd64.deb': {'Package': 'foo', 'Version': '1.9', 'Architecture': 'amd64'},
+            'foo_1.9_i386.deb': {'Package': 'foo', 'Version': '1.9', 'Architecture': 'i386'},
+        }
+        # Package names sort before the "_" of file names; versions sort as dpkg does.
+        self.assertEqual(index.sort_stanza_names(stanzas), [
+            'foo_1.9_amd64.deb', 'foo_1.9_i386.deb', 'foo_1.10_amd64.deb', 'foo-bar_1.0_amd64.deb',
+        ])
+
+    def test_write_indexes(self):
+        debs_dir = self.dir / 'debs'
+        debs_dir.mkdir()
+        make_deb(debs_dir, 'foo', '1.0', 'amd64')
+        make_deb(debs_dir, 'bar', '1.0', 'all')
+        stanzas = index.scan_debs(debs_dir)
+        text = index.format_packages(stanzas).encode()
+        self.assertEqual(index.create_packages_gz(debs_dir, stanzas, formats=['xz', 'bogus']), 0)
+        self.assertEqual(gzip.decompress((debs_dir / 'Packages.gz').read_bytes()), text)
+        self.assertEqual(lzma.decompress((debs_dir / 'Packages.xz').read_bytes()), text)
+        self.assertEqual(list(debs_dir.glob('.*.tmp')), [])
+
+        # Release lists the hash and size of each index.
+        release = (debs_dir / 'Release').read_text()
+        for name in ['Packages', 'Packages.gz', 'Packages.xz']:
+            data = text if name == 'Packages' else (debs_dir / name).read_bytes()
+            self.assertIn(f" {hashlib.sha256(data).hexdigest()} {len(data):>16} {name}\n", release)
+
+        # Unchanged indexes keep their hashes; dropped formats are removed.
+        gz_hash = hashlib.sha256((debs_dir / 'Packages.gz').read_bytes()).hexdigest()
+        self.assertEqual(index.create_packages_gz(debs_dir, stanzas), 0)
+        self.assertEqual(hashlib.sha256((debs_dir / 'Packages.gz').read_bytes()).hexdigest(), gz_hash)
+        self.assertFalse((debs_dir / 'Packages.xz').exists())
+        self.assertNotIn('Packages.xz', (debs_dir / 'Release').read_text())
+
+    def test_write_indexes_by_hash(self):
+        debs_dir = self.dir / 'debs'
+        debs_dir.mkdir()
+        by_hash = debs_dir / index.BY_HASH_DIR
+        gz_hashes = []
+        for version in ['1.0', '1.1', '1.2']:
+            make_deb(debs_dir, 'foo', version, 'amd64')
+            hashes = index.write_indexes(debs_dir, index.scan_debs(debs_dir), formats=['xz'])
+            gz_hashes.append(hashes.get('Packages.gz')[0])
+            # Every compressed index that Release lists is there by hash.
+            listed = index.read_release_hashes(debs_dir / 'Release')
+            self.assertEqual(listed, {h for h, s in hashes.values()})
+            for name in ['Packages.gz', 'Packages.xz']:
+                self.assertEqual((by_hash / hashes.get(name)[0]).read_bytes(), (debs_dir / name).read_bytes())
+        self.assertIn('Acquire-By-Hash: yes\n', (debs_dir / 'Release').read_text())
+        # Only the current and previous generations are kept.
+        self.assertEqual(len(list(by_hash.iterdir())), 4)
+        self.assertFalse((by_hash / gz_hashes[0]).exists())
+        self.assertTrue((by_hash / gz_hashes[1]).exists())
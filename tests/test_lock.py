@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from pathlib import Path
+
+from apt_lan import lock
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+HOLDER = """
+import sys, time
+from apt_lan import lock
+with lock.SyncLock(sys.argv[1]):
+    print('locked', flush=True)
+    time.sleep(float(sys.argv[2]))
+"""
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.lock_file = Path(self.tempdir.name) / 'sync.lock'
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def start_holder(self, seconds):
+        holder = subprocess.Popen(
+            [sys.executable, '-c', HOLDER, str(self.lock_file), str(seconds)],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        holder.stdout.readline()
+        return holder
+
+    def test_acquire_and_release(self):
+        sync_lock = lock.SyncLock(self.lock_file)
+        with sync_lock as acquired:
+            self.assertTrue(acquired)
+            pid, since = sync_lock.read_owner()
+            self.assertEqual(pid, os.getpid())
+            self.assertLessEqual(since, time.time())
+        self.assertEqual(sync_lock.read_owner(), (None, None))
+        # The lock can be taken again once released.
+        with lock.SyncLock(self.lock_file) as acquired:
+            self.assertTrue(acquired)
+
+    def test_timeout(self):
+        holder = self.start_holder(5)
+        try:
+            sync_lock = lock.SyncLock(self.lock_file, timeout=0.2)
+            self.assertFalse(sync_lock.acquire())
+            self.assertEqual(sync_lock.read_owner()[0], holder.pid)
+        finally:
+            holder.kill()
+            holder.wait()
+            holder.stdout.close()
+
+    def test_wait_for_holder(self):
+        holder = self.start_holder(0.3)
+        start = time.monotonic()
+        with lock.SyncLock(self.lock_file, timeout=10) as acquired:
+            self.assertTrue(acquired)
+            self.assertLess(time.monotonic() - start, 5)
+        holder.wait()
+        holder.stdout.close()
+
+    def test_dead_holder(self):
+        holder = self.start_holder(60)
+        holder.kill()
+        holder.wait()
+        holder.stdout.close()
+        # The kernel drops the flock of a killed process.
+        with lock.SyncLock(self.lock_file, timeout=1) as acquired:
+            self.assertTrue(acquired)
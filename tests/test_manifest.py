@@ -0,0 +1,56 @@
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import manifest
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dest_dir = Path(self.tempdir.name)
+        self.stanzas = {
+            'foo_1.0_all.deb': {
+                'Package': 'foo',
+                'Version': '1.0',
+                'Architecture': 'all',
+                'Size': '1234',
+                'SHA256': 'ab' * 32,
+                'Description': 'not in manifest',
+            },
+        }
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_write_read_manifest(self):
+        file = self.dest_dir / manifest.MANIFEST_NAME
+        self.assertEqual(manifest.read_manifest(file), (0, None))
+        generation = manifest.write_manifest(self.dest_dir, self.stanzas)
+        self.assertGreater(generation, 0)
+        gen, debs = manifest.read_manifest(file)
+        self.assertEqual(gen, generation)
+        self.assertEqual(debs, {
+            'foo_1.0_all.deb': {
+                'Size': 1234,
+                'SHA256': 'ab' * 32,
+                'Package': 'foo',
+                'Version': '1.0',
+                'Architecture': 'all',
+            },
+        })
+
+    def test_generation(self):
+        generation = manifest.write_manifest(self.dest_dir, self.stanzas)
+        self.assertEqual(manifest.write_manifest(self.dest_dir, self.stanzas), generation)
+        self.stanzas['bar_2.0_all.deb'] = dict(self.stanzas['foo_1.0_all.deb'], Package='bar')
+        self.assertGreater(manifest.write_manifest(self.dest_dir, self.stanzas), generation)
+
+    def test_invalid_manifest(self):
+        file = self.dest_dir / manifest.MANIFEST_NAME
+        file.write_bytes(b'not gzip')
+        self.assertEqual(manifest.read_manifest(file), (0, None))
+        self.assertGreater(manifest.write_manifest(self.dest_dir, self.stanzas), 0)
@@ -0,0 +1,79 @@
+import json
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import metrics
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class FakeApp():
+    config = {}
+    metrics = None
+    profile = None
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_phases_and_counters(self):
+        sync_metrics = metrics.SyncMetrics('client')
+        sync_metrics.enter('list')
+        sync_metrics.enter('download')
+        sync_metrics.count('bytes_downloaded', 100, peer='10.0.0.2')
+        sync_metrics.count('bytes_downloaded', 50, peer='10.0.0.3')
+        sync_metrics.enter('list')
+        sync_metrics.finish(0)
+        record = sync_metrics.to_dict()
+        self.assertEqual(list(record.get('phases')), ['list', 'download'])
+        self.assertEqual(record.get('counters'), {'bytes_downloaded': 150})
+        self.assertEqual(record.get('peers').get('10.0.0.3'), {'bytes_downloaded': 50})
+        self.assertGreaterEqual(record.get('duration'), sum(record.get('phases').values()) - 0.01)
+
+        prom = metrics.format_prometheus(sync_metrics)
+        self.assertIn('apt_lan_sync_success{kind="client"} 1\n', prom)
+        self.assertIn('apt_lan_sync_peer_count{kind="client",peer="10.0.0.2",counter="bytes_downloaded"} 100\n', prom)
+        self.assertIn('# TYPE apt_lan_sync_phase_seconds gauge\n', prom)
+
+    def test_run_measured(self):
+        app = FakeApp(self.dir / 'state')
+        def sync(app, arg):
+            app.metrics.enter('place')
+            app.metrics.count('debs_placed', arg)
+            raise RuntimeError
+        with self.assertRaises(RuntimeError):
+            metrics.run_measured(app, 'server', sync, 3)
+        self.assertIsNone(app.metrics)
+        record = json.loads((self.dir / 'state' / 'metrics' / 'server.json').read_text())
+        self.assertEqual(record.get('result'), 1)
+        self.assertEqual(record.get('counters'), {'debs_placed': 3})
+        self.assertEqual(metrics.run_measured(app, 'server', lambda app: 0), 0)
+        runs = (self.dir / 'state' / 'metrics' / metrics.RUNS_NAME).read_text().splitlines()
+        self.assertEqual([json.loads(r).get('result') for r in runs], [1, 0])
+
+    def test_run_history_limit(self):
+        runs = self.dir / metrics.RUNS_NAME
+        for i in range(5):
+            metrics.append_run_record(runs, {'run': i}, max_runs=3)
+        self.assertEqual([json.loads(r).get('run') for r in runs.read_text().splitlines()], [2, 3, 4])
+
+    def test_memory_peaks(self):
+        sync_metrics = metrics.SyncMetrics('server', traced_phases=['list'])
+        sync_metrics.enter('list')
+        data = [bytearray(1048576) for i in range(4)]
+        del data
+        sync_metrics.enter('place')
+        sync_metrics.finish(0)
+        peaks = sync_metrics.to_dict().get('memory_peaks')
+        self.assertEqual(list(peaks), ['list'])
+        self.assertGreaterEqual(peaks.get('list'), 4 * 1048576)
@@ -0,0 +1,42 @@
+import tempfile
+import time
+import unittest
+
+from pathlib import Path
+
+from apt_lan import peers
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file = Path(self.tempdir.name) / 'peers.json'
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_peer_cache_roundtrip(self):
+        cache = peers.PeerCache(self.file).load()
+        self.assertEqual(cache.peers, {})
+        cache.record_seen('10.0.0.5', latency=0.004, pkg_count=12)
+        cache.record_seen('10.0.0.2', latency=0.002)
+        cache.record_seen('10.0.0.9', latency=0.001)
+        cache.record_failure('10.0.0.9')
+        cache.record_generation('10.0.0.5', 'focal/binary-amd64', 42)
+        cache.save()
+
+        cache = peers.PeerCache(self.file).load()
+        self.assertEqual(cache.peers['10.0.0.5']['pkg_count'], 12)
+        self.assertEqual(cache.get_generation('10.0.0.5', 'focal/binary-amd64'), 42)
+        self.assertEqual(cache.get_generation('10.0.0.5', 'focal/binary-i386'), 0)
+        self.assertEqual(cache.ranked(), ['10.0.0.2', '10.0.0.5', '10.0.0.9'])
+
+    def test_peer_cache_expire(self):
+        cache = peers.PeerCache(self.file)
+        cache.record_seen('10.0.0.5')
+        cache.record_seen('10.0.0.6')
+        cache.peers['10.0.0.6']['last_seen'] = time.time() - 3600
+        cache.expire(60)
+        self.assertEqual(list(cache.peers), ['10.0.0.5'])
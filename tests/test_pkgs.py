@@ -1,3 +1,6 @@
+import gzip
+import lzma
+import tempfile
 import unittest
 from pathlib import Path
 
@@ -6,6 +9,19 @@ from apt_lan import pkgs, utils
 # Assert*() methods here:
 # https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
 
+PACKAGES_LIST = """Package: foo
+Architecture: amd64
+Version: 1:1.0-1
+Description: foo
+ Package: not-a-field
+Filename: pool/main/f/foo/foo_1.0-1_amd64.deb
+
+Package: bar
+Version: 2.0
+Architecture: all
+Filename: pool/main/b/bar/bar_2.0_all.deb
+"""
+
 class Basic(unittest.TestCase):
     def setUp(self):
         pass
@@ -69,3 +85,95 @@ class Basic(unittest.TestCase):
         for pkg_list in pkg_lists:
             match = pkgs.match_filename(approved, pkg_list)
             self.assertTrue(match)
+
+    def test_match_filename_compressed(self):
+        approved = 'archive.ubuntu.com_ubuntu_dists_focal_main_binary-amd64_Packages'
+        files = [f"{approved}.gz", f"{approved}.lz4", 'other_Packages']
+        self.assertEqual(pkgs.match_filename(approved, files), f"{approved}.lz4")
+        files.append(approved)
+        self.assertEqual(pkgs.match_filename(approved, files), approved)
+
+    def test_iter_packages_list(self):
+        expected = [
+            ('foo', '1:1.0-1', 'amd64', 'pool/main/f/foo/foo_1.0-1_amd64.deb'),
+            ('bar', '2.0', 'all', 'pool/main/b/bar/bar_2.0_all.deb'),
+        ]
+        data = PACKAGES_LIST.encode()
+        with tempfile.TemporaryDirectory() as d:
+            files = {
+                Path(d) / 'x_Packages': data,
+                Path(d) / 'x_Packages.gz': gzip.compress(data),
+                Path(d) / 'x_Packages.xz': lzma.compress(data),
+            }
+            for file, content in files.items():
+                file.write_bytes(content)
+                self.assertEqual(list(pkgs.iter_packages_list(file)), expected)
+            empty = Path(d) / 'empty_Packages'
+            empty.touch()
+            self.assertEqual(list(pkgs.iter_packages_list(empty)), [])
+
+    def test_get_deb_name(self):
+        self.assertEqual(pkgs.get_deb_name('foo', '1:1.0-1', 'amd64'), 'foo_1%3a1.0-1_amd64.deb')
+
+    def test_list_repo_releases(self):
+        repos = [
+            'http://archive.ubuntu.com/ubuntu focal-updates main universe',
+            'http://archive.ubuntu.com/ubuntu jammy main',
+            'http://archive.ubuntu.com/ubuntu bionic-security main',
+            'https://repo.skype.com/deb stable main',
+            'http://deb.debian.org/debian oldstable main',
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            lists_dir = Path(d)
+            for repo in repos[:2] + repos[3:]:
+                name = pkgs.convert_repo_to_package_files(repo, ['amd64'])[0]
+                (lists_dir / name).write_text(PACKAGES_LIST)
+            (lists_dir / 'archive.ubuntu.com_ubuntu_dists_focal-updates_InRelease').write_text(
+                "-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\nSuite: focal-updates\nCodename: focal\n"
+            )
+            (lists_dir / 'repo.skype.com_deb_dists_stable_InRelease').write_text("Codename: stable\n")
+            (lists_dir / 'deb.debian.org_debian_dists_oldstable_Release').write_text("Suite: oldstable\nCodename: bullseye\nSHA256:\n 00 1 main\n")
+            # bionic has no lists, and skype's suite isn't a release.
+            self.assertEqual(pkgs.list_repo_releases(repos, ['amd64'], lists_dir), ['bullseye', 'focal', 'jammy'])
+            self.assertEqual(pkgs.list_repo_releases(repos, ['i386'], lists_dir), [])
+            self.assertEqual(pkgs.list_repo_releases(None, ['amd64'], lists_dir), [])
+
+    def test_list_good_debs_cache(self):
+        repo = 'http://archive.ubuntu.com/ubuntu focal main'
+        arch = pkgs.get_dpkg_arches()[0]
+        list_name = pkgs.convert_repo_to_package_files(repo, [arch])[0]
+        with tempfile.TemporaryDirectory() as d:
+            lists_dir = Path(d) / 'lists'
+            lists_dir.mkdir()
+            cache_file = Path(d) / 'good-debs.cache'
+            pkg_list = lists_dir / list_name
+            pkg_list.write_text(PACKAGES_LIST)
+
+            expected = {'foo_1%3a1.0-1_amd64.deb', 'bar_2.0_all.deb'}
+            good_debs = pkgs.list_good_debs([repo], cache_file, lists_dir)
+            self.assertEqual(good_debs, expected)
+            self.assertTrue(cache_file.is_file())
+            # Unchanged lists are read from cache.
+            self.assertEqual(pkgs.list_good_debs([repo], cache_file, lists_dir), expected)
+
+            # Changed lists are parsed again.
+            pkg_list.unlink()
+            pkg_list.write_text(PACKAGES_LIST.split('\n\n')[1])
+            good_debs = pkgs.list_good_debs([repo], cache_file, lists_dir)
+            self.assertEqual(good_debs, {'bar_2.0_all.deb'})
+
+    def test_debset(self):
+        a = pkgs.DebSet(['c_1_all.deb', 'a_1_all.deb', 'b_1_all.deb'])
+        b = pkgs.DebSet(['b_1_all.deb', 'd_1_all.deb'])
+        self.assertEqual(list(a), ['a_1_all.deb', 'b_1_all.deb', 'c_1_all.deb'])
+        for result in [a | b, a & b, a - b, a ^ b, a.union(b), a.difference(['a_1_all.deb'])]:
+            self.assertIsInstance(result, pkgs.DebSet)
+        self.assertEqual(list(a - b), ['a_1_all.deb', 'c_1_all.deb'])
+        self.assertEqual(pkgs.list_approved_debs(['x.deb', 'a_1_all.deb'], a), {'a_1_all.deb'})
+        self.assertEqual(pkgs.list_debs_to_copy(a, b), {'a_1_all.deb', 'c_1_all.deb'})
+
+        with tempfile.TemporaryDirectory() as d:
+            file = Path(d) / 'superseded.txt'
+            a.write(file)
+            self.assertEqual(file.read_text(), 'a_1_all.deb\nb_1_all.deb\nc_1_all.deb\n')
+            self.assertEqual(pkgs.get_superseded_debs(file), a)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import placement
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.src_dir = Path(self.tempdir.name) / 'src'
+        self.dst_dir = Path(self.tempdir.name) / 'dst'
+        self.src_dir.mkdir()
+        self.dst_dir.mkdir()
+        self.src = self.src_dir / 'foo_1.0_all.deb'
+        self.src.write_bytes(os.urandom(300000))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_probe_strategy_same_fs(self):
+        self.assertEqual(placement.probe_strategy(self.src, self.dst_dir), 'hardlink')
+        self.assertEqual(list(self.dst_dir.iterdir()), [])
+
+    def test_place_file(self):
+        for strategy in placement.STRATEGIES:
+            used = placement.place_file(self.src, self.dst_dir, strategy)
+            dst = self.dst_dir / self.src.name
+            self.assertEqual(dst.read_bytes(), self.src.read_bytes())
+            if used == 'hardlink':
+                self.assertTrue(os.path.samefile(str(dst), str(self.src)))
+            else:
+                self.assertFalse(os.path.samefile(str(dst), str(self.src)))
+            dst.unlink()
+        self.assertEqual(list(self.dst_dir.iterdir()), [])
+
+    def test_get_bytes_needed(self):
+        self.assertEqual(placement.get_bytes_needed('hardlink', 1000), 0)
+        self.assertEqual(placement.get_bytes_needed('reflink', 1000), 0)
+        self.assertEqual(placement.get_bytes_needed('copy', 1000), 1000)
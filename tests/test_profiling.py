@@ -0,0 +1,46 @@
+import pstats
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import profiling
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class FakeApp():
+    pkg_name = 'apt-lan'
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+
+
+def busy_work():
+    return sum(i * i for i in range(10000))
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tempdir.name)
+        self.app = FakeApp(self.dir / 'log')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_run_profiled(self):
+        stats_file = self.dir / 'sync.pstats'
+        with self.assertLogs(level='INFO') as logs:
+            ret = profiling.run_profiled(self.app, busy_work, str(stats_file))
+        self.assertEqual(ret, busy_work())
+        functions = [f[2] for f in pstats.Stats(str(stats_file)).stats]
+        self.assertIn('busy_work', functions)
+        self.assertTrue(any('busy_work' in line for line in logs.output))
+
+    def test_default_stats_file(self):
+        stats_file = profiling.get_stats_file(self.app, '')
+        self.assertEqual(stats_file.parent, self.dir / 'log')
+        self.assertEqual(stats_file.suffix, '.pstats')
+        with self.assertLogs(level='INFO'):
+            profiling.run_profiled(self.app, busy_work)
+        self.assertEqual(len(list((self.dir / 'log').glob('*.pstats'))), 1)
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import store
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.share_dir = Path(self.tempdir.name)
+        self.store_dir = self.share_dir / 'state' / 'blobs'
+        self.focal_dir = Path(self.tempdir.name) / 'focal' / 'binary-amd64'
+        self.jammy_dir = Path(self.tempdir.name) / 'jammy' / 'binary-amd64'
+        self.focal_dir.mkdir(parents=True)
+        self.jammy_dir.mkdir(parents=True)
+        self.name = 'foo_1.0_all.deb'
+        self.data = os.urandom(10000)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.stanzas = {self.name: {'SHA256': self.sha256, 'Size': str(len(self.data))}}
+        (self.focal_dir / self.name).write_bytes(self.data)
+        (self.jammy_dir / self.name).write_bytes(self.data)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_add_files(self):
+        self.assertEqual(store.add_files(self.store_dir, self.focal_dir, self.stanzas), 0)
+        self.assertTrue(store.have_blob(self.store_dir, self.sha256))
+        freed = store.add_files(self.store_dir, self.jammy_dir, self.stanzas)
+        self.assertEqual(freed, len(self.data))
+        self.assertTrue(os.path.samefile(str(self.focal_dir / self.name), str(self.jammy_dir / self.name)))
+        self.assertEqual((self.jammy_dir / self.name).read_bytes(), self.data)
+        self.assertEqual(store.get_space_saved(self.store_dir, self.share_dir), len(self.data))
+        # Adding again changes nothing.
+        self.assertEqual(store.add_files(self.store_dir, self.jammy_dir, self.stanzas), 0)
+
+    def test_link_from_store(self):
+        dst = self.jammy_dir / 'bar_1.0_all.deb'
+        self.assertFalse(store.link_from_store(self.store_dir, self.sha256, dst))
+        self.assertFalse(store.link_from_store(self.store_dir, None, dst))
+        store.add_files(self.store_dir, self.focal_dir, self.stanzas)
+        self.assertTrue(store.link_from_store(self.store_dir, self.sha256, dst))
+        self.assertEqual(dst.read_bytes(), self.data)
+
+    def test_prune(self):
+        store.add_files(self.store_dir, self.focal_dir, self.stanzas)
+        self.assertEqual(store.prune(self.store_dir, self.share_dir), 0)
+        (self.focal_dir / self.name).unlink()
+        self.assertEqual(store.prune(self.store_dir, self.share_dir), 1)
+        self.assertFalse(store.have_blob(self.store_dir, self.sha256))
+
+    def test_apt_archive_links(self):
+        # Debs placed from APT's archive are hardlinked from there too.
+        apt_dir = Path(self.tempdir.name) / 'apt-archives'
+        apt_dir.mkdir()
+        (self.jammy_dir / self.name).unlink()
+        os.link(str(self.focal_dir / self.name), str(apt_dir / self.name))
+        store.add_files(self.store_dir, self.focal_dir, self.stanzas)
+        self.assertEqual(store.get_space_saved(self.store_dir, self.share_dir), 0)
+        # The blob goes once no archive folder uses it, whatever APT keeps.
+        (self.focal_dir / self.name).unlink()
+        self.assertEqual(store.prune(self.store_dir, self.share_dir), 1)
+        self.assertEqual((apt_dir / self.name).read_bytes(), self.data)
+
+    def test_bandwidth_saved(self):
+        store.record_bandwidth_saved(self.store_dir, 100)
+        store.record_bandwidth_saved(self.store_dir, 50)
+        self.assertEqual(store.load_stats(self.store_dir).get('bandwidth_saved'), 150)
+        # Stats file isn't mistaken for a blob.
+        self.assertEqual(store.prune(self.store_dir, self.share_dir), 0)
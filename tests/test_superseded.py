@@ -0,0 +1,71 @@
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import superseded
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dest_dir = Path(self.tempdir.name)
+        self.debs = [f"pkg{i}_1.0_amd64.deb" for i in range(3000)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_bloom_filter(self):
+        bloom = superseded.BloomFilter(len(self.debs))
+        for deb in self.debs:
+            bloom.add(deb)
+        for deb in self.debs:
+            self.assertIn(deb, bloom)
+        others = [f"other{i}_1.0_amd64.deb" for i in range(3000)]
+        false_positives = sum(1 for o in others if o in bloom)
+        self.assertLess(false_positives, 100)
+
+    def test_append_and_lookup(self):
+        log = superseded.SupersededLog(self.dest_dir).load()
+        self.assertEqual(log.append(self.debs), 3000)
+        self.assertEqual(log.append(self.debs[:10] + ['new_1.0_all.deb']), 1)
+        log = superseded.SupersededLog(self.dest_dir).load()
+        self.assertEqual(len(log), 3001)
+        self.assertIn('new_1.0_all.deb', log)
+        self.assertNotIn('other_1.0_all.deb', log)
+        self.assertEqual(list(log.exclude(['pkg1_1.0_amd64.deb', 'other_1.0_all.deb'])), ['other_1.0_all.deb'])
+
+    def test_read_entries_since(self):
+        log = superseded.SupersededLog(self.dest_dir).load()
+        log.append(['a_1_all.deb'])
+        first = log.generation
+        log.append(['b_1_all.deb'])
+        entries = list(superseded.read_entries(log.file, since=first))
+        self.assertEqual(entries, [(log.generation, 'b_1_all.deb')])
+        self.assertGreater(log.generation, first)
+
+    def test_legacy_migration(self):
+        legacy = self.dest_dir / superseded.LEGACY_NAME
+        legacy.write_text('a_1_all.deb\nb_1_all.deb\n')
+        log = superseded.SupersededLog(self.dest_dir).load()
+        self.assertFalse(legacy.exists())
+        self.assertIn('b_1_all.deb', log)
+        self.assertEqual(len(log), 2)
+
+    def test_compact(self):
+        log = superseded.SupersededLog(self.dest_dir).load()
+        log.append(['a_1_all.deb'])
+        log.append(['b_1_all.deb'])
+        log.append(['c_1_all.deb'])
+        # Duplicate line, e.g. from an interrupted rewrite.
+        with open(log.file, 'a') as f:
+            f.write(f"{log.generation} c_1_all.deb\n")
+        log = superseded.SupersededLog(self.dest_dir).load()
+        generation = log.generation
+        self.assertEqual(log.compact(), 1)
+        self.assertEqual(log.compact(2), 1)
+        self.assertEqual([d for g, d in superseded.read_entries(log.file)], ['b_1_all.deb', 'c_1_all.deb'])
+        self.assertNotIn('a_1_all.deb', log)
+        self.assertEqual(superseded.SupersededLog(self.dest_dir).load().generation, generation)
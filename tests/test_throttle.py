@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+
+from apt_lan import throttle
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+def at_hour(hour):
+    return time.struct_time((2021, 6, 7, hour, 30, 0, 0, 158, -1))
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'network': {
+                'bwlimit': '1000',
+                'busy_hours': '8-12, 13-17',
+                'busy_bwlimit': '100',
+                'nice': '5',
+            },
+        }
+
+    def tearDown(self):
+        pass
+
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(1000, burst=2000)
+        self.assertEqual(bucket.reserve(2000), 0)
+        # Bucket is now empty; the next 500 bytes take about 0.5 s.
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=1)
+        self.assertAlmostEqual(bucket.reserve(500), 1.0, places=1)
+
+    def test_is_busy(self):
+        self.assertTrue(throttle.is_busy('8-12,13-17', at_hour(9)))
+        self.assertFalse(throttle.is_busy('8-12,13-17', at_hour(12)))
+        self.assertFalse(throttle.is_busy('8-12,13-17', at_hour(17)))
+        self.assertTrue(throttle.is_busy('22-6', at_hour(23)))
+        self.assertTrue(throttle.is_busy('22-6', at_hour(2)))
+        self.assertFalse(throttle.is_busy('22-6', at_hour(6)))
+        self.assertFalse(throttle.is_busy('', at_hour(9)))
+        self.assertFalse(throttle.is_busy('x-y', at_hour(9)))
+
+    def test_get_policy(self):
+        policy = throttle.get_policy(self.config, 'network', at_hour(9))
+        self.assertTrue(policy.get('busy'))
+        self.assertEqual(policy.get('bwlimit'), 100 * 1024)
+        self.assertEqual(policy.get('nice'), 5)
+        policy = throttle.get_policy(self.config, 'network', at_hour(20))
+        self.assertEqual(policy.get('bwlimit'), 1000 * 1024)
+        policy = throttle.get_policy(self.config, 'system', at_hour(9))
+        self.assertEqual(policy.get('bwlimit'), 0)
+        self.assertIsNone(throttle.get_bucket(policy))
+        self.assertEqual(policy.get('ionice'), 'best-effort')
+
+    def test_iter_chunks(self):
+        sizes = {'a': 600, 'b': 600, 'c': 100, 'd': 2000}
+        chunks = list(throttle.iter_chunks(['a', 'b', 'c', 'd'], sizes, 1000))
+        self.assertEqual(chunks, [(['a', 'b'], 1200), (['c', 'd'], 2100)])
+
+    def test_fetch_limited(self):
+        def fetch_chunk(chunk, bwlimit):
+            # Stand-in for rsync --bwlimit.
+            size = sum(sizes.get(n) for n in chunk)
+            time.sleep(size / bwlimit)
+            return {n: sizes.get(n) for n in chunk}
+        # More than the bucket's burst, so charging the bucket as well as
+        #   limiting the transfer would take about twice as long.
+        sizes = {'a.deb': 60000, 'b.deb': 60000}
+        bucket = throttle.TokenBucket(100000)
+        start = time.monotonic()
+        transferred = throttle.fetch_limited(fetch_chunk, list(sizes), sizes, bucket)
+        elapsed = time.monotonic() - start
+        self.assertEqual(transferred, sizes)
+        self.assertGreaterEqual(elapsed, 1.1)
+        self.assertLess(elapsed, 1.5)
+
+    def test_parallel_shares(self):
+        shares = []
+        def fetch_chunk(chunk, bwlimit):
+            shares.append(bwlimit)
+            time.sleep(sizes.get(chunk[0]) / bwlimit)
+            return {chunk[0]: sizes.get(chunk[0])}
+        # Four peers at once stay within the rate from their first chunk on.
+        sizes = {f"{i}.deb": 10000 for i in range(4)}
+        bucket = throttle.TokenBucket(80000)
+        bucket.plan_transfers(len(sizes), 4)
+        threads = [threading.Thread(target=throttle.fetch_limited, args=(fetch_chunk, [n], sizes, bucket)) for n in sizes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(shares, [20000] * 4)
+        # Shares grow as planned transfers end.
+        bucket.plan_transfers(3, 2)
+        self.assertEqual(bucket.get_share(), 40000)
+        bucket.end_transfer()
+        self.assertEqual(bucket.get_share(), 40000)
+        bucket.end_transfer()
+        self.assertEqual(bucket.get_share(), 80000)
@@ -0,0 +1,39 @@
+import select
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from apt_lan import watch
+
+# Assert*() methods here:
+# https://docs.python.org/3/library/unittest.html?highlight=pytest#unittest.TestCase
+
+class Basic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_watcher(self):
+        with watch.Watcher() as watcher:
+            watcher.add(self.dir, watch.IN_CLOSE_WRITE | watch.IN_MOVED_TO | watch.IN_DELETE)
+            self.assertEqual(list(watcher.read_events()), [])
+            (self.dir / 'foo.deb.partial').write_bytes(b'deb')
+            (self.dir / 'foo.deb.partial').rename(self.dir / 'foo_1.0_all.deb')
+            (self.dir / 'foo_1.0_all.deb').unlink()
+            ready, _, _ = select.select([watcher], [], [], 5)
+            self.assertEqual(ready, [watcher])
+            events = [(n, m & ~watch.IN_ONLYDIR) for f, n, m in watcher.read_events()]
+            self.assertEqual(events, [
+                ('foo.deb.partial', watch.IN_CLOSE_WRITE),
+                ('foo_1.0_all.deb', watch.IN_MOVED_TO),
+                ('foo_1.0_all.deb', watch.IN_DELETE),
+            ])
+
+    def test_watcher_missing_dir(self):
+        with watch.Watcher() as watcher:
+            with self.assertRaises(OSError):
+                watcher.add(self.dir / 'missing', watch.IN_CLOSE_WRITE)